@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Zero-copy IQ reads of the BB60C for channel-capturing.py.
+
+bb_get_IQ_unpacked (bbdevice/bb_api.py) allocates a new array and a result dict on every call. bb_get_IQ_into
+calls bbGetIQ of the BB API library through ctypes with a bbIQPacket pointing to a caller-owned complex64 array,
+so the samples are written by the API straight into the preallocated buffers of the capture loop. The packet is
+allocated once per device and reused : the result fields (sec, nano, sampleLoss, dataRemaining) are read from
+the returned packet and stay valid until the next read of the device.
+
+bb_sim.py provides the same bb_get_IQ_into function for the simulated device.
+
+With --iq16 the BB60C streams 16-bit complex shorts instead of 32-bit complex floats (bb_configure_IQ_data_type),
+which halves the bytes moved per sample. The buffers are then int16 arrays of (I, Q) pairs, and the samples in
+sqrt(mW) are (I, Q) / 32768 * correction, with the correction of bb_get_IQ_correction.
+
+aligned_empty allocates the preallocated buffers on page boundaries.
+"""
+import ctypes
+import numpy as np
+
+# bbDataType of bb_api.h
+BB_DATA_TYPE_32FC = 0
+BB_DATA_TYPE_16SC = 1
+
+# Alignment (bytes) of the buffers allocated by aligned_empty
+PAGE_SIZE = 4096
+
+
+class bbIQPacket(ctypes.Structure):
+    """bbIQPacket of bb_api.h"""
+    _fields_ = [("iqData", ctypes.c_void_p),
+                ("iqCount", ctypes.c_int),
+                ("triggers", ctypes.POINTER(ctypes.c_int)),
+                ("triggerCount", ctypes.c_int),
+                ("purge", ctypes.c_int),
+                ("dataRemaining", ctypes.c_int),
+                ("sampleLoss", ctypes.c_int),
+                ("sec", ctypes.c_int),
+                ("nano", ctypes.c_int)]
+
+
+# BB API library loaded by load_bb_library() and the reusable packet of each device
+bblib = None
+packets = {}
+
+
+def load_bb_library(path):
+    """Load the BB API library (bb_api.dll) and declare the functions used"""
+    global bblib
+    bblib = ctypes.CDLL(path)
+    bblib.bbGetIQ.argtypes = [ctypes.c_int, ctypes.POINTER(bbIQPacket)]
+    bblib.bbGetIQ.restype = ctypes.c_int
+    bblib.bbConfigureIQDataType.argtypes = [ctypes.c_int, ctypes.c_int]
+    bblib.bbConfigureIQDataType.restype = ctypes.c_int
+    bblib.bbGetIQCorrection.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_float)]
+    bblib.bbGetIQCorrection.restype = ctypes.c_int
+
+
+def check_status(status, function):
+    # Negative status are errors, positive status are warnings
+    if status < 0:
+        raise RuntimeError("{} error {}".format(function, status))
+
+
+def bb_configure_IQ_data_type(device, data_type):
+    """Select the IQ data type of the device : BB_DATA_TYPE_32FC or BB_DATA_TYPE_16SC"""
+    status = bblib.bbConfigureIQDataType(device, data_type)
+    check_status(status, "bbConfigureIQDataType")
+    return {"status" : status}
+
+
+def bb_get_IQ_correction(device):
+    """Correction of the 16-bit IQ of the device, valid after bb_initiate : samples (sqrt(mW)) = (I, Q) / 32768 * correction"""
+    correction = ctypes.c_float()
+    status = bblib.bbGetIQCorrection(device, ctypes.byref(correction))
+    check_status(status, "bbGetIQCorrection")
+    return {"status" : status, "correction" : correction.value}
+
+
+def bb_get_IQ_into(device, iq, purge):
+    """Read len(<iq>) samples of the device into the array <iq> (C contiguous) : complex64, or int16 of shape (samples, 2)
+    with BB_DATA_TYPE_16SC. Return the bbIQPacket"""
+    packet = packets.get(device)
+    if packet is None:
+        packet = bbIQPacket()
+        packets[device] = packet
+    packet.iqData = iq.ctypes.data
+    packet.iqCount = len(iq)
+    packet.triggers = None
+    packet.triggerCount = 0
+    packet.purge = purge
+    check_status(bblib.bbGetIQ(device, ctypes.byref(packet)), "bbGetIQ")
+    return packet
+
+
+def aligned_empty(shape, dtype=np.complex64, alignment=PAGE_SIZE):
+    """Uninitialized array whose data starts on an <alignment> bytes boundary"""
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(size + alignment, dtype=np.uint8)
+    offset = (-raw.ctypes.data) % alignment
+    return raw[offset:offset+size].view(dtype).reshape(shape)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of a raw IQ recording (see iq_recorder.py) as a BB60C, for channel-capturing.py --device replay.
+
+Provide the same functions and constants as bb_sim.py, so the recorded IQ goes through the same detection engine
+as a live capture. The recording is memory-mapped and read as fast as the processing goes (faster than real time),
+so detector parameters can be swept over one recording (see replay-sweep.py).
+
+The recorded reads of each IQ center frequency are replayed in order, one after the other, whatever the hop
+order of the replay : bb_configure_IQ_center selects the center frequency and the next reads continue from where
+the last read of this frequency stopped. The timestamps are the recorded ones.
+    - The decimation and the bandwidth of bb_configure_IQ must match the recording, and the center frequencies
+      must be recorded ones (same -f, -s, -fb, -d and --channelizer as the recorded capture).
+    - The reads with purge (flush after retune) do not consume the recording : the recorded samples are already
+      settled. They return zeros.
+    - A read that spans two recorded reads is filled from both, with the timestamp of its first sample.
+    - A read past the end of the recording of its center frequency raises EOFError, which ends the replay.
+A 16-bit recording (--iq16) can be replayed with or without --iq16. A complex64 recording needs the 32-bit IQ.
+"""
+import numpy as np
+
+from iq_recorder import load_recording
+from bb_sim import (BB_FALSE, BB_TRUE, BB_AUTO_GAIN, BB_AUTO_ATTEN, BB_IDLE, BB_SWEEPING, BB_REAL_TIME, BB_STREAMING,
+                    BB_STREAM_IQ, BB_DATA_TYPE_32FC, BB_DATA_TYPE_16SC, BB_NO_ERROR, SimIQPacket)
+
+#### Replay settings ##########################################################
+replay_settings = {
+    "recording" : None
+}
+
+# Opened devices, key is the handle
+devices = {}
+
+
+def replay_configure(**settings):
+    """Update the replay settings (path of the recording). Only affect the devices opened afterward"""
+    for key in settings:
+        if key not in replay_settings:
+            raise KeyError("Unknown replay setting : {}".format(key))
+    replay_settings.update(settings)
+
+
+class ReplayDevice:
+    """State of one replayed BB60C"""
+
+    def __init__(self, path):
+        self.header, self.iq, self.markers = load_recording(path)
+        self.decimation = self.header["decimation"]
+        # Recorded reads (marker indices) of each center frequency, and the replay position : next read and sample in it
+        self.reads = {}
+        for k, center in enumerate(self.markers['center_freq']):
+            self.reads.setdefault(center_key(center), []).append(k)
+        self.position = {key : [0, 0] for key in self.reads}
+        self.center = None
+        self.data_type = BB_DATA_TYPE_32FC
+        self.packet = SimIQPacket()
+
+    def configure_center(self, center_freq):
+        key = center_key(center_freq)
+        if key not in self.reads:
+            raise ValueError("Center frequency {} MHz not in the IQ recording".format(center_freq/1e6))
+        self.center = key
+
+    def configure_IQ(self, decimation, bandwidth):
+        if decimation != self.decimation or bandwidth != self.header["bandwidth"]:
+            raise ValueError("The IQ recording was captured with decimation {} and bandwidth {} MHz".format(
+                self.decimation, self.header["bandwidth"]/1e6))
+
+    def configure_data_type(self, data_type):
+        if data_type == BB_DATA_TYPE_16SC and self.iq.dtype != np.int16:
+            raise ValueError("The IQ recording has 32-bit IQ, replay it without --iq16")
+        self.data_type = data_type
+
+    def read_into(self, iq, purge):
+        """Write the next len(<iq>) recorded samples of the current center frequency into <iq> : complex64, or int16
+        of shape (samples, 2). Return the reused packet of the device"""
+        if purge == BB_TRUE:
+            iq[:] = 0
+            self.packet.iqCount = len(iq)
+            self.packet.sampleLoss = BB_FALSE
+            return self.packet
+        reads = self.reads[self.center]
+        position = self.position[self.center]
+        start = 0
+        while start < len(iq):
+            if position[0] >= len(reads):
+                raise EOFError("End of the IQ recording at {} MHz".format(self.center/1e6))
+            marker = self.markers[reads[position[0]]]
+            if start == 0:
+                time_ns = int(marker['time_ns']) + (position[1] * 1000000000 * self.decimation) // 40000000
+                self.packet.sec = time_ns // 1000000000
+                self.packet.nano = time_ns % 1000000000
+                self.packet.sampleLoss = int(marker['sample_loss']) if position[1] == 0 else BB_FALSE
+            n = min(len(iq) - start, int(marker['count']) - position[1])
+            offset = int(marker['offset']) + position[1]
+            self.copy(self.iq[offset:offset+n], iq[start:start+n], float(marker['correction']))
+            start = start + n
+            position[1] = position[1] + n
+            if position[1] == marker['count']:
+                position[0] = position[0] + 1
+                position[1] = 0
+        self.packet.iqCount = len(iq)
+        self.packet.dataRemaining = 0
+        return self.packet
+
+    def correction(self):
+        """Correction of the 16-bit IQ of the next read of the current center frequency"""
+        reads = self.reads[self.center]
+        position = self.position[self.center]
+        if position[0] >= len(reads):
+            return 1.0
+        return float(self.markers['correction'][reads[position[0]]])
+
+    def copy(self, recorded, iq, correction):
+        if recorded.dtype == iq.dtype:
+            iq[:] = recorded
+        else:
+            # int16 recording replayed as complex64 : apply the correction
+            values = iq.view(np.float32).reshape(-1, 2)
+            np.multiply(recorded, np.float32(correction/32768), out=values)
+
+
+def center_key(center_freq):
+    """Center frequency rounded to the Hz, used to match the configured center frequencies with the recorded ones"""
+    return int(round(center_freq))
+
+
+#### bb_api functions #########################################################
+def bb_open_device():
+    return bb_open_device_by_serial(len(devices))
+
+def bb_open_device_by_serial(serial_number):
+    if replay_settings["recording"] is None:
+        raise ValueError("No IQ recording to replay")
+    handle = len(devices)
+    while handle in devices:
+        handle = handle + 1
+    devices[handle] = ReplayDevice(replay_settings["recording"])
+    return {"status" : BB_NO_ERROR, "handle" : handle}
+
+def bb_close_device(device):
+    devices.pop(device, None)
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_ref_level(device, ref_level):
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_gain_atten(device, gain, atten):
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_IQ_center(device, center_freq):
+    devices[device].configure_center(center_freq)
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_IQ(device, downsample_factor, bandwidth):
+    devices[device].configure_IQ(downsample_factor, bandwidth)
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_IQ_data_type(device, data_type):
+    devices[device].configure_data_type(data_type)
+    return {"status" : BB_NO_ERROR}
+
+def bb_get_IQ_correction(device):
+    return {"status" : BB_NO_ERROR, "correction" : devices[device].correction()}
+
+def bb_initiate(device, mode, flag):
+    return {"status" : BB_NO_ERROR}
+
+def bb_abort(device):
+    return {"status" : BB_NO_ERROR}
+
+def bb_get_IQ_unpacked(device, iq_count, purge):
+    iq = np.empty(iq_count, dtype=np.complex64)
+    packet = devices[device].read_into(iq, purge)
+    return {"status" : BB_NO_ERROR,
+            "iq" : iq,
+            "triggers" : [],
+            "data_remaining" : packet.dataRemaining,
+            "sample_loss" : packet.sampleLoss,
+            "sec" : packet.sec,
+            "nano" : packet.nano}
+
+def bb_get_IQ_into(device, iq, purge):
+    return devices[device].read_into(iq, purge)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Software stand-in for the BB60C python API (bbdevice/bb_api.py).
+
+Provide the same functions and constants used by channel-capturing.py so the capture pipeline can run without
+the hardware, e.g. on the Linux build/benchmark machines. Select it with --device sim. bb_get_IQ_into (see
+bb_iq_into.py) writes the samples into a caller-owned array, like the zero-copy reads of the BB60C.
+
+The simulated device produces complex64 IQ (in sqrt(mW), same as bb_get_IQ_unpacked) made of :
+    - complex gaussian noise at a configurable noise floor (dBm)
+    - bursty synthetic emitters. Each emitter is a tone at its own frequency, switched on/off by a two-state
+      process with exponentially distributed burst and gap durations. An emitter shows up in a capture only if
+      its frequency falls inside the configured filter bandwidth around the IQ center frequency.
+With BB_DATA_TYPE_16SC (bb_configure_IQ_data_type), the IQ is quantized to int16 (I, Q) pairs with the reference
+level as full scale, and bb_get_IQ_correction returns the full scale amplitude (sqrt(mW)).
+Timestamps (sec/nano) follow the sample clock of the stream started by bb_initiate, so consecutive reads are
+exactly <iq_count>/fs apart. bb_initiate waits <retune_delay> to mimic the retune/settling time of the BB60C.
+After each bb_initiate, the first <settling> samples (per decimation) carry a decaying DC transient that mimics
+the filter ramp up, starting 40 dB over the noise floor.
+
+Simulation configuration json file (--simconf) :
+    {
+        "noise_floor" : -100.0,         noise power in the capture bandwidth (dBm)
+        "retune_delay" : 1.0,           delay of each bb_initiate (ms)
+        "realtime" : true,              block reads until the samples would have been streamed by a real device
+        "settling" : {"8" : 400},       length (samples) of the filter ramp up transient per decimation
+        "seed" : 1,                     random seed (optional)
+        "emitters" : [
+            {"frequency" : 2412.0,      emitter frequency (MHz)
+             "power" : -40.0,           emitter power when active (dBm)
+             "burst" : 2000.0,          mean burst duration (us)
+             "gap" : 8000.0}            mean gap between bursts (us)
+        ]
+    }
+
+"""
+import time
+import numpy as np
+
+#### API constants (same names as bb_api.py) ##################################
+BB_FALSE = 0
+BB_TRUE = 1
+
+BB_AUTO_GAIN = -1
+BB_AUTO_ATTEN = -1
+
+BB_IDLE = -1
+BB_SWEEPING = 0
+BB_REAL_TIME = 1
+BB_STREAMING = 4
+
+BB_STREAM_IQ = 0x0
+
+BB_DATA_TYPE_32FC = 0
+BB_DATA_TYPE_16SC = 1
+
+BB_NO_ERROR = 0
+
+#### Simulation settings ######################################################
+sim_settings = {
+    "noise_floor" : -100.0,
+    "retune_delay" : 1.0,
+    "realtime" : True,
+    "settling" : {"1" : 1600, "2" : 1000, "4" : 600, "8" : 400, "16" : 300, "32" : 200, "64" : 150},
+    "seed" : None,
+    "emitters" : []
+}
+
+# Number of noise samples generated once and reused (with random offset) on every read
+noise_pool_size = 1 << 20
+
+# The amount of data (s) the device can buffer before samples are lost, similar to the ~1 second of the BB60C
+device_buffer_time = 1.0
+
+# Opened devices, key is the handle
+devices = {}
+
+
+def sim_configure(**settings):
+    """Update the simulation settings. Only affect the devices opened afterward"""
+    for key in settings:
+        if key not in sim_settings:
+            raise KeyError("Unknown simulation setting : {}".format(key))
+    sim_settings.update(settings)
+
+
+class Emitter:
+    """On/off bursty emitter. Bursts are generated lazily on the absolute time axis (ns)"""
+
+    def __init__(self, frequency, power, burst, gap, rng):
+        self.frequency = frequency * 1e6
+        self.amplitude = np.sqrt(10 ** (power/10))
+        self.burst_ns = burst * 1e3
+        self.gap_ns = gap * 1e3
+        self.rng = rng
+        self.starts = np.empty(0, dtype=np.int64)
+        self.ends = np.empty(0, dtype=np.int64)
+        self.next_start = None
+
+    def bursts(self, t_start, t_end):
+        """Return the (start, end) ns of the bursts overlapping [t_start, t_end)"""
+        if self.next_start is None:
+            self.next_start = t_start + int(self.rng.exponential(self.gap_ns))
+        # Extend the schedule until it covers t_end
+        if self.next_start < t_end:
+            new_starts = []
+            new_ends = []
+            while self.next_start < t_end:
+                end = self.next_start + max(1, int(self.rng.exponential(self.burst_ns)))
+                new_starts.append(self.next_start)
+                new_ends.append(end)
+                self.next_start = end + max(1, int(self.rng.exponential(self.gap_ns)))
+            self.starts = np.concatenate((self.starts, new_starts)).astype(np.int64)
+            self.ends = np.concatenate((self.ends, new_ends)).astype(np.int64)
+        # Drop the bursts that are already in the past to keep memory bounded
+        keep = self.ends > t_start
+        self.starts = self.starts[keep]
+        self.ends = self.ends[keep]
+        overlap = self.starts < t_end
+        return self.starts[overlap], self.ends[overlap]
+
+
+class SimIQPacket:
+    """Result fields of a read, same names as the bbIQPacket of bb_api.h"""
+
+    def __init__(self):
+        self.iqCount = 0
+        self.dataRemaining = 0
+        self.sampleLoss = BB_FALSE
+        self.sec = 0
+        self.nano = 0
+
+
+class SimDevice:
+    """State of one simulated BB60C"""
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.rng = np.random.default_rng(sim_settings["seed"])
+        self.noise_floor = sim_settings["noise_floor"]
+        self.retune_delay = sim_settings["retune_delay"] * 1e-3
+        self.realtime = sim_settings["realtime"]
+        self.settling = {int(d) : n for d, n in sim_settings["settling"].items()}
+        self.emitters = [Emitter(e["frequency"], e["power"], e["burst"], e["gap"], self.rng)
+                         for e in sim_settings["emitters"]]
+        # Unit variance complex gaussian noise, scaled on every read
+        self.noise_pool = (self.rng.standard_normal((noise_pool_size, 2), dtype=np.float32)
+                           * np.float32(np.sqrt(0.5))).view(np.complex64).ravel()
+        self.center = 0.0
+        self.decimation = 1
+        self.bandwidth = 27.0e6
+        self.fs = 40.0e6
+        self.streaming = False
+        self.ref_level = -20.0
+        self.data_type = BB_DATA_TYPE_32FC
+        # complex64 samples of the 16-bit reads before quantization, grown as needed
+        self.scratch = np.empty(0, dtype=np.complex64)
+        # Timestamp of the next sample in the stream (epoch ns) and sample counter since bb_initiate
+        self.stream_ns = 0
+        self.stream_start_ns = 0
+        self.stream_samples = 0
+        # Result of the last read, reused like the bbIQPacket of bb_get_IQ_into
+        self.packet = SimIQPacket()
+
+    def sample_time(self, n):
+        """Epoch ns of the sample <n> counted from the start of the stream"""
+        return self.stream_start_ns + (n * 1000000000 * self.decimation) // 40000000
+
+    def read(self, iq_count, purge):
+        iq = np.empty(iq_count, dtype=np.complex64)
+        packet = self.read_into(iq, purge)
+        return {"status" : BB_NO_ERROR,
+                "iq" : iq,
+                "triggers" : [],
+                "data_remaining" : packet.dataRemaining,
+                "sample_loss" : packet.sampleLoss,
+                "sec" : packet.sec,
+                "nano" : packet.nano}
+
+    def correction(self):
+        """Full scale amplitude (sqrt(mW)) of the 16-bit IQ : the reference level"""
+        return float(np.sqrt(10 ** (self.ref_level/10)))
+
+    def read_into(self, iq, purge):
+        """Write the next len(<iq>) samples of the stream into <iq> : complex64, or int16 of shape (samples, 2) with
+        BB_DATA_TYPE_16SC. Return the reused packet of the device"""
+        iq_count = len(iq)
+        if iq.dtype == np.int16:
+            if len(self.scratch) < iq_count:
+                self.scratch = np.empty(iq_count, dtype=np.complex64)
+            samples = self.scratch[:iq_count]
+        else:
+            samples = iq
+        now_ns = time.time_ns()
+        sample_loss = BB_FALSE
+        if purge == BB_TRUE:
+            # Discard everything buffered so far and resume from the current time
+            self.skip_to(now_ns)
+        elif now_ns - self.stream_ns > device_buffer_time * 1e9:
+            # The reader is too slow, the device buffer overflowed
+            sample_loss = BB_TRUE
+            self.skip_to(now_ns - int(device_buffer_time * 1e9))
+
+        t_start = self.stream_ns
+        t_end = self.sample_time(self.stream_samples + iq_count)
+        if self.realtime:
+            wait = (t_end - time.time_ns()) * 1e-9
+            if wait > 0:
+                time.sleep(wait)
+
+        self.noise_into(samples)
+        self.add_emitters(samples, t_start, t_end)
+        self.add_transient(samples)
+        if iq.dtype == np.int16:
+            self.quantize(samples, iq)
+
+        self.stream_samples = self.stream_samples + iq_count
+        self.stream_ns = t_end
+        self.packet.iqCount = iq_count
+        self.packet.dataRemaining = max(0, int((time.time_ns() - t_end) * 1e-9 * self.fs))
+        self.packet.sampleLoss = sample_loss
+        self.packet.sec = t_start // 1000000000
+        self.packet.nano = t_start % 1000000000
+        return self.packet
+
+    def skip_to(self, t_ns):
+        if t_ns > self.stream_ns:
+            self.stream_samples = ((t_ns - self.stream_start_ns) * 40000000) // (1000000000 * self.decimation)
+            self.stream_ns = self.sample_time(self.stream_samples)
+
+    def noise_into(self, iq):
+        scale = np.float32(np.sqrt(10 ** (self.noise_floor/10)))
+        offset = int(self.rng.integers(noise_pool_size))
+        # Copy the pool from the random offset, wrapping around as many times as needed
+        start = 0
+        while start < len(iq):
+            n = min(len(iq) - start, noise_pool_size - offset)
+            np.multiply(self.noise_pool[offset:offset+n], scale, out=iq[start:start+n])
+            start = start + n
+            offset = 0
+
+    def quantize(self, samples, iq):
+        """Quantize the complex64 <samples> into the int16 (I, Q) pairs <iq>, clipped at full scale"""
+        values = samples.view(np.float32).reshape(-1, 2)
+        np.multiply(values, np.float32(32768 / self.correction()), out=values)
+        np.rint(values, out=values)
+        np.clip(values, -32768, 32767, out=values)
+        np.copyto(iq, values, casting='unsafe')
+
+    def add_transient(self, iq):
+        settling = self.settling.get(self.decimation, 0)
+        if self.stream_samples >= settling:
+            return
+        n = np.arange(self.stream_samples, min(self.stream_samples + len(iq), settling))
+        # Transient power decays linearly in dB from 40 dB over the noise floor to 0 dB at the end of the settling
+        power_db = self.noise_floor + 40 * (1 - n/settling)
+        iq[:len(n)] += np.sqrt(10 ** (power_db/10)).astype(np.float32)
+
+    def add_emitters(self, iq, t_start, t_end):
+        period_ns = 1e9 / self.fs
+        for emitter in self.emitters:
+            offset_f = emitter.frequency - self.center
+            if abs(offset_f) > self.bandwidth/2:
+                continue
+            starts, ends = emitter.bursts(t_start, t_end)
+            for start, end in zip(starts, ends):
+                first = max(0, int(np.ceil((start - t_start) / period_ns)))
+                last = min(len(iq), int(np.ceil((end - t_start) / period_ns)))
+                if last <= first:
+                    continue
+                n = np.arange(first, last) + self.stream_samples
+                phase = (2 * np.pi * offset_f / self.fs) * n
+                iq[first:last] += (emitter.amplitude * np.exp(1j * phase)).astype(np.complex64)
+
+
+#### bb_api functions #########################################################
+def bb_open_device():
+    return bb_open_device_by_serial(len(devices))
+
+def bb_open_device_by_serial(serial_number):
+    handle = len(devices)
+    while handle in devices:
+        handle = handle + 1
+    devices[handle] = SimDevice(serial_number)
+    return {"status" : BB_NO_ERROR, "handle" : handle}
+
+def bb_get_serial_number_list():
+    return {"status" : BB_NO_ERROR, "serials" : [d.serial for d in devices.values()], "device_count" : len(devices)}
+
+def bb_close_device(device):
+    devices.pop(device, None)
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_ref_level(device, ref_level):
+    devices[device].ref_level = ref_level
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_gain_atten(device, gain, atten):
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_IQ_center(device, center_freq):
+    devices[device].center = center_freq
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_IQ(device, downsample_factor, bandwidth):
+    dev = devices[device]
+    dev.decimation = downsample_factor
+    dev.fs = 40.0e6 / downsample_factor
+    dev.bandwidth = bandwidth
+    return {"status" : BB_NO_ERROR}
+
+def bb_configure_IQ_data_type(device, data_type):
+    devices[device].data_type = data_type
+    return {"status" : BB_NO_ERROR}
+
+def bb_get_IQ_correction(device):
+    return {"status" : BB_NO_ERROR, "correction" : devices[device].correction()}
+
+def bb_initiate(device, mode, flag):
+    dev = devices[device]
+    if dev.retune_delay > 0:
+        time.sleep(dev.retune_delay)
+    dev.streaming = True
+    dev.stream_start_ns = time.time_ns()
+    dev.stream_ns = dev.stream_start_ns
+    dev.stream_samples = 0
+    return {"status" : BB_NO_ERROR}
+
+def bb_abort(device):
+    devices[device].streaming = False
+    return {"status" : BB_NO_ERROR}
+
+def bb_get_IQ_unpacked(device, iq_count, purge):
+    return devices[device].read(iq_count, purge)
+
+def bb_get_IQ_into(device, iq, purge):
+    return devices[device].read_into(iq, purge)
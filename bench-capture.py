@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the capture pipeline of channel-capturing.py on the simulated BB60C (bb_sim.py), so it can be run on
+any machine without the hardware.
+
+Each benchmark case runs channel-capturing.py with --device sim in a temporary folder and reads back the
+throughput (buffers/s, events/s), the dead time per hop and the detection efficiency (events per second of
+observation, to compare the sweep options) from the Metadata file.
+
+The default simulation configuration (sim_conf_bench.json) does not pace the reads on the sample clock
+("realtime" : false), so the throughput measures the capture pipeline itself. With the real-time pacing the
+throughput is capped by the sample rate and a slowdown only shows once the processing falls behind it.
+
+Output : table of the results. Optional :
+    --save <file>       save the results as the baseline json file
+    --baseline <file>   compare with a saved baseline and exit with error if the throughput (buffers/s) dropped or
+                        the dead time per hop increased more than the tolerance. The event rates are only reported
+
+Example : python bench-capture.py -t 0.1 --baseline bench-baseline.json
+"""
+import argparse
+import os
+import sys
+import csv
+import json
+import shutil
+import subprocess
+import tempfile
+
+script_directory = os.path.dirname(os.path.abspath(__file__))
+
+# Benchmark cases : name and the extra arguments passed to channel-capturing.py
+BENCH_CASES = [
+    ('fixed-d8', ['--option', 'fixed', '-d', '8', '-f', '2412']),
+    ('sweep-d8', ['--option', 'sweep', '-d', '8', '-s', '100']),
+    ('sweep-d2', ['--option', 'sweep', '-d', '2', '-s', '100']),
+    ('sweep-d8-batched', ['--option', 'sweep', '-d', '8', '-s', '100', '--batched']),
+    ('sweep-d1-threads', ['--option', 'sweep', '-d', '1', '-s', '100', '--batched', '--threads', '2']),
+    ('rand-sweep-d8', ['--option', 'rand-sweep', '-d', '8', '-s', '100']),
+    ('hop-with-p-d8', ['--option', 'hop-with-p', '-d', '8', '-s', '100']),
+    ('bandit-d8', ['--option', 'bandit', '-d', '8', '-s', '100']),
+]
+
+# Metadata rows reported by the benchmark. For each : (row name, True if higher is better, False if lower is better,
+# None if only reported). The event rates depend on the simulated emitters, not on the capture pipeline, so they are
+# not compared with the baseline
+BENCH_METRICS = [
+    ('Throughput (buffers/s)', True),
+    ('Events (events/s)', None),
+    ('Dead time per hop (ms)', False),
+    ('Detection efficiency (events/s observed)', None),
+]
+
+
+def read_metadata(path):
+    with open(path, 'r', newline='') as f:
+        return {row[0] : row[1] for row in csv.reader(f) if len(row) >= 2}
+
+
+def run_case(name, case_args, duration, simconf, extra_args):
+    work_dir = tempfile.mkdtemp(prefix='bench-capture-')
+    try:
+        shutil.copy(os.path.join(script_directory, 'default_conf.json'), work_dir)
+        command = [sys.executable, os.path.join(script_directory, 'channel-capturing.py'),
+                   '--device', 'sim', '--simconf', simconf, '-t', str(duration), '-o', name] + case_args + extra_args
+        subprocess.run(command, cwd=work_dir, check=True, stdout=subprocess.DEVNULL)
+        metadata = read_metadata(os.path.join(work_dir, 'Metadata-' + name + '.csv'))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {metric : float(metadata[metric]) for metric, _ in BENCH_METRICS}
+
+
+my_parser = argparse.ArgumentParser(prog="bench-capture", description=__doc__,
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+my_parser.add_argument('-t', '--duration', metavar='<duration>', type=float, default=0.1,
+                       help='Collection duration (min) of each benchmark case. Default to 0.1 min')
+my_parser.add_argument('--simconf', metavar='<sim_configuration_file>', type=str,
+                       default=os.path.join(script_directory, 'sim_conf_bench.json'),
+                       help='Simulation configuration json file. Default to sim_conf_bench.json, the emitters of sim_conf.json without the real-time pacing')
+my_parser.add_argument('--cases', metavar='<case>', nargs='*', choices=[c[0] for c in BENCH_CASES],
+                       help='Only run these benchmark cases')
+my_parser.add_argument('--save', metavar='<baseline_file>', type=str, help='Save the results to a baseline json file')
+my_parser.add_argument('--baseline', metavar='<baseline_file>', type=str, help='Compare the results to a baseline json file')
+my_parser.add_argument('--tolerance', metavar='<ratio>', type=float, default=0.2,
+                       help='Allowed relative regression compared to the baseline. Default to 0.2')
+my_parser.add_argument('--extra', metavar='"<arguments>"', type=str, default='',
+                       help='Extra arguments passed to channel-capturing.py for every case')
+args = my_parser.parse_args()
+
+results = {}
+for name, case_args in BENCH_CASES:
+    if args.cases and name not in args.cases:
+        continue
+    results[name] = run_case(name, case_args, args.duration, args.simconf, args.extra.split())
+
+# Column width of each metric
+widths = [max(26, len(metric) + 2) for metric, _ in BENCH_METRICS]
+print('{:<20}'.format('case') + ''.join('{:>{}}'.format(metric, width) for (metric, _), width in zip(BENCH_METRICS, widths)))
+for name in results:
+    print('{:<20}'.format(name) + ''.join('{:>{}.3f}'.format(results[name][metric], width) for (metric, _), width in zip(BENCH_METRICS, widths)))
+
+if args.save is not None:
+    with open(args.save, 'w') as outfile:
+        outfile.write(json.dumps(results, indent=4))
+
+if args.baseline is not None:
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = []
+    for name in results:
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in BENCH_METRICS:
+            if higher_is_better is None or metric not in baseline[name]:
+                continue
+            old_value = baseline[name][metric]
+            new_value = results[name][metric]
+            if old_value == 0:
+                continue
+            change = (new_value - old_value) / old_value
+            if (higher_is_better and change < -args.tolerance) or (not higher_is_better and change > args.tolerance):
+                regressions.append('{} {} : {:.3f} -> {:.3f}'.format(name, metric, old_value, new_value))
+    if regressions:
+        print('Regression compared to baseline <{}> :'.format(args.baseline))
+        for line in regressions:
+            print('    ' + line)
+        sys.exit(1)
+    print('No regression compared to baseline <{}>'.format(args.baseline))
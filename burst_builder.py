@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Event coalescing of channel-capturing.py (--coalesce).
+
+Instead of one event per buffer (or window) over the threshold, the BurstBuilder tracks the active state of each
+channel and writes one record per burst to the event sink (BURST_DTYPE : start time, end time, channel, mean and
+peak power, number of buffers).
+
+    - A burst starts at a buffer with power >= <on_threshold> and continues through the buffers with
+      power >= <on_threshold> - <hysteresis> dB. The on threshold (mW) is given per channel.
+    - Buffers under the off threshold for at most <gap_ns> are bridged : the burst continues if the power rises
+      again within the gap tolerance. The end of the burst is the end of its last buffer over the off threshold.
+    - A burst is closed when the gap tolerance is exceeded, when its channel stops being observed (retune, the
+      next buffers of the channel do not follow the last one), or at the end of the capturing (close_all).
+
+The buffers are given dwell by dwell with add(), in time order for each channel. The state machine runs on whole
+arrays : the buffers over the off threshold are chained into segments by the gap tolerance, and each segment is
+trimmed to start at its first buffer over <on_threshold>.
+"""
+import numpy as np
+
+from event_sink import BURST_DTYPE
+
+
+class BurstBuilder:
+    """Coalesce the buffers over the threshold of each channel into bursts written to <sink>"""
+
+    def __init__(self, sink, channel_number, on_threshold, hysteresis=0.0, gap_ns=0):
+        self.sink = sink
+        # On threshold (mW) per channel, shared with the detection, and the ratio of the off threshold to the on threshold
+        self.on_threshold = on_threshold
+        self.off_ratio = 10 ** (-hysteresis/10)
+        self.gap_ns = gap_ns
+        # Open burst of each channel : start/end (epoch ns), sum and peak of the power (mW) and number of buffers
+        self.open = np.zeros(channel_number, dtype=bool)
+        self.start_ns = np.zeros(channel_number, dtype=np.int64)
+        self.end_ns = np.zeros(channel_number, dtype=np.int64)
+        self.power_sum = np.zeros(channel_number)
+        self.peak_power = np.zeros(channel_number)
+        self.count = np.zeros(channel_number, dtype=np.int64)
+        # End (epoch ns) of the last buffer observed in each channel
+        self.observed_end_ns = np.zeros(channel_number, dtype=np.int64)
+
+    def add(self, start_ns, end_ns, channels, power):
+        """Add the buffers of one dwell : start/end time (epoch ns) of each buffer (in time order), the channel
+        indices and the avg power (mW) as an array (buffers, channels)"""
+        records = []
+        for k, channel in enumerate(channels):
+            records.extend(self.add_channel(start_ns, end_ns, channel, power[:, k]))
+        if records:
+            self.sink.add_records(np.array(records, dtype=BURST_DTYPE))
+
+    def add_channel(self, start_ns, end_ns, channel, power):
+        bursts = []
+        # Close the open burst if the channel was not observed since its last buffer
+        if self.open[channel] and start_ns[0] - self.observed_end_ns[channel] > end_ns[0] - start_ns[0]:
+            bursts.append(self.close(channel))
+        self.observed_end_ns[channel] = end_ns[-1]
+
+        on_threshold = self.on_threshold[channel]
+        sustain = np.flatnonzero(power >= on_threshold * self.off_ratio)
+        if len(sustain) > 0:
+            # Chain the buffers over the off threshold into segments, a new segment starts after a gap longer than the tolerance
+            new_segment = np.empty(len(sustain), dtype=bool)
+            new_segment[1:] = start_ns[sustain[1:]] - end_ns[sustain[:-1]] > self.gap_ns
+            continue_open = self.open[channel] and start_ns[sustain[0]] - self.end_ns[channel] <= self.gap_ns
+            if self.open[channel] and not continue_open:
+                bursts.append(self.close(channel))
+            new_segment[0] = True
+            segment = np.cumsum(new_segment) - 1
+
+            # Keep the buffers from the first one over the on threshold of each segment. The segment continuing the open burst is kept whole
+            above = (power[sustain] >= on_threshold).astype(np.int64)
+            above_cumsum = np.cumsum(above)
+            segment_first = np.flatnonzero(new_segment)
+            above_before = above_cumsum[segment_first] - above[segment_first]
+            active = above_cumsum - above_before[segment] > 0
+            if continue_open:
+                active[segment == 0] = True
+            kept = sustain[active]
+            kept_segment = segment[active]
+
+            if len(kept) > 0:
+                first = np.flatnonzero(np.diff(kept_segment, prepend=-1) != 0)
+                burst_start = start_ns[kept[first]]
+                burst_end = end_ns[kept[np.append(first[1:], len(kept)) - 1]]
+                burst_sum = np.add.reduceat(power[kept].astype(np.float64), first)
+                burst_peak = np.maximum.reduceat(power[kept], first)
+                burst_count = np.diff(np.append(first, len(kept)))
+                if continue_open and kept_segment[0] == 0:
+                    # Merge the first segment into the open burst
+                    burst_start[0] = self.start_ns[channel]
+                    burst_sum[0] = burst_sum[0] + self.power_sum[channel]
+                    burst_peak[0] = max(burst_peak[0], self.peak_power[channel])
+                    burst_count[0] = burst_count[0] + self.count[channel]
+                    self.open[channel] = False
+                for i in range(len(first) - 1):
+                    bursts.append((burst_start[i], channel, burst_sum[i]/burst_count[i], burst_end[i], burst_peak[i], burst_count[i]))
+                # The last burst stays open for the next dwell
+                self.open[channel] = True
+                self.start_ns[channel] = burst_start[-1]
+                self.end_ns[channel] = burst_end[-1]
+                self.power_sum[channel] = burst_sum[-1]
+                self.peak_power[channel] = burst_peak[-1]
+                self.count[channel] = burst_count[-1]
+
+        # Close the open burst if the gap tolerance is already exceeded at the end of the dwell
+        if self.open[channel] and end_ns[-1] - self.end_ns[channel] > self.gap_ns:
+            bursts.append(self.close(channel))
+        return bursts
+
+    def close(self, channel):
+        self.open[channel] = False
+        return (self.start_ns[channel], channel, self.power_sum[channel]/self.count[channel], self.end_ns[channel],
+                self.peak_power[channel], self.count[channel])
+
+    def close_all(self):
+        """Write the open bursts of all the channels, at the end of the capturing"""
+        records = [self.close(channel) for channel in np.flatnonzero(self.open)]
+        if records:
+            self.sink.add_records(np.array(records, dtype=BURST_DTYPE))
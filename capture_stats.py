@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming statistics of channel-capturing.py, kept in bounded memory during the capturing and written to the
+Metadata file.
+
+PhaseProfiler : latency of each phase of the capturing (bb_configure_IQ_center, bb_initiate, garbage flush and
+                capture read), kept as log-spaced histograms. Reports p50/p95/p99/max per phase, optionally
+                broken down by frequency or decimation.
+DutyCycleAccount : sample-exact observed time per channel, retune dead time and missed time (gaps in the device
+                timestamps and sample loss), and the overall duty cycle of the capturing in the Metadata file. The
+                per-channel dwell counts, observed time and revisit intervals are written to
+                DutyCycle-<output_filename>.csv, so the Metadata file does not grow with the span.
+ChannelStats : running per-channel occupancy and power statistics (buffers observed and over the threshold,
+                occupancy rate, mean/std/min/max of the buffer power in dBm, threshold), written to Stats-<output_filename>.csv
+                periodically and at the end of the capturing.
+PowerHistogram : per-channel histogram of the buffer power (dBm) with the float64 sum of the power, giving the
+                avg and percentile power of the channels in constant memory (--acquire).
+"""
+import os
+import csv
+import math
+import threading
+import numpy as np
+
+
+class LatencyHistogram:
+    """Histogram of durations with log-spaced bins from <min_time> to <max_time> seconds"""
+
+    def __init__(self, min_time=1e-7, max_time=100.0, bins_per_decade=40):
+        self.min_time = min_time
+        self.bins_per_decade = bins_per_decade
+        self.bin_count = int(math.ceil(math.log10(max_time/min_time) * bins_per_decade))
+        self.counts = np.zeros(self.bin_count + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds > self.min_time:
+            index = min(int(math.log10(seconds/self.min_time) * self.bins_per_decade) + 1, self.bin_count)
+        else:
+            index = 0
+        self.counts[index] = self.counts[index] + 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper edge (s) of the bin containing the q-th percentile, bounded by the max recorded value"""
+        if self.count == 0:
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(self.counts), q/100 * self.count))
+        return min(self.min_time * 10 ** (index / self.bins_per_decade), self.max)
+
+
+class PhaseProfiler:
+    """Latency histograms per phase, and optionally per frequency or decimation (the key given to record())"""
+
+    PHASES = ['configure', 'initiate', 'flush', 'read']
+
+    def __init__(self, breakdown='total'):
+        self.breakdown = breakdown
+        self.histograms = {}
+
+    def record(self, phase, seconds, key=None):
+        if self.breakdown == 'total':
+            key = None
+        histogram = self.histograms.get((phase, key))
+        if histogram is None:
+            histogram = LatencyHistogram()
+            self.histograms[(phase, key)] = histogram
+        histogram.record(seconds)
+
+    def summary_rows(self):
+        """Metadata rows : [name, count, mean, p50, p95, p99, max] with the times in ms"""
+        rows = [['Latency (ms)', 'count', 'mean', 'p50', 'p95', 'p99', 'max']]
+        for (phase, key) in sorted(self.histograms, key=lambda k: (self.PHASES.index(k[0]), str(k[1]))):
+            histogram = self.histograms[(phase, key)]
+            name = 'Latency {}'.format(phase) if key is None else 'Latency {} {}'.format(phase, key)
+            rows.append([name, histogram.count, histogram.total*1e3/max(histogram.count, 1)]
+                        + [histogram.percentile(q)*1e3 for q in (50, 95, 99)] + [histogram.max*1e3])
+        return rows
+
+
+class DutyCycleAccount:
+    """Account the time of the capturing spent observing each channel versus retuning, missed or processing"""
+
+    def __init__(self, channel_number, fs):
+        self.fs = fs
+        self.channel_number = channel_number
+        # Samples observed (captured) per channel, and in total by the device. With the channelizer, the channels of one
+        # tune are observed at the same time
+        self.observed_samples = np.zeros(channel_number, dtype=np.int64)
+        self.device_samples = 0
+        # Visits (consecutive dwells without retune) per channel and the revisit intervals, start to start (ns)
+        self.visit_count = np.zeros(channel_number, dtype=np.int64)
+        self.last_visit_ns = np.full(channel_number, -1, dtype=np.int64)
+        self.revisit_sum_ns = np.zeros(channel_number, dtype=np.int64)
+        self.revisit_max_ns = np.zeros(channel_number, dtype=np.int64)
+        self.retune_time = 0.0
+        # Missed time (ns) : gaps between consecutive reads of the same stream, and number of reads with sample loss
+        self.missed_ns = 0
+        self.sample_loss_count = 0
+        # Expected timestamp (ns) of the next read, None right after a retune
+        self.next_read_ns = None
+
+    def record_retune(self, seconds):
+        self.retune_time = self.retune_time + seconds
+        self.next_read_ns = None
+
+    def record_read(self, channel, iq_count, start_ns, sample_loss):
+        """<channel> : the channel index, or an array of the channels observed at the same time (channelizer)"""
+        if self.next_read_ns is None:
+            # First read after a retune, a new visit of the channel(s)
+            interval = np.where(self.last_visit_ns[channel] >= 0, start_ns - self.last_visit_ns[channel], 0)
+            self.revisit_sum_ns[channel] = self.revisit_sum_ns[channel] + interval
+            self.revisit_max_ns[channel] = np.maximum(self.revisit_max_ns[channel], interval)
+            self.last_visit_ns[channel] = start_ns
+            self.visit_count[channel] = self.visit_count[channel] + 1
+        elif start_ns - self.next_read_ns > 1e9 / self.fs:
+            # Gap of more than one sample in the stream
+            self.missed_ns = self.missed_ns + start_ns - self.next_read_ns
+        if sample_loss:
+            self.sample_loss_count = self.sample_loss_count + 1
+        self.observed_samples[channel] = self.observed_samples[channel] + iq_count
+        self.device_samples = self.device_samples + iq_count
+        self.next_read_ns = start_ns + int(iq_count * 1e9 / self.fs)
+
+    def summary_rows(self, elapsed_time):
+        """Metadata rows : overall time accounting and duty cycle"""
+        observed_time = self.device_samples / self.fs
+        missed_time = self.missed_ns * 1e-9
+        other_time = max(elapsed_time - observed_time - self.retune_time - missed_time, 0.0)
+        return [['Observed time (s)', observed_time],
+                ['Retune dead time (s)', self.retune_time],
+                ['Missed time (s)', missed_time],
+                ['Reads with sample loss', self.sample_loss_count],
+                ['Processing and other time (s)', other_time],
+                ['Duty cycle (%)', 100 * observed_time / elapsed_time if elapsed_time > 0 else 0.0]]
+
+    def channel_rows(self, dwell_count, center_freq, filter_bandwidth):
+        """Rows of the DutyCycle file : one row per channel"""
+        rows = [['Channel', 'Center freq (MHz)', 'Dwells', 'Visits', 'Observed time (s)',
+                 'Mean revisit interval (ms)', 'Max revisit interval (ms)']]
+        for channel in range(self.channel_number):
+            revisits = self.visit_count[channel] - 1
+            rows.append([channel, (center_freq + channel*filter_bandwidth)/1e6, int(dwell_count[channel]),
+                         int(self.visit_count[channel]), self.observed_samples[channel] / self.fs,
+                         self.revisit_sum_ns[channel] * 1e-6 / revisits if revisits > 0 else '',
+                         self.revisit_max_ns[channel] * 1e-6 if revisits > 0 else ''])
+        return rows
+
+    def write(self, path, dwell_count, center_freq, filter_bandwidth):
+        """Write the per-channel table to the csv file <path>"""
+        with open(path, 'w', newline='') as out:
+            csv.writer(out).writerows(self.channel_rows(dwell_count, center_freq, filter_bandwidth))
+
+
+class ChannelStats:
+    """Running occupancy and power statistics per channel, in O(channels) memory. The mean and variance of the power
+    (dBm) are merged dwell by dwell with the parallel form of Welford's algorithm"""
+
+    def __init__(self, channel_number, threshold, noise_floor=None):
+        self.channel_number = channel_number
+        # Threshold (mW) of the occupancy per channel, and the noise floor (dBm) per channel of the adaptive threshold
+        # (None if not used). Both arrays are shared with the detection
+        self.threshold = threshold
+        self.noise_floor = noise_floor
+        self.observed = np.zeros(channel_number, dtype=np.int64)
+        self.over_threshold = np.zeros(channel_number, dtype=np.int64)
+        self.mean = np.zeros(channel_number)
+        self.m2 = np.zeros(channel_number)
+        self.min = np.full(channel_number, np.inf)
+        self.max = np.full(channel_number, -np.inf)
+        self.lock = threading.Lock()
+
+    def record(self, channels, power):
+        """Add the avg power (mW) of the buffers of one dwell, as an array (buffers, channels) for the channel indices <channels>"""
+        power_db = 10 * np.log10(power)
+        n_b = power.shape[0]
+        mean_b = power_db.mean(axis=0)
+        m2_b = ((power_db - mean_b)**2).sum(axis=0)
+        over_b = np.count_nonzero(power >= self.threshold[channels], axis=0)
+        with self.lock:
+            n_a = self.observed[channels]
+            n = n_a + n_b
+            delta = mean_b - self.mean[channels]
+            self.mean[channels] = self.mean[channels] + delta * n_b / n
+            self.m2[channels] = self.m2[channels] + m2_b + delta**2 * n_a * n_b / n
+            self.observed[channels] = n
+            self.over_threshold[channels] = self.over_threshold[channels] + over_b
+            self.min[channels] = np.minimum(self.min[channels], power_db.min(axis=0))
+            self.max[channels] = np.maximum(self.max[channels], power_db.max(axis=0))
+
+    def summary_rows(self, center_freq, filter_bandwidth):
+        """Rows of the Stats file : one row per channel"""
+        rows = [['Channel', 'Center freq (MHz)', 'Buffers observed', 'Buffers over threshold', 'Occupancy (%)',
+                 'Mean power (dBm)', 'Std power (dB)', 'Min power (dBm)', 'Max power (dBm)', 'Threshold (dBm)']]
+        if self.noise_floor is not None:
+            rows[0].append('Noise floor (dBm)')
+        with self.lock:
+            for channel in range(self.channel_number):
+                observed = int(self.observed[channel])
+                if observed == 0:
+                    row = [channel, (center_freq + channel*filter_bandwidth)/1e6, 0, 0, '', '', '', '', '']
+                else:
+                    row = [channel, (center_freq + channel*filter_bandwidth)/1e6, observed,
+                           int(self.over_threshold[channel]), 100 * self.over_threshold[channel] / observed,
+                           self.mean[channel], math.sqrt(self.m2[channel] / observed),
+                           self.min[channel], self.max[channel]]
+                row.append(10 * math.log10(self.threshold[channel]))
+                if self.noise_floor is not None:
+                    row.append(self.noise_floor[channel] if not np.isnan(self.noise_floor[channel]) else '')
+                rows.append(row)
+        return rows
+
+    def write(self, path, center_freq, filter_bandwidth):
+        """Write the statistics to the csv file <path>. The file is replaced at once, so it is complete at any moment"""
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', newline='') as out:
+            csv.writer(out).writerows(self.summary_rows(center_freq, filter_bandwidth))
+        os.replace(temp_path, path)
+
+
+class PowerHistogram:
+    """Per-channel histogram of the power (dBm) in bins of <resolution> dB from <min_db> to <max_db>, and the float64
+    sum of the power (mW) for the average. The int32 counts take channels x 2300 x 4 bytes with the default bins
+    (5.5 MB for 600 channels), so the memory scales with the channel count, not with the acquire time. A channel
+    holds up to 2^31 buffers"""
+
+    def __init__(self, channel_number, min_db=-200.0, max_db=30.0, resolution=0.1):
+        self.channel_number = channel_number
+        self.min_db = min_db
+        self.resolution = resolution
+        self.bin_count = int(math.ceil((max_db - min_db) / resolution))
+        self.counts = np.zeros((channel_number, self.bin_count), dtype=np.int32)
+        self.power_sum = np.zeros(channel_number)
+
+    def record(self, channels, power):
+        """Add the avg power (mW) of buffers, as an array (buffers, channels) for the channel indices <channels>"""
+        index = ((10 * np.log10(power) - self.min_db) / self.resolution).astype(np.int64)
+        np.clip(index, 0, self.bin_count - 1, out=index)
+        index = index + np.arange(power.shape[1])[None, :] * self.bin_count
+        self.counts[channels] += np.bincount(index.ravel(), minlength=power.shape[1]*self.bin_count).reshape(power.shape[1], -1)
+        self.power_sum[channels] = self.power_sum[channels] + power.sum(axis=0, dtype=np.float64)
+
+    def average(self):
+        """Avg power (dBm) of each channel"""
+        return 10 * np.log10(self.power_sum / np.maximum(self.counts.sum(axis=1, dtype=np.int64), 1))
+
+    def percentile(self, q):
+        """q-th percentile of the power (dBm) of each channel, at the center of the bin containing it"""
+        cumulative = np.cumsum(self.counts, axis=1, dtype=np.int64)
+        rank = q/100 * cumulative[:, -1:]
+        index = np.minimum((cumulative < np.maximum(rank, 1)).sum(axis=1), self.bin_count - 1)
+        return self.min_db + (index + 0.5) * self.resolution
@@ -11,6 +11,8 @@ Input : configuration json file(optional)
 Output : 
     <output_filename>.csv : Event list that captures the events in the specified channels
     Metadata-<output_filename>.csv : Metadata of the Capturing. 
+    Stats-<output_filename>.csv : Per-channel occupancy and power statistics, updated during the capturing
+    DutyCycle-<output_filename>.csv : Per-channel dwells, visits, observed time and revisit intervals
     (Optional) <config_name>.json : The configuration of this capturing. This will be output only if -w/--writeconfig is called
     
 
@@ -54,71 +56,197 @@ import csv
 # Import modules relate to processing
 import numpy as np
 import math
-import random
 
 # Timer module
 import time
 
+# Acquisition/processing pipeline
+import threading
+import queue
+
+# Event output
+from event_sink import CsvEventSink, BinaryEventSink, EVENT_DTYPE, BURST_DTYPE
+from burst_builder import BurstBuilder
+
+# Adaptive per-channel thresholds
+from noise_floor import NoiseFloorTracker
+
+# Hop strategies of the sweep options
+from hop_strategy import HOP_STRATEGIES, ChannelHistory, make_strategy, deadline_utilization
+
+# Zero-copy IQ reads into preallocated buffers
+from bb_iq_into import aligned_empty
+
+# Raw IQ recording
+from iq_recorder import IqRecorder
+
+# Power of every buffer, for the offline thresholding
+from power_log import PowerLog
+
+# Statistics of the capturing
+from capture_stats import PhaseProfiler, DutyCycleAccount, ChannelStats, PowerHistogram
+
+# Wideband capture split into sub-channels
+from channelizer import FftChannelizer
+
 #### Manual setting variables #################################################
 
 # Set the bb API directory to python search path and import the package
 # https://stackoverflow.com/questions/59014318/filenotfounderror-could-not-find-module-libvlc-dll?fbclid=IwAR25hyP3R1sDf94Sk8aprcxGgEFuaZqz-Z-tV5MfZlNVDIJqNMbpfSUre2w
 # DLL dependencies for extension modules and DLLs loaded with ctypes on Windows 
 # are now resolved more securely after python 3.8.
+# The DLL directory is only added when the BB60C device is used (see --device)
 API_directory=r'C:\Users\jng22\Downloads\Jing\BB60C\software-relate\signal_hound_sdk_01_12_22\signal_hound_sdk\device_apis\bb_series\win\examples\python\bbdevice'
-os.add_dll_directory(API_directory)
 
-# The amount of inaccurate iq data discarded on each configuration due to the filter ramp up time
+# The amount of inaccurate iq data discarded on each configuration due to the filter ramp up time.
+# Used if the current decimation/bandwidth is not in the settling table calibrated by --calibrate
 garbage_size = 2048
 
+# Size (samples) of the chunks read by --acquire, rounded down to whole buffers. The memory of the acquire stays bounded by the chunk whatever the acquire time and sample rate
+acquire_chunk_size = 262144
+
+# Settling calibration (--calibrate) : samples read right after bb_initiate, window (samples) of the power settling curve and tolerance (dB) to the steady state power
+settling_probe_size = 16384
+settling_window = 32
+settling_tolerance = 1.0
+
+# Weight of each dwell in the exponential moving average of the adaptive noise floor (--adaptive)
+noise_floor_alpha = 0.1
+
 # The occupancy threshold that create probability to keep capturing in the same frequency
 occupancy_threshold = 0.3
 
 # The probability to stay capturing in the same frequency if occupancy rate is over the threshold
 p_samefreq = 0.7
 
+# Probability of the bandit option to hop to a uniformly random channel instead of the Thompson sampling choice
+bandit_exploration = 0.1
+
+# Decay per dwell of the busy/idle buffer counts of the bandit option, so it follows the changes of activity
+bandit_discount = 0.99
+
+# Fraction of the max revisit interval kept as margin by the deadline option against the jitter of the dwell and retune times
+revisit_margin = 0.05
+
 ###############################################################################
-from bbdevice.bb_api import *
+
+# Settings of the capturing, written to the Metadata file
+def settings_rows() :
+    return [['Sampling Rate (M/s)', fs/1e6],
+            ['Sweep option', args.option],
+            ['Min Center frequency (MHz)', center_freq/1e6],
+            ['Max Center frequency (MHz)', center_freq/1e6 + (channel_number-1)*filter_bandwidth/1e6],
+            ['Filter Bandwidth (MHz)', filter_bandwidth/1e6],
+            ['Total channels sweeping during capturing', channel_number],
+            ['Channelizer', args.channelizer],
+            ['Capture bandwidth (MHz)', capture_bandwidth/1e6],
+            ['Sub-channels per tune', subchannel_number],
+            ['Tunes sweeping during capturing', tune_number],
+            ['Threshold (dBm)', args.threshold],
+            ['Channels with acquired threshold (10th percentile + offset)', table_channel_count],
+            ['Adaptive threshold (noise floor + offset)', args.adaptive],
+            ['Reference level (dBm)', ref_level],
+            ['IQ data type', '16-bit complex short' if args.iq16 else '32-bit complex float']]
+
+# All the rows of the Metadata file
+def metadata_rows(collection_duration) :
+    # Throughput of the capturing
+    elapsed_time = time.perf_counter() - measure_start_time
+    buffer_count = dwell_count*num_captures_samefreq
+
+    rows = settings_rows()
+    rows.append(['Total collection duration (min)', collection_duration])
+    rows.append(['Buffer duration/min event size (us))', args.bufferduration])
+    rows.append(['Frequency dwell time (ms)', args.fcduration])
+    if args.adaptive :
+        rows.append(['Adaptive threshold offset (dB)', args.offset])
+    rows.append(['Coalesced burst events', args.coalesce])
+    if args.coalesce :
+        rows.append(['Hysteresis (dB)', args.hysteresis])
+        rows.append(['Gap tolerance (us)', args.gap])
+    if window_size is not None :
+        rows.append(['Window size/min event size (samples)', window_size])
+        rows.append(['Window step (samples)', window_step])
+    rows.append(['Flush size after retune (samples)', flush_size])
+    rows.append(['Batched dwell acquisition', batched_read])
+    rows.append(['Processing threads', args.threads])
+    if args.threads > 0 :
+        rows.append(['Ring size (dwells)', ring_size])
+        rows.append(['Max queue depth', max_queue_depth])
+        rows.append(['Mean queue depth', sum_queue_depth/max(dwell_count, 1)])
+        rows.append(['Ring overflows', ring_overflow_count])
+    rows.append(['Event format', args.format])
+    rows.append(['Device', args.device])
+    if args.serial is not None :
+        rows.append(['Device serial', args.serial])
+    if args.device == 'replay' :
+        rows.append(['Replayed IQ recording', args.replay])
+    if recorder is not None :
+        rows.append(['IQ recording', recorder.path])
+        rows.append(['Recorded samples', recorder.sample_count])
+    if power_log is not None :
+        rows.append(['Power log', power_log.path])
+        rows.append(['Power log records', power_log.count])
+    rows.append(['Buffers processed', buffer_count])
+    rows.append(['Throughput (buffers/s)', buffer_count/elapsed_time])
+    rows.append(['Events', event_sink.count])
+    rows.append(['Events (events/s)', event_sink.count/elapsed_time])
+    rows.append(['Hops', hop_count])
+    rows.append(['Dead time per hop (ms)', hop_dead_time*1e3/max(hop_count, 1)])
+    # Detection efficiency of the sweep option : events per second of observation and per hop
+    observed_time = duty_cycle.device_samples/fs
+    rows.append(['Detection efficiency (events/s observed)', event_sink.count/observed_time if observed_time > 0 else 0.0])
+    rows.append(['Events per hop', event_sink.count/max(hop_count, 1)])
+    if tune_revisit is not None :
+        rows.append(['Max revisit interval (ms)', args.revisit])
+        rows.append(['Revisit deadline utilization (%)', 100*deadline_utilization(tune_revisit, history.dwell_time or fcduration, history.retune_time or 0.0)])
+        rows.append(['Tunes over the max revisit interval', int(np.sum(history.max_unobserved > tune_revisit))])
+        rows.append(['Max unobserved time over the max revisit interval (ms)', max(float(np.max(history.max_unobserved - tune_revisit)), 0.0)*1e3])
+    rows.append(['Comments', args.comment[0]])
+    rows.extend(duty_cycle.summary_rows(elapsed_time))
+    rows.append(['Duty cycle table', os.path.basename(duty_cycle_path)])
+    if profiler is not None :
+        rows.extend(profiler.summary_rows())
+    return rows
+
+# Flush the remaining events to the output event file and write the metadata to Metadata-<output_filename>.csv in the current folder
+def write_output(collection_duration) :
+    # Write the bursts still open at the end of the capturing
+    if burst_builder is not None :
+        burst_builder.close_all()
+    metadata = metadata_rows(collection_duration)
+
+    # Write the final per-channel statistics and duty cycle, and the Metadata file first, so they are kept even if closing an output file fails
+    channel_stats.write(stats_path, center_freq, filter_bandwidth)
+    duty_cycle.write(duty_cycle_path, history.dwell_count[channel_tune], center_freq, filter_bandwidth)
+    with open(os.path.join(os.getcwd(), "Metadata-" + output_filename + '.csv'),'w', newline='') as out:
+        csv_output = csv.writer(out)
+        csv_output.writerows(metadata)
+
+    # Flush the remaining events of the event sink and close the IQ recording and the power log. Their header keeps the final metadata. All of them are closed even if one fails
+    print("Write capture event to the output {} <{}> file".format(args.format, output_filename))
+    close_error = None
+    for output in [event_sink, recorder, power_log] :
+        if output is None :
+            continue
+        try :
+            output.close(metadata)
+        except (OSError, ValueError) as e :
+            print("Fail to close <{}> : {}".format(output.path, e))
+            close_error = close_error or e
+    if close_error is not None :
+        raise close_error
+
+# Set by customized_exit when Ctrl+C is called. The capture engine stops after the current dwell and runs the normal teardown
+interrupt_requested = False
 
 # This is the exception handler when Ctrl+C is called to interrupt the program while capturing data using BB60C. The purpose is to appropriately close the BB60C device so an error would not occur if the program is called again
+# The handler runs on the main thread, possibly inside a locked write of the event sink or the statistics, so it only sets the stop flag. The device is closed and the output is written by the teardown after the capture engine
 def customized_exit(signum, frame) :
-    # The following line is to restore the original SIGINT handler. Though it's useless in this example, it's a good practice to change the customized handler back if the customized one is no longer used.
+    global interrupt_requested
+    # The following line is to restore the original SIGINT handler, so a second Ctrl+C raises KeyboardInterrupt if the teardown hangs
     signal.signal(signal.SIGINT, signal.default_int_handler)
-    print("Program is interrupted by Ctrl+C. Close BB60C and exit the program")
-    bb_close_device(handle)
-    
-    # Write event to csv file
-    print("Write capture event to the output csv <{}> file".format(output_filename))
-    output_path = os. getcwd() + '\\'
-    # For Windows
-    with open(output_path + output_filename + '.csv','w', newline='') as out:
-    # for linux : with open(output_path + output_file,'w') as out:
-        csv_output = csv.writer(out)
-        csv_output.writerow(['Event start time','Time in Nano second', 'Center Freq (Hz)', 'Avg Power (dBm)'])
-        csv_output.writerows(event_list)
-        #for row in data:
-        #    csv_out.writerow(row)    
-
-    # Write Metadata file
-    # For Windows
-    with open(output_path + "Metadata-" + output_filename + '.csv','w', newline='') as out:
-    # for linux : with open(output_path + output_file,'w') as out:
-        csv_output = csv.writer(out)
-        csv_output.writerow(['Sampling Rate (M/s)', fs/1e6])
-        csv_output.writerow(['Sweep option', args.option])
-        csv_output.writerow(['Min Center frequency (MHz)', center_freq/1e6])
-        csv_output.writerow(['Max Center frequency (MHz)', center_freq/1e6 + (channel_number-1)*filter_bandwidth/1e6])
-        csv_output.writerow(['Filter Bandwidth (MHz)', filter_bandwidth/1e6])
-        csv_output.writerow(['Total channels sweeping during capturing', channel_number])
-    #    csv_output.writerow(['Center frequency (Hz)', center_freq])
-        csv_output.writerow(['Threshold (dBm)', args.threshold])
-        csv_output.writerow(['Reference level (dBm)', ref_level])
-        collection_time_interrupt = (time.perf_counter() - measure_start_time)/60
-        csv_output.writerow(['Total collection duration (min)', collection_time_interrupt])
-        csv_output.writerow(['Buffer duration/min event size (us))', args.bufferduration])
-        csv_output.writerow(['Frequency dwell time (ms)', args.fcduration])
-        csv_output.writerow(['Comments', args.comment[0]])
-    sys.exit()
+    interrupt_requested = True
 
 
 #%%  Parse the input argument
@@ -160,6 +288,30 @@ def positive_int(in_var):
         raise argparse.ArgumentTypeError("%r not positive"%(in_var))
     return in_var
 
+# Key of the settling table (calibrated flush size) for the setting <decimation> and <bandwidth> (Hz)
+def settling_key(decimation, bandwidth) :
+    return '{}:{}'.format(decimation, int(bandwidth))
+
+# Find the minimal safe flush size from the power settling curve (dB, one value per <settling_window> samples) after bb_initiate.
+# The curve is settled at the first window after which every window stays within <settling_tolerance> dB (plus 3 times the
+# robust spread of the noise) of the steady state power, taken as the median of the second half of the curve
+def settled_flush_size(curve_db) :
+    steady_curve_db = curve_db[len(curve_db)//2:]
+    steady_db = np.median(steady_curve_db)
+    spread_db = 1.4826 * np.median(np.abs(steady_curve_db - steady_db))
+    unsettled = np.flatnonzero(np.abs(curve_db - steady_db) > settling_tolerance + 3*spread_db)
+    if len(unsettled) == 0 :
+        return settling_window
+    if unsettled[-1] >= len(curve_db)//2 :
+        # Not settled within the probe, keep the default flush size
+        return garbage_size
+    # One more window as safety margin
+    return int((unsettled[-1] + 2) * settling_window)
+
+# Key of the per-channel threshold table for the channel center frequency <channel_freq> (Hz)
+def channel_key(channel_freq) :
+    return '{:g}'.format(round(channel_freq/1e6, 6))
+
 # Check if the -w, --writeconfig option is called
 def check_w_option(args, termination) :
     if args.writeconfig is not None:
@@ -181,7 +333,10 @@ def check_w_option(args, termination) :
             conf_var["bufferduration"] = args.bufferduration
             conf_var["fcduration"] = args.fcduration
             conf_var["option"] = args.option
+            conf_var["revisit"] = args.revisit
             conf_var["offset"] = args.offset
+            conf_var["settling_table"] = args.settling_table
+            conf_var["channel_thresholds"] = args.channel_thresholds
         
         format_json = json.dumps(conf_var, indent=4)
         # Writing to <output_configname>.json
@@ -247,7 +402,7 @@ my_parser.add_argument('-d', '--decimation',
                       
 my_parser.add_argument('-t', '--duration',
                        metavar='<Collection_duration>',
-                       type=positive_int,
+                       type=positive_float,
                        help='Collection duration (min). Default to ?? min.')
 
 my_parser.add_argument('-b', '--bufferduration',
@@ -264,7 +419,7 @@ my_parser.add_argument('--acquire',
                        metavar='<acquire_time>',
                        nargs='*',
                        type=positive_int,
-                       help='The acquire time for the threshold for the noise floor (sec). Default to 5s. If --acquire option is called, it will capture and average the IQ data in <acquire_time> and then set the acquire_threshold in default_conf.json file')
+                       help='The acquire time for the threshold for the noise floor (sec). Default to 5s. If --acquire option is called, it will capture every channel of the span for a share of <acquire_time>, measure the avg and percentile power of each channel, and write the per-channel threshold table (10th percentile power + threshold_offset) to the channel_thresholds of the configuration file (-w)')
 
 # my_parser.add_argument('-r', '--reset',
 #                        action='store_true',    
@@ -274,6 +429,12 @@ my_parser.add_argument('--acquire',
 #                        action='store_true',    
 #                        help='If --meta option is called, it will also output the Metadata file along with the event list file')
 
+my_parser.add_argument('--calibrate',
+                       metavar='<retunes>',
+                       nargs='*',
+                       type=positive_int,
+                       help='Calibrate the filter ramp up settling after bb_initiate for every decimation (with its max filter bandwidth) using <retunes> retunes per setting. Default to 10. The minimal safe flush size per setting is written to the settling_table of the configuration file (-w), and used instead of the fixed 2048 samples flush by the capturing')
+
 my_parser.add_argument('-w', '--writeconfig',
                        metavar='<config_filename>',
                        nargs='*',
@@ -283,14 +444,24 @@ my_parser.add_argument('-w', '--writeconfig',
 my_parser.add_argument('--offset',
                        metavar='<threshold_offset>',
                        type=positive_float,
-                       help='The offset added on the acquired noise floor (dBm). This is only effective if the --acquire option is called. The threshold value written to the configuration file will be (acquired_noise_floor + threshold_offset). Default to 10dBm.')
+                       help='The offset added on the acquired noise floor (dBm). This is only effective if the --acquire or --adaptive option is called. The threshold value written to the configuration file will be (acquired_noise_floor + threshold_offset). Default to 10dBm.')
+
+my_parser.add_argument('--adaptive',
+                       action='store_true',
+                       help='Track the noise floor of each channel online from its buffers under the threshold, and use (noise floor + <threshold_offset>) as the threshold of the channel. <Threshold> is only used until the first dwell of each channel')
 
 my_parser.add_argument('--option',
                        metavar='<Sweep_option>',
                        type=str,
-                       choices=['fixed', 'sweep', 'rand-sweep','hop-with-p', 'hop-ifnot-busy'],
+                       choices=list(HOP_STRATEGIES),
                        help='Sweep options for frequency hopping. Default to sweep')
 
+my_parser.add_argument('--revisit',
+                       metavar='<max_revisit_interval>',
+                       type=positive_float,
+                       nargs='+',
+                       help='Max time (ms) a channel may go unobserved between two visits, for --option deadline : one value for all the channels, or one value per channel of the span. The hop order is computed online, earliest deadline first, with the measured retune and dwell times')
+
 my_parser.add_argument('--comment',
                        metavar='"<your comments>"',
                        type=str,
@@ -298,12 +469,127 @@ my_parser.add_argument('--comment',
                        default=[""],
                        help='This option helps writing comments with content "<your comments>" to output Metadata file. Remember to add the double quote ("") to your comments. ')
 
+my_parser.add_argument('--batched',
+                       action='store_true',
+                       help='Read the whole dwell (<Fc_dwelltime>) with one IQ read and process all buffers in one NumPy pass, instead of one read per buffer. This reduces the per-call overhead with small <Buffer_duration>')
+
+my_parser.add_argument('--channelizer',
+                       action='store_true',
+                       help='Capture the max bandwidth of the decimation on each tune and split it with an FFT channelizer into sub-channels of <filter_bandwidth>, thresholded at the same time. A span is covered with fewer retunes, e.g. -d 1 -fb 3.75 observes 7 channels per tune. The dwell is always processed as a whole (see --batched)')
+
+my_parser.add_argument('--window',
+                       metavar='<window_duration>',
+                       type=positive_float,
+                       help='Detect the events with the power of sliding windows of <window_duration> (us) inside each buffer, computed with the cumulative sum of |iq|^2, instead of the avg power of the whole buffer. The event start time is accurate to the sample and the min event size is no longer tied to <Buffer_duration>, so larger buffers can be read. The dwell is always processed as a whole (see --batched). Default is one window per buffer')
+
+my_parser.add_argument('--windowstep',
+                       metavar='<window_step>',
+                       type=positive_float,
+                       help='Step (us) between two consecutive windows of --window. Default to <window_duration> (adjacent windows)')
+
+my_parser.add_argument('--coalesce',
+                       action='store_true',
+                       help='Coalesce the consecutive buffers (or windows) over the threshold of each channel into one burst event with start/end time, duration, mean/peak power and buffer count, instead of one event per buffer. The dwell is always processed as a whole (see --batched)')
+
+my_parser.add_argument('--hysteresis',
+                       metavar='<hysteresis>',
+                       type=positive_float,
+                       default=0.0,
+                       help='With --coalesce, a burst continues while the power stays over (<Threshold> - <hysteresis>) dB. Default to 0 dB')
+
+my_parser.add_argument('--gap',
+                       metavar='<gap_tolerance>',
+                       type=positive_float,
+                       default=0.0,
+                       help='With --coalesce, gaps (us) under the threshold up to <gap_tolerance> are bridged inside a burst. Default to 0 us')
+
+my_parser.add_argument('--statstime',
+                       metavar='<stats_time>',
+                       type=positive_float,
+                       default=60.0,
+                       help='Period (s) of the update of the per-channel occupancy and power statistics file Stats-<output_filename>.csv. The file is also written at the end of the capturing. Default to 60s')
+
+my_parser.add_argument('--iq16',
+                       action='store_true',
+                       help='Stream the IQ as 16-bit complex shorts instead of 32-bit complex floats. The power is computed on the int16 (I, Q) pairs and the full-scale correction of the BB60C (bb_get_IQ_correction) is applied once per buffer. This halves the bytes moved per sample, useful at decimation 1 and 2. The --channelizer still converts the IQ to complex floats')
+
+my_parser.add_argument('--threads',
+                       metavar='<processing_threads>',
+                       type=positive_int,
+                       default=0,
+                       help='Number of processing threads. If > 0, the main thread only drains the BB60C into a ring of IQ blocks and the processing threads run the power/threshold stage. Default to 0 (process between device reads)')
+
+my_parser.add_argument('--ringsize',
+                       metavar='<ring_size>',
+                       type=positive_int,
+                       default=8,
+                       help='Number of dwell IQ blocks preallocated in the ring when --threads is used. Default to 8')
+
+my_parser.add_argument('--flushsize',
+                       metavar='<events>',
+                       type=positive_int,
+                       default=10000,
+                       help='The events are appended to the output file in batches of <events>. Default to 10000')
+
+my_parser.add_argument('--flushtime',
+                       metavar='<flush_time>',
+                       type=positive_float,
+                       default=5.0,
+                       help='Max time (s) between two flushes of the events to the output file. Each of these flushes is also a fsync checkpoint. Default to 5s')
+
+my_parser.add_argument('--format',
+                       metavar='<event_format>',
+                       type=str,
+                       choices=['csv', 'bin'],
+                       default='csv',
+                       help='Format of the output event file. "bin" writes <output_filename>.bin with compact binary records (int64 epoch ns, uint16 channel index, float32 power) that can be memory-mapped, and keeps the metadata in its header. Use events-to-csv.py to convert it to csv. Default to csv')
+
+my_parser.add_argument('--profile',
+                       metavar='<breakdown>',
+                       type=str,
+                       nargs='?',
+                       const='total',
+                       choices=['total', 'frequency', 'decimation'],
+                       help='Profile the latency of each capturing phase (bb_configure_IQ_center, bb_initiate, garbage flush and capture read) and write the p50/p95/p99/max summary to the Metadata file. Optionally broken down by frequency or decimation. Default breakdown to total')
+
+my_parser.add_argument('--device',
+                       metavar='<device>',
+                       type=str,
+                       choices=['bb60c', 'sim', 'replay'],
+                       default='bb60c',
+                       help='Device used for the capturing. "sim" uses the software BB60C stand-in (bb_sim.py) so the script can run and be benchmarked without hardware. "replay" replays the IQ recording of --replay (bb_replay.py) faster than real time, until its end. Default to bb60c')
+
+my_parser.add_argument('--serial',
+                       metavar='<serial_number>',
+                       type=int,
+                       help='Serial number of the BB60C to open, when several devices are connected (see multi-capture.py). Default to the first device found')
+
+my_parser.add_argument('--simconf',
+                       metavar='<sim_configuration_file>',
+                       type=str,
+                       help='Simulation configuration json file (noise floor, emitters, retune delay) for --device sim. See bb_sim.py for the format')
+
+my_parser.add_argument('--record',
+                       action='store_true',
+                       help='Record the raw IQ of every read to <output_filename>.iq, with the retune markers in <output_filename>.iqm, so the detection can be re-run offline with --device replay. The recording takes 8 bytes per sample (4 with --iq16), e.g. 40 MB/s at decimation 8')
+
+my_parser.add_argument('--powerlog',
+                       action='store_true',
+                       help='Log the avg power of every buffer (or window), over the threshold or not, to <output_filename>.pwr (6 bytes per buffer and channel, e.g. 120 kB/s at 20k buffers/s) with the dwell timestamps in <output_filename>.pwrm. Use power-log-threshold.py to re-apply other thresholds offline')
+
+my_parser.add_argument('--replay',
+                       metavar='<iq_recording>',
+                       type=str,
+                       help='IQ recording (<output_filename>.iq of --record) replayed by --device replay. The replay needs the same -f, -s, -fb, -d and --channelizer as the recorded capturing. See replay-sweep.py to sweep the detection parameters over a recording')
+
 # Execute the parse_args() method
 args = my_parser.parse_args()
 
 
     
 #### Load from configuration and argparse #####################################
+# The configuration files written before the --calibrate and --acquire per-channel table options have no settling table or channel thresholds
+my_parser.set_defaults(settling_table={}, channel_thresholds={})
 # Check if a configuration file is specified, if not, default configuration file will be loaded
 if args.conf is not None:
     with open(args.conf[0], 'r') as f:
@@ -348,9 +634,56 @@ if args.span != -1:
 else:
     # non sweeping mode
     channel_number = 1
-if channel_number == 1 :
+
+# Channelizer mode : the BB60C captures the max bandwidth of the decimation and each tune covers <subchannel_number> adjacent channels
+if args.channelizer:
+    capture_bandwidth = MAX_BW_TABLE[args.decimation]
+    subchannel_number = min(max(int(capture_bandwidth // filter_bandwidth), 1), channel_number)
+else:
+    capture_bandwidth = filter_bandwidth
+    subchannel_number = 1
+# The hop strategies operate over the tunes. Without the channelizer, a tune is one channel
+tune_number = math.ceil(channel_number/subchannel_number)
+if tune_number == 1 :
     args.option = 'fixed'
 
+# Channels of each tune, IQ center frequency (Hz) of each tune (the center of its channels) and tune of each channel
+tune_channels = [np.arange(t*subchannel_number, min((t+1)*subchannel_number, channel_number)) for t in range(tune_number)]
+tune_center_freq = [args.frequency*1.0e6 + (t*subchannel_number + (subchannel_number-1)/2)*filter_bandwidth for t in range(tune_number)]
+channel_tune = np.arange(channel_number)//subchannel_number
+
+# Max revisit interval (s) of each tune for the deadline option : the smallest of its channels
+if args.option == 'deadline' :
+    if args.revisit is None :
+        sys.exit("--option deadline needs the max revisit interval (--revisit)")
+    if len(args.revisit) not in (1, channel_number) :
+        sys.exit("--revisit needs one value, or one value per channel ({} channels)".format(channel_number))
+    channel_revisit = np.broadcast_to(np.array(args.revisit)*1e-3, (channel_number,))
+    tune_revisit = np.array([channel_revisit[channels].min() for channels in tune_channels])
+else :
+    tune_revisit = None
+
+
+#### Select the device #######################################################
+if args.device == 'sim':
+    from bb_sim import *
+    if args.simconf is not None:
+        with open(args.simconf, 'r') as f:
+            sim_configure(**json.load(f))
+elif args.device == 'replay':
+    from bb_replay import *
+    if args.replay is None:
+        sys.exit("--device replay needs the IQ recording to replay (--replay)")
+    replay_configure(recording=args.replay)
+else:
+    os.add_dll_directory(API_directory)
+    from bbdevice.bb_api import *
+    # The capture loop reads the IQ with bbGetIQ straight into its preallocated buffers
+    from bb_iq_into import load_bb_library, bb_get_IQ_into
+    # 16-bit IQ (--iq16)
+    from bb_iq_into import bb_configure_IQ_data_type, bb_get_IQ_correction, BB_DATA_TYPE_32FC, BB_DATA_TYPE_16SC
+    load_bb_library(os.path.join(API_directory, 'bb_api.dll'))
+
 
 #### Variables summary ########################################################
 # output file name : output_filename
@@ -366,6 +699,9 @@ center_freq = args.frequency*1.0e6;
 # args.threshold (dBm) & mW_threshold (mW). 
 mW_threshold = 10 ** (args.threshold/10);
 
+# Threshold (mW) of each channel. Equal to mW_threshold, or updated by the noise floor tracker with --adaptive
+channel_threshold = np.full(channel_number, mW_threshold)
+
 # The bandwidth set for IQ capturing in one center freq : filter_bandwidth (Hz)
 # Total span set : args.span(MHz)
 
@@ -389,6 +725,77 @@ num_captures_samefreq = round(fcduration/bufferduration)
 # buffer size per iq capture
 buffer_size = math.ceil(fs*bufferduration)
 
+# FFT channelizer of the channelizer mode, None if not used. The buffer size is rounded up to whole FFT frames
+if args.channelizer:
+    channelizer = FftChannelizer(fs, filter_bandwidth, subchannel_number)
+    buffer_size = math.ceil(buffer_size/channelizer.nfft)*channelizer.nfft
+else:
+    channelizer = None
+
+# Sliding window detection (--window) : window size and step (samples) inside each buffer, None if not used
+if args.window is not None:
+    if channelizer is not None:
+        sys.exit("--window can not be used with --channelizer")
+    window_size = max(round(fs*args.window*1e-6), 1)
+    window_step = max(round(fs*args.windowstep*1e-6), 1) if args.windowstep is not None else window_size
+    if window_size > buffer_size:
+        sys.exit("window duration longer than the buffer duration")
+    # First sample of each window in a buffer
+    window_start = np.arange(0, buffer_size - window_size + 1, window_step)
+else:
+    window_size = None
+
+# IQ data type of the device (--iq16). The power (mW) of the 16-bit IQ is (I^2 + Q^2) * iq_power_scale[tune], with the
+# scale (correction/32768)^2 read after each bb_initiate of the tune. The scale stays 1 with the 32-bit IQ
+iq_data_type = BB_DATA_TYPE_16SC if args.iq16 else BB_DATA_TYPE_32FC
+iq_correction = np.ones(tune_number)
+iq_power_scale = np.ones(tune_number)
+
+# Preallocated, page-aligned IQ array of <shape> samples : complex64, or int16 (I, Q) pairs (last axis of 2) with --iq16
+def aligned_iq(*shape) :
+    if args.iq16 :
+        return aligned_empty(shape + (2,), np.int16)
+    return aligned_empty(shape)
+
+# View of the IQ array <iq> as (I, Q) values reshaped to <shape> : the float32 pairs of the complex64 IQ or the int16 pairs
+def iq_values(iq, *shape) :
+    if args.iq16 :
+        return iq.reshape(shape)
+    return iq.view(np.float32).reshape(shape)
+
+# Complex64 IQ of the IQ array <iq> for the channelizer, converted from the int16 pairs with --iq16 (without the correction)
+def iq_complex(iq) :
+    if args.iq16 :
+        return iq.astype(np.float32).view(np.complex64)
+    return iq
+
+# Open the device of --serial, or the first device found. Return the handle
+def open_device() :
+    if args.serial is not None :
+        return bb_open_device_by_serial(args.serial)["handle"]
+    return bb_open_device()["handle"]
+
+# Select the IQ data type of the device, before bb_configure_IQ
+def configure_iq_data_type() :
+    if args.iq16 :
+        bb_configure_IQ_data_type(handle, iq_data_type)
+
+# Read the correction of the 16-bit IQ of the tune <tune>, after bb_initiate
+def update_iq_power_scale(tune) :
+    if args.iq16 :
+        iq_correction[tune] = bb_get_IQ_correction(handle)["correction"]
+        iq_power_scale[tune] = (iq_correction[tune]/32768) ** 2
+
+# The bursts of --coalesce are built in time order, so the dwells can't be processed by concurrent threads
+if args.coalesce and args.threads > 1:
+    sys.exit("--coalesce can only be used with 0 or 1 processing thread")
+
+# Read mode of the dwell : one IQ read per dwell with --batched, and always with the channelizer, the windows and the coalescing, which process the dwell as a whole
+batched_read = args.batched or args.channelizer or args.window is not None or args.coalesce
+
+# Number of samples flushed after each retune : calibrated value of the settling table, or garbage_size if not calibrated. Used by both the acquire and the capturing
+flush_size = args.settling_table.get(settling_key(args.decimation, capture_bandwidth), garbage_size)
+
 
 #### Items check ##############################################################
 # Check if the --acquire option is called
@@ -397,53 +804,122 @@ if args.acquire is not None:
         args.acquire = [5]
     print('Value of acquired time is set to {} seconds'.format(args.acquire[0]))
     
-    print('Start acquiring average IQ power with sample rate {} Ms ...'.format(40/args.decimation))
+    print('Start acquiring IQ power of {} channels ({} tunes) with sample rate {} Ms ...'.format(channel_number, tune_number, 40/args.decimation))
     
-    # Use 0.5 second buffer size since the BB60C build-in buffer size is around 1 second amount
-    acquire_rounds = args.acquire[0]/0.5 
-    acquire_buffer_size = fs*0.5    
-    accumulate_iq_power = 0.0
+    # The acquire time is shared by the tunes, read in chunks of <acquire_buffers> buffers of buffer_size samples.
+    # The power distribution of a channel is the avg power of its buffers, kept as a histogram
+    tune_acquire_time = args.acquire[0]/tune_number
+    acquire_buffers = max(acquire_chunk_size // buffer_size, 1)
+    acquire_rounds = max(round(tune_acquire_time*fs / (acquire_buffers*buffer_size)), 1)
     
     # Open device
-    handle = bb_open_device()["handle"]
+    handle = open_device()
     # Configure device (first time)
     bb_configure_ref_level(handle, ref_level)
     bb_configure_gain_atten(handle, BB_AUTO_GAIN, BB_AUTO_ATTEN)
-    bb_configure_IQ_center(handle, center_freq)
-    bb_configure_IQ(handle, args.decimation, filter_bandwidth)
-
-    # Initialize
-    bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
-
-    # Flush IQ data filter ramp up time
-    garbage = bb_get_IQ_unpacked(handle, garbage_size, BB_TRUE)["iq"]
+    configure_iq_data_type()
+    bb_configure_IQ(handle, args.decimation, capture_bandwidth)
+
+    # IQ of the flush, IQ and avg power (mW) of the buffers of one chunk, one column per channel of the tune (reused for every chunk), and the power histogram of each channel
+    acquire_flush_iq = aligned_iq(flush_size)
+    acquire_iq = aligned_iq(acquire_buffers*buffer_size)
+    acquire_power = np.empty((acquire_buffers, subchannel_number))
+    power_histogram = PowerHistogram(channel_number)
+    for tune in range(tune_number):
+        channels = tune_channels[tune]
+        bb_configure_IQ_center(handle, tune_center_freq[tune])
+        # Initialize
+        bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
+        update_iq_power_scale(tune)
 
-    # capture <num_captures_samefreq> round in this center frequency
-    i = 0
-    while (i<acquire_rounds):
-        # Here the parameter should be set BB_FALSE
-        acquire_iq = bb_get_IQ_unpacked(handle, int(acquire_buffer_size), BB_FALSE)["iq"]
-        # Calculate the avg power using (iq * conj(iq) / total samples)
-        acquire_iq_power = np.abs(np.vdot(acquire_iq, acquire_iq) / acquire_buffer_size)
-        accumulate_iq_power = accumulate_iq_power + acquire_iq_power
-        i = i+1
+        # Flush IQ data filter ramp up time
+        bb_get_IQ_into(handle, acquire_flush_iq, BB_TRUE)
 
-    avg_iq_power = 10 * np.log10(accumulate_iq_power/acquire_rounds)
-    print("Average IQ power in {} seconds is {} dBm".format(args.acquire[0], avg_iq_power))
+        i = 0
+        while (i<acquire_rounds):
+            # Here the parameter should be set BB_FALSE
+            bb_get_IQ_into(handle, acquire_iq, BB_FALSE)
+            if channelizer is not None:
+                acquire_power[:] = channelizer.power(iq_complex(acquire_iq), acquire_buffers) * iq_power_scale[tune]
+            else:
+                # Calculate the avg power of each buffer using (sum(I^2 + Q^2) / total samples), accumulated in float64
+                iq = iq_values(acquire_iq, acquire_buffers, 2*buffer_size)
+                np.einsum('ij,ij->i', iq, iq, dtype=np.float64, out=acquire_power[:, 0])
+                acquire_power[:, 0] *= iq_power_scale[tune]/buffer_size
+            power_histogram.record(channels, acquire_power[:, :len(channels)])
+            i = i+1
     
     # Remember to delete the buffer, close the device
     bb_close_device(handle)
-    del acquire_iq
+    del acquire_iq, acquire_flush_iq
     
-    ####### NEED FURTHER CHECK
-    args.threshold = avg_iq_power + args.offset
-    print("Threshold power write to output configuration file is {} dBm".format(args.threshold))
+    # Avg and percentile power (dBm) of each channel. The 10th percentile is used as noise floor, since it ignores the emitters active less than 90% of the time
+    avg_iq_power = power_histogram.average()
+    p10_iq_power, p50_iq_power, p90_iq_power = [power_histogram.percentile(q) for q in (10, 50, 90)]
+    print("Channel, Center freq (MHz), Average (dBm), 10th percentile (dBm), Median (dBm), 90th percentile (dBm), Threshold (dBm)")
+    args.channel_thresholds = {}
+    for channel in range(channel_number):
+        channel_freq = center_freq + channel*filter_bandwidth
+        args.channel_thresholds[channel_key(channel_freq)] = float(p10_iq_power[channel]) + args.offset
+        print("{}, {}, {:.2f}, {:.2f}, {:.2f}, {:.2f}, {:.2f}".format(channel, channel_freq/1e6, avg_iq_power[channel],
+              p10_iq_power[channel], p50_iq_power[channel], p90_iq_power[channel], p10_iq_power[channel] + args.offset))
+    
+    # The global threshold is the median of the channel thresholds, used by the channels out of the table
+    args.threshold = float(np.median(p10_iq_power)) + args.offset
+    print("Threshold power write to output configuration file is {} dBm, with the per-channel threshold table".format(args.threshold))
     check_w_option(args, True)
     
 
 
+# Check if the --calibrate option is called
+if args.calibrate is not None:
+    if args.calibrate == []:
+        args.calibrate = [10]
+    print('Start calibrating the settling of the filter ramp up with {} retunes per setting ...'.format(args.calibrate[0]))
+    
+    # Open device
+    handle = open_device()
+    bb_configure_ref_level(handle, ref_level)
+    bb_configure_gain_atten(handle, BB_AUTO_GAIN, BB_AUTO_ATTEN)
+    
+    # Calibrate every decimation with its max filter bandwidth, and the specified filter bandwidth for the current decimation
+    calibrate_settings = [(d, MAX_BW_TABLE[d]) for d in MAX_BW_TABLE]
+    if capture_bandwidth != MAX_BW_TABLE[args.decimation]:
+        calibrate_settings.append((args.decimation, capture_bandwidth))
+    
+    for (calibrate_decimation, calibrate_bandwidth) in calibrate_settings:
+        bb_configure_IQ(handle, calibrate_decimation, calibrate_bandwidth)
+        # Power of each <settling_window> samples right after bb_initiate, one row per retune
+        settling_curves = np.empty((args.calibrate[0], settling_probe_size//settling_window))
+        i = 0
+        while (i<args.calibrate[0]):
+            bb_configure_IQ_center(handle, tune_center_freq[i % tune_number])
+            bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
+            probe_iq = bb_get_IQ_unpacked(handle, settling_probe_size, BB_TRUE)["iq"]
+            settling_curves[i] = np.mean(np.abs(probe_iq.reshape(-1, settling_window))**2, axis=1)
+            i = i+1
+        # The median over the retunes ignores the emitters active during some of them
+        settling_curve_db = 10 * np.log10(np.median(settling_curves, axis=0))
+        settled_size = settled_flush_size(settling_curve_db)
+        args.settling_table[settling_key(calibrate_decimation, calibrate_bandwidth)] = settled_size
+        print("Decimation {}, filter bandwidth {} MHz : flush {} samples ({} us)".format(
+            calibrate_decimation, calibrate_bandwidth/1e6, settled_size, settled_size*calibrate_decimation/40))
+    
+    bb_close_device(handle)
+    print("Settling table write to output configuration file : {}".format(args.settling_table))
+    check_w_option(args, True)
+
+
 # Check if the -w, --writeconfig option is called
 check_w_option(args, False)
+
+# Per-channel thresholds of the table acquired by --acquire, applied by channel center frequency. The channels out of the table use the global threshold
+table_channel_count = 0
+for channel in range(channel_number):
+    channel_table_key = channel_key(center_freq + channel*filter_bandwidth)
+    if channel_table_key in args.channel_thresholds:
+        channel_threshold[channel] = 10 ** (args.channel_thresholds[channel_table_key]/10)
+        table_channel_count = table_channel_count + 1
     
 
 
@@ -469,11 +945,20 @@ print("output file name : {}".format(output_filename))
 print("Start center freqency : {} MHz".format(center_freq*0.000001))
 print("Sample freqency : {} Ms".format(fs*0.000001))
 print("Filter Bandwidth : {} MHz".format(filter_bandwidth*0.000001))
+if channelizer is not None:
+    print("Channelizer : capture bandwidth {} MHz, {} sub-channels per tune, {} tunes, FFT size {}".format(
+        capture_bandwidth*0.000001, subchannel_number, tune_number, channelizer.nfft))
 print("Reference level : {} dBm. Threshold = {}, mW_threshold = {}".format(ref_level, args.threshold, mW_threshold))
+if table_channel_count > 0:
+    print("Acquired threshold table used for {} of {} channels".format(table_channel_count, channel_number))
 #print("Total span set : {} MHz".format(args.span))
 print("Sweep option : {}".format(args.option))
 print("Actual sweep from {} - {} Mhz".format(center_freq*0.000001, center_freq*0.000001 + (channel_number-1)*filter_bandwidth*0.000001))
 print("Buffer size : {}. Actual buffer duration : {} us".format(buffer_size, buffer_size*1e6/fs))
+if window_size is not None:
+    print("Window size : {} samples ({} us), step {} samples, {} windows per buffer".format(
+        window_size, window_size*1e6/fs, window_step, len(window_start)))
+print("Flush size after retune : {} samples ({} us)".format(flush_size, flush_size*1e6/fs))
 print("Fc duration : {} ms. Actual Fc duration : {} ms".format(fcduration*1e3, buffer_size*num_captures_samefreq*1e3/fs))
 print("Total collection time : {} min".format(duration/60))
 
@@ -484,220 +969,406 @@ print("Total collection time : {} min".format(duration/60))
 # Start using customized exception handler
 signal.signal(signal.SIGINT, customized_exit)
 
-# Create the event list
-event_list = []
-current_freq = center_freq
+# Create the event sink. Events are appended to <output_filename>.csv (or .bin) in batches during the capturing
+event_dtype = BURST_DTYPE if args.coalesce else EVENT_DTYPE
+if args.format == 'bin' :
+    event_sink = BinaryEventSink(os.path.join(os.getcwd(), output_filename + '.bin'), center_freq, filter_bandwidth,
+                                 args.flushsize, args.flushtime, settings_rows(), event_dtype)
+else :
+    event_sink = CsvEventSink(os.path.join(os.getcwd(), output_filename + '.csv'), center_freq, filter_bandwidth,
+                              args.flushsize, args.flushtime, event_dtype)
 
-# Open device
-handle = bb_open_device()["handle"]
+# Running per-channel occupancy and power statistics, written to Stats-<output_filename>.csv every <args.statstime> seconds
+# Noise floor tracker of --adaptive, None if not used. It updates channel_threshold after each dwell
+if args.adaptive :
+    noise_floor = NoiseFloorTracker(channel_threshold, args.offset, noise_floor_alpha)
+else :
+    noise_floor = None
 
+channel_stats = ChannelStats(channel_number, channel_threshold, noise_floor.floor if noise_floor is not None else None)
+stats_path = os.path.join(os.getcwd(), "Stats-" + output_filename + '.csv')
+last_stats_time = time.monotonic()
 
+def poll_stats() :
+    global last_stats_time
+    if time.monotonic() - last_stats_time >= args.statstime :
+        channel_stats.write(stats_path, center_freq, filter_bandwidth)
+        last_stats_time = time.monotonic()
 
-#### Start the first round of measurement
-measure_start_time = time.perf_counter()
-# Configure device (first time)
-bb_configure_ref_level(handle, ref_level)
-bb_configure_gain_atten(handle, BB_AUTO_GAIN, BB_AUTO_ATTEN)
-bb_configure_IQ_center(handle, center_freq)
-bb_configure_IQ(handle, args.decimation, filter_bandwidth)
-
-# Initialize
-bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
-
-# Flush IQ data filter ramp up time
-garbage = bb_get_IQ_unpacked(handle, garbage_size, BB_TRUE)["iq"]
+# Burst builder of --coalesce, None if not used. It writes the bursts to the event sink
+if args.coalesce :
+    burst_builder = BurstBuilder(event_sink, channel_number, channel_threshold, args.hysteresis, int(args.gap*1e3))
+else :
+    burst_builder = None
 
-# capture <num_captures_samefreq> round in this center frequency
-i = 0
-print('Start capturing from frequency : {}'.format(center_freq)) #debug use
-while (i<num_captures_samefreq):
-    # Here the parameter should be set BB_FALSE
-    iq_struct = bb_get_IQ_unpacked(handle, int(buffer_size), BB_FALSE)
-    iq = iq_struct["iq"]
-    iq_buffer_start_nano = iq_struct["nano"]
-    iq_buffer_start_sec = iq_struct["sec"]
+# Raw IQ recorder of --record, None if not used. The header keeps the metadata of the capturing, like the binary event file
+if args.record :
+    recorder = IqRecorder(os.path.join(os.getcwd(), output_filename + '.iq'), np.int16 if args.iq16 else np.complex64,
+                          args.decimation, capture_bandwidth, settings_rows())
+else :
+    recorder = None
+
+# Power log of --powerlog, None if not used. The header keeps the settings needed to derive the buffer timestamps
+if args.powerlog :
+    power_log = PowerLog(os.path.join(os.getcwd(), output_filename + '.pwr'),
+                         {"center_freq" : center_freq,
+                          "filter_bandwidth" : filter_bandwidth,
+                          "channel_number" : channel_number,
+                          "decimation" : args.decimation,
+                          "buffer_size" : buffer_size,
+                          "window_size" : window_size,
+                          "window_step" : window_step if window_size is not None else None},
+                         settings_rows())
+else :
+    power_log = None
+
+# Throughput counters : dwells captured, hops and the total dead time (s) spent on retune and flush
+dwell_count = 0
+hop_count = 0
+hop_dead_time = 0.0
+
+# Hop to the tune <tune> (center frequency tune_center_freq[tune], the channel center_freq + tune*filter_bandwidth without the channelizer) : configure BB60C, initialize and flush the filter ramp up samples. The time spent is accounted as dead time
+def retune(tune) :
+    global hop_count, hop_dead_time
+    hop_start_time = time.perf_counter()
+    bb_configure_IQ_center(handle, tune_center_freq[tune])
+    configure_done_time = time.perf_counter()
+    bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
+    update_iq_power_scale(tune)
+    initiate_done_time = time.perf_counter()
+    # Flush IQ data filter ramp up time
+    bb_get_IQ_into(handle, flush_iq, BB_TRUE)
+    hop_done_time = time.perf_counter()
+    hop_dead_time = hop_dead_time + hop_done_time - hop_start_time
+    hop_count = hop_count + 1
+    duty_cycle.record_retune(hop_done_time - hop_start_time)
+    history.record_retune(hop_done_time - hop_start_time)
+    if profiler is not None :
+        key = profile_key(tune)
+        profiler.record('configure', configure_done_time - hop_start_time, key)
+        profiler.record('initiate', initiate_done_time - configure_done_time, key)
+        profiler.record('flush', hop_done_time - initiate_done_time, key)
+
+# Latency profiler of the capturing phases (--profile), None if not used
+profiler = PhaseProfiler(args.profile) if args.profile is not None else None
+
+# Breakdown key of the profiler for the tune <tune>
+def profile_key(tune) :
+    if args.profile == 'frequency' :
+        return '{} MHz'.format(tune_center_freq[tune]/1e6)
+    if args.profile == 'decimation' :
+        return 'decimation {}'.format(args.decimation)
+    return None
+
+# Observed, retune and missed time accounting of the capturing
+duty_cycle = DutyCycleAccount(channel_number, fs)
+duty_cycle_path = os.path.join(os.getcwd(), "DutyCycle-" + output_filename + '.csv')
+
+# Preallocated, page-aligned IQ buffers of the capture loop : the IQ block of one dwell (inline processing) and the flush after retune.
+# With the processing threads, the dwells are read into the blocks of the ring instead
+dwell_iq = aligned_iq(num_captures_samefreq*buffer_size)
+flush_iq = aligned_iq(flush_size)
+
+# Read len(<iq>) samples from the device straight into the preallocated array <iq>. Return the timestamp (epoch ns) of the first sample.
+# The samples are accounted as observed time of the channels of <tune>, and the read time is recorded by the profiler
+def read_iq(iq, tune) :
+    if profiler is None :
+        packet = bb_get_IQ_into(handle, iq, BB_FALSE)
+    else :
+        read_start_time = time.perf_counter()
+        packet = bb_get_IQ_into(handle, iq, BB_FALSE)
+        profiler.record('read', time.perf_counter() - read_start_time, profile_key(tune))
+    start_ns = packet.sec*1000000000 + packet.nano
+    duty_cycle.record_read(tune_channels[tune], len(iq), start_ns, packet.sampleLoss)
+    if recorder is not None :
+        recorder.record(iq, tune_center_freq[tune], start_ns, packet.sampleLoss, iq_correction[tune])
+    return start_ns
+
+# Capture <num_captures_samefreq> buffers in the current tune <tune> and add the buffers over the threshold to the event sink. Return the number of buffers over the threshold
+def capture_dwell(tune) :
+    global dwell_count
+    event_sink.poll()
+    poll_stats()
+    if args.threads > 0 :
+        return capture_dwell_pipeline(tune)
+    if batched_read :
+        return capture_dwell_batched(tune)
+    # Without the channelizer, the tune <tune> is the channel <tune>
+    channel = tune
+    threshold = channel_threshold[channel]
+    dwell_power = np.empty((num_captures_samefreq, 1))
+    busy_count = 0
+    i = 0
+    while (i<num_captures_samefreq):
+        # Here the parameter should be set BB_FALSE
+        iq = dwell_iq[i*buffer_size:(i+1)*buffer_size]
+        iq_buffer_start_ns = read_iq(iq, channel)
+        if i == 0 :
+            dwell_start_ns = iq_buffer_start_ns
+        
+        # Calculate the avg power using (sum(I^2 + Q^2) / total samples)
+        iq = iq_values(iq, 2*buffer_size)
+        avg_iq_power = np.einsum('i,i->', iq, iq, dtype=np.float32) * (iq_power_scale[channel]/buffer_size)
+        dwell_power[i] = avg_iq_power
+        
+        # Check if it's over the threshold, if yes, add to the event sink. The dBm value is calculated when the events are flushed
+        if (avg_iq_power >= threshold) : 
+            event_sink.append(iq_buffer_start_ns, channel, avg_iq_power)
+            busy_count = busy_count + 1
+        i = i+1
+    channel_stats.record(tune_channels[tune], dwell_power)
+    if power_log is not None :
+        power_log.add(dwell_start_ns, tune_channels[tune], dwell_power)
+    if noise_floor is not None :
+        noise_floor.update(tune_channels[tune], dwell_power)
+    dwell_count = dwell_count + 1
+    return busy_count
+
+# Sample offset of each buffer in a dwell, converted to ns
+buffer_offset_ns = (np.arange(num_captures_samefreq, dtype=np.int64)*buffer_size*1000000000*args.decimation)//40000000
+buffer_duration_ns = (buffer_size*1000000000*args.decimation)//40000000
+
+# Sample offset of each window in a buffer (--window), converted to ns
+if window_size is not None :
+    window_offset_ns = (window_start.astype(np.int64)*1000000000*args.decimation)//40000000
+    window_duration_ns = (window_size*1000000000*args.decimation)//40000000
+
+# Batched version of capture_dwell : read the whole dwell in one call and process all buffers in one NumPy pass
+def capture_dwell_batched(tune) :
+    global dwell_count
+    dwell_start_ns = read_iq(dwell_iq, tune)
+    # Timestamp of each buffer = first timestamp + sample offset
+    busy_count = process_dwell(dwell_iq, dwell_start_ns + buffer_offset_ns, tune)
+    dwell_count = dwell_count + 1
+    return busy_count
+
+# Compute the avg power of all the buffers of one dwell <iq_block> in one NumPy pass, and add the buffers over the threshold to the event sink. Return the number of buffers over the threshold
+def process_dwell(iq_block, buffer_start_ns, tune) :
+    if channelizer is not None :
+        return process_dwell_channelized(iq_block, buffer_start_ns, tune)
+    if window_size is not None :
+        return process_dwell_windowed(iq_block, buffer_start_ns, tune)
+    # View the IQ as (I, Q) pairs, one row per buffer
+    iq = iq_values(iq_block, num_captures_samefreq, 2*buffer_size)
     
-    #print("The timestamp : {}".format(capture_time))
+    # Calculate the avg power of each buffer using (sum(I^2 + Q^2) / total samples). The int16 pairs of --iq16 are summed in float32 and the correction is applied once per buffer
+    avg_iq_power = np.einsum('ij,ij->i', iq, iq, dtype=np.float32) * (iq_power_scale[tune]/buffer_size)
+    busy_index = np.flatnonzero(avg_iq_power >= channel_threshold[tune])
+    channel_stats.record(tune_channels[tune], avg_iq_power[:, None])
+    if power_log is not None :
+        power_log.add(buffer_start_ns[0], tune_channels[tune], avg_iq_power[:, None])
     
-    # Calculate the avg power using (iq * conj(iq) / total samples)
-    avg_iq_power = np.abs(np.vdot(iq, iq) / buffer_size)
+    if burst_builder is not None :
+        burst_builder.add(buffer_start_ns, buffer_start_ns + buffer_duration_ns, tune_channels[tune], avg_iq_power[:, None])
+    else :
+        event_sink.add(buffer_start_ns[busy_index], tune, avg_iq_power[busy_index])
+    if noise_floor is not None :
+        noise_floor.update(tune_channels[tune], avg_iq_power[:, None])
+    return len(busy_index)
+
+# Sliding window version of process_dwell : one event per window over the threshold, starting at the first sample of the window. A buffer is counted as busy if any of its windows is over the threshold
+def process_dwell_windowed(iq_block, buffer_start_ns, tune) :
+    iq = iq_values(iq_block, num_captures_samefreq, buffer_size, 2)
     
-    # Check if it's over the threshold, if yes, add to event_list
-    if (avg_iq_power >= mW_threshold) : 
-        # calculate the dBm value
-        avg_iq_power = 10 * np.log10(avg_iq_power)
-        capture_time = datetime.fromtimestamp(iq_buffer_start_sec).strftime('%Y-%m-%d %H:%M:%S')
-        event_list.append((capture_time, iq_buffer_start_nano, current_freq, avg_iq_power))
-    i = i+1
-
-
-
-
-#%%  Hop to other center frequency based on sweep_option if not exceed the whole collection duration
-if args.option == 'fixed' :
-    while (time.perf_counter() - measure_start_time) < duration :
-        i = 0
-        while (i<num_captures_samefreq):
-            # Here the parameter should be set BB_FALSE
-            iq_struct = bb_get_IQ_unpacked(handle, int(buffer_size), BB_FALSE)
-            iq = iq_struct["iq"]
-            iq_buffer_start_nano = iq_struct["nano"]
-            iq_buffer_start_sec = iq_struct["sec"]
-            
-            # Calculate the avg power using (iq * conj(iq) / total samples)
-            avg_iq_power = np.abs(np.vdot(iq, iq) / buffer_size)
-            
-            # Check if it's over the threshold, if yes, add to event_list
-            if (avg_iq_power >= mW_threshold) : 
-                # calculate the dBm value
-                avg_iq_power = 10 * np.log10(avg_iq_power)
-                capture_time = datetime.fromtimestamp(iq_buffer_start_sec).strftime('%Y-%m-%d %H:%M:%S')
-                event_list.append((capture_time, iq_buffer_start_nano, center_freq, avg_iq_power))
-            i = i+1
-            
-elif args.option == 'sweep' :
-    sweep_counter = 0
-    while (time.perf_counter() - measure_start_time) < duration :
-        # Hop to next frequency channel with the same bandwidth and configure BB60C
-        sweep_counter = (sweep_counter+1)%channel_number
-        next_f = center_freq + sweep_counter*filter_bandwidth
-        # print('Switch to capture at frequency : {}'.format(next_f)) #debug use
-        bb_configure_IQ_center(handle, next_f)
-        bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
-        
-        # Flush IQ data filter ramp up time
-        garbage = bb_get_IQ_unpacked(handle, garbage_size, BB_TRUE)["iq"]
-        i = 0
-        while (i<num_captures_samefreq):
-            # Here the parameter should be set BB_FALSE
-            iq_struct = bb_get_IQ_unpacked(handle, int(buffer_size), BB_FALSE)
-            iq = iq_struct["iq"]
-            iq_buffer_start_nano = iq_struct["nano"]
-            iq_buffer_start_sec = iq_struct["sec"]
-            
-            # Calculate the avg power using (iq * conj(iq) / total samples)
-            avg_iq_power = np.abs(np.vdot(iq, iq) / buffer_size)
-            
-            # Check if it's over the threshold, if yes, add to event_list
-            if (avg_iq_power >= mW_threshold) : 
-                # calculate the dBm value
-                avg_iq_power = 10 * np.log10(avg_iq_power)
-                capture_time = datetime.fromtimestamp(iq_buffer_start_sec).strftime('%Y-%m-%d %H:%M:%S')
-                event_list.append((capture_time, iq_buffer_start_nano, next_f, avg_iq_power))
-            i = i+1
+    # Cumulative sum of the power of each sample in each buffer (float64 to keep the precision over long buffers), with a leading 0
+    power_cumsum = np.zeros((num_captures_samefreq, buffer_size + 1))
+    np.cumsum(np.einsum('ijk,ijk->ij', iq, iq, dtype=np.float32), axis=1, out=power_cumsum[:, 1:])
     
-elif args.option == 'rand-sweep' : 
-    while (time.perf_counter() - measure_start_time) < duration :
-        # Randomly choose the next center frequency and configure BB60C
-        next_f = center_freq + random.randrange(channel_number)*filter_bandwidth
-        # print('Switch to capture at frequency : {}'.format(next_f)) #debug use
-        bb_configure_IQ_center(handle, next_f)
-        bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
-        
-        # Flush IQ data filter ramp up time
-        garbage = bb_get_IQ_unpacked(handle, garbage_size, BB_TRUE)["iq"]
+    # Avg power of each window of each buffer
+    avg_iq_power = (power_cumsum[:, window_start + window_size] - power_cumsum[:, window_start]) * (iq_power_scale[tune]/window_size)
+    busy_buffer, busy_window = np.nonzero(avg_iq_power >= channel_threshold[tune])
+    channel_stats.record(tune_channels[tune], avg_iq_power.reshape(-1, 1))
+    if power_log is not None :
+        power_log.add(buffer_start_ns[0], tune_channels[tune], avg_iq_power.reshape(-1, 1))
+    
+    if burst_builder is not None :
+        window_start_ns = (buffer_start_ns[:, None] + window_offset_ns).ravel()
+        burst_builder.add(window_start_ns, window_start_ns + window_duration_ns, tune_channels[tune], avg_iq_power.reshape(-1, 1))
+    else :
+        event_sink.add(buffer_start_ns[busy_buffer] + window_offset_ns[busy_window], tune, avg_iq_power[busy_buffer, busy_window])
+    if noise_floor is not None :
+        noise_floor.update(tune_channels[tune], avg_iq_power.reshape(-1, 1))
+    return len(np.unique(busy_buffer))
+
+# Channelizer version of process_dwell : one event per buffer and sub-channel over the threshold. A buffer is counted as busy if any of its sub-channels is over the threshold
+def process_dwell_channelized(iq_block, buffer_start_ns, tune) :
+    channels = tune_channels[tune]
+    # Avg power of each buffer (row) and channel of the tune (column). The last tune may use only part of the sub-channels
+    avg_iq_power = channelizer.power(iq_complex(iq_block), num_captures_samefreq)[:, :len(channels)] * iq_power_scale[tune]
+    busy_buffer, busy_subchannel = np.nonzero(avg_iq_power >= channel_threshold[channels])
+    channel_stats.record(channels, avg_iq_power)
+    if power_log is not None :
+        power_log.add(buffer_start_ns[0], channels, avg_iq_power)
+    
+    if burst_builder is not None :
+        burst_builder.add(buffer_start_ns, buffer_start_ns + buffer_duration_ns, channels, avg_iq_power)
+    else :
+        event_sink.add(buffer_start_ns[busy_buffer], channels[busy_subchannel], avg_iq_power[busy_buffer, busy_subchannel])
+    if noise_floor is not None :
+        noise_floor.update(channels, avg_iq_power)
+    return len(np.unique(busy_buffer))
+
+
+#### Acquisition/processing pipeline (--threads) ##############################
+# The main thread (producer) only drains the BB60C into a preallocated ring of IQ blocks, one block per dwell.
+# <args.threads> consumer threads run the power/threshold stage on the blocks taken from the bounded work queue.
+ring_size = max(args.ringsize, 1)
+ring_iq = None
+ring_start_ns = None
+free_slots = queue.Queue()
+work_queue = queue.Queue(maxsize=ring_size)
+result_queue = queue.Queue()
+consumer_threads = []
+dwell_count_lock = threading.Lock()
+# First exception raised by the processing of a dwell in a consumer thread. The capture engine stops at the next dwell and the exception is re-raised in the main thread after the output is written
+pipeline_error = None
+
+# Pipeline counters : the producer found no free block in the ring (processing can't keep up), max and sum of the work queue depth
+ring_overflow_count = 0
+max_queue_depth = 0
+sum_queue_depth = 0
+
+
+def start_pipeline() :
+    global ring_iq, ring_start_ns
+    ring_iq = aligned_iq(ring_size, num_captures_samefreq*buffer_size)
+    ring_start_ns = np.empty((ring_size, num_captures_samefreq), dtype=np.int64)
+    for slot in range(ring_size):
+        free_slots.put(slot)
+    for k in range(args.threads):
+        consumer = threading.Thread(target=consumer_loop, name='consumer-{}'.format(k), daemon=True)
+        consumer.start()
+        consumer_threads.append(consumer)
+
+def stop_pipeline() :
+    for consumer in consumer_threads:
+        work_queue.put(None)
+    for consumer in consumer_threads:
+        consumer.join()
+
+def consumer_loop() :
+    global dwell_count, pipeline_error
+    while True:
+        work = work_queue.get()
+        if work is None:
+            break
+        slot, tune = work
+        # After an error, the blocks are only given back so the producer and stop_pipeline() never wait on a dead consumer
+        busy_count = None
+        if pipeline_error is None:
+            try:
+                busy_count = process_dwell(ring_iq[slot], ring_start_ns[slot], tune)
+            except Exception as e:
+                with dwell_count_lock:
+                    pipeline_error = pipeline_error or e
+        if busy_count is not None:
+            with dwell_count_lock:
+                dwell_count = dwell_count + 1
+        free_slots.put(slot)
+        if strategy.needs_feedback:
+            result_queue.put(busy_count)
+        elif busy_count is not None:
+            with dwell_count_lock:
+                history.record_busy(tune, busy_count)
+
+# Read one dwell from the device straight into the ring block <slot>
+def read_dwell(slot, tune) :
+    if batched_read :
+        ring_start_ns[slot] = read_iq(ring_iq[slot], tune) + buffer_offset_ns
+    else :
         i = 0
         while (i<num_captures_samefreq):
-            # Here the parameter should be set BB_FALSE
-            iq_struct = bb_get_IQ_unpacked(handle, int(buffer_size), BB_FALSE)
-            iq = iq_struct["iq"]
-            iq_buffer_start_nano = iq_struct["nano"]
-            iq_buffer_start_sec = iq_struct["sec"]
-            
-            # Calculate the avg power using (iq * conj(iq) / total samples)
-            avg_iq_power = np.abs(np.vdot(iq, iq) / buffer_size)
-            
-            # Check if it's over the threshold, if yes, add to event_list
-            if (avg_iq_power >= mW_threshold) : 
-                # calculate the dBm value
-                avg_iq_power = 10 * np.log10(avg_iq_power)
-                capture_time = datetime.fromtimestamp(iq_buffer_start_sec).strftime('%Y-%m-%d %H:%M:%S')
-                event_list.append((capture_time, iq_buffer_start_nano, next_f, avg_iq_power))
+            ring_start_ns[slot, i] = read_iq(ring_iq[slot, i*buffer_size:(i+1)*buffer_size], tune)
             i = i+1
 
-elif args.option == 'hop-ifnot-busy' : 
-    busy_count = num_captures_samefreq*occupancy_threshold
-    next_f = center_freq
-    while (time.perf_counter() - measure_start_time) < duration :
-        # Stay capturing in same freq if occupancy rate is over the threshold
-        if (busy_count/num_captures_samefreq) >= occupancy_threshold : 
-            # Channel busy
-            pass            
-        else :
-            # Channel not busy, hop
-            next_f = center_freq + random.randrange(channel_number)*filter_bandwidth
-            bb_configure_IQ_center(handle, next_f)
-            bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
-            # Flush IQ data filter ramp up time
-            garbage = bb_get_IQ_unpacked(handle, garbage_size, BB_TRUE)["iq"]
-                
-        i = 0
-        busy_count = 0
-        while (i<num_captures_samefreq):
-            # Here the parameter should be set BB_FALSE
-            iq_struct = bb_get_IQ_unpacked(handle, int(buffer_size), BB_FALSE)
-            iq = iq_struct["iq"]
-            iq_buffer_start_nano = iq_struct["nano"]
-            iq_buffer_start_sec = iq_struct["sec"]
-            
-            # Calculate the avg power using (iq * conj(iq) / total samples)
-            avg_iq_power = np.abs(np.vdot(iq, iq) / buffer_size)
-            
-            # Check if it's over the threshold, if yes, add to event_list
-            if (avg_iq_power >= mW_threshold) : 
-                # calculate the dBm value
-                avg_iq_power = 10 * np.log10(avg_iq_power)
-                capture_time = datetime.fromtimestamp(iq_buffer_start_sec).strftime('%Y-%m-%d %H:%M:%S')
-                event_list.append((capture_time, iq_buffer_start_nano, next_f, avg_iq_power))
-                busy_count = busy_count + 1
-            i = i+1
+# Pipeline version of capture_dwell. The busy count is only waited for with the hop strategies needing it, otherwise None is returned (the processing threads record it in the history). None is also returned if the processing of the dwell failed (see pipeline_error)
+def capture_dwell_pipeline(tune) :
+    global ring_overflow_count, max_queue_depth, sum_queue_depth
+    try:
+        slot = free_slots.get_nowait()
+    except queue.Empty:
+        # All blocks are still waiting to be processed
+        ring_overflow_count = ring_overflow_count + 1
+        slot = free_slots.get()
+    try:
+        read_dwell(slot, tune)
+    except EOFError:
+        # End of the replayed recording, give the block back to the ring
+        free_slots.put(slot)
+        raise
+    work_queue.put((slot, tune))
+    queue_depth = work_queue.qsize()
+    max_queue_depth = max(max_queue_depth, queue_depth)
+    sum_queue_depth = sum_queue_depth + queue_depth
+    if strategy.needs_feedback:
+        return result_queue.get()
+    return None
+
+# Create the hop strategy of the sweep option and the per-tune history it uses
+if args.option not in HOP_STRATEGIES :
+    sys.exit("Warning : unrecognized sweep option !!!")
+strategy = make_strategy(args.option, tune_number, num_captures_samefreq,
+                         {"occupancy_threshold" : occupancy_threshold, "p_samefreq" : p_samefreq,
+                          "bandit_exploration" : bandit_exploration, "bandit_discount" : bandit_discount,
+                          "revisit_interval" : tune_revisit, "revisit_margin" : revisit_margin})
+history = ChannelHistory(tune_number, num_captures_samefreq)
 
-elif args.option == 'hop-with-p' : 
-    busy_count = num_captures_samefreq*occupancy_threshold
-    next_f = center_freq
-    while (time.perf_counter() - measure_start_time) < duration :
-        # Stay capturing in same freq if occupancy rate is over the threshold
-        if (busy_count/num_captures_samefreq) >= occupancy_threshold : 
-            # Channel busy, stay in same freq with probability p_samefreq
-            if random.uniform(0, 1) <= p_samefreq:
-                pass
-            else :
-                next_f = center_freq + random.randrange(channel_number)*filter_bandwidth
-                bb_configure_IQ_center(handle, next_f)
-                bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
-                # Flush IQ data filter ramp up time
-                garbage = bb_get_IQ_unpacked(handle, garbage_size, BB_TRUE)["iq"]
-        else :
-            # Channel not busy, hop
-            next_f = center_freq + random.randrange(channel_number)*filter_bandwidth
-            bb_configure_IQ_center(handle, next_f)
-            bb_initiate(handle, BB_STREAMING, BB_STREAM_IQ)
-            # Flush IQ data filter ramp up time
-            garbage = bb_get_IQ_unpacked(handle, garbage_size, BB_TRUE)["iq"]
-                
-        i = 0
-        busy_count = 0
-        while (i<num_captures_samefreq):
-            # Here the parameter should be set BB_FALSE
-            iq_struct = bb_get_IQ_unpacked(handle, int(buffer_size), BB_FALSE)
-            iq = iq_struct["iq"]
-            iq_buffer_start_nano = iq_struct["nano"]
-            iq_buffer_start_sec = iq_struct["sec"]
-            
-            # Calculate the avg power using (iq * conj(iq) / total samples)
-            avg_iq_power = np.abs(np.vdot(iq, iq) / buffer_size)
-            
-            # Check if it's over the threshold, if yes, add to event_list
-            if (avg_iq_power >= mW_threshold) : 
-                # calculate the dBm value
-                avg_iq_power = 10 * np.log10(avg_iq_power)
-                capture_time = datetime.fromtimestamp(iq_buffer_start_sec).strftime('%Y-%m-%d %H:%M:%S')
-                event_list.append((capture_time, iq_buffer_start_nano, next_f, avg_iq_power))
-                busy_count = busy_count + 1
-            i = i+1
-            
-else :
-    print("Warning : unrecognized sweep option !!!")
+# Open device
+handle = open_device()
+
+if args.threads > 0 :
+    start_pipeline()
+
+
+
+#### Capture engine ##########################################################
+# Start with the first tune (channel), then hop to the tune given by the hop strategy after each dwell until the whole collection duration is over
+measure_start_time = time.perf_counter()
+# Configure device (first time)
+bb_configure_ref_level(handle, ref_level)
+bb_configure_gain_atten(handle, BB_AUTO_GAIN, BB_AUTO_ATTEN)
+configure_iq_data_type()
+bb_configure_IQ(handle, args.decimation, capture_bandwidth)
+
+print('Start capturing from frequency : {}'.format(center_freq)) #debug use
+current_channel = 0
+retune(current_channel)
+
+# Check that the max revisit intervals of the deadline option can be met : each tune needs one retune (measured by the first one) and one dwell per revisit interval
+if tune_revisit is not None :
+    utilization = deadline_utilization(tune_revisit, fcduration, history.retune_time)
+    if utilization > 1 :
+        print("Warning : the max revisit intervals can not all be met. {} tunes with a dwell of {} ms and a retune of {:.3f} ms need {:.0f}% of the time (min revisit interval of {:.1f} ms for all the channels)".format(
+            tune_number, args.fcduration, history.retune_time*1e3, 100*utilization, ((tune_number - 1)*fcduration + tune_number*history.retune_time)*1e3))
+
+while True :
+    # capture <num_captures_samefreq> round in this center frequency. The replayed device (--device replay) ends the capturing at the end of the recording
+    dwell_start_time = time.perf_counter()
+    try :
+        busy_count = capture_dwell(current_channel)
+    except EOFError :
+        print("End of the replayed IQ recording")
+        break
+    # Stop before the history and the hop strategy see the dwell if a processing thread failed (its busy count is missing)
+    if pipeline_error is not None :
+        print("A processing thread failed, stop the capturing")
+        break
+    if busy_count is not None :
+        history.record_busy(current_channel, busy_count)
+    history.record_dwell(current_channel, time.perf_counter(), dwell_start_time)
+    
+    if (time.perf_counter() - measure_start_time) >= duration :
+        break
+    if interrupt_requested :
+        print("Program is interrupted by Ctrl+C. Close BB60C and exit the program")
+        break
+    
+    # Hop to other center frequency based on sweep_option
+    next_channel = strategy.next_channel(history)
+    if next_channel is not None :
+        # print('Switch to capture at frequency : {}'.format(tune_center_freq[next_channel])) #debug use
+        current_channel = next_channel
+        retune(current_channel)
 
 
 
@@ -706,48 +1377,33 @@ print("Capturing done")
 #%% Close device and write to csv file
 
 
+# Wait for the processing threads to finish the remaining dwells
+if args.threads > 0 :
+    stop_pipeline()
+
 # Close the BB60C device
 print("Device closing ...")
 bb_close_device(handle)
 
 
-# Write event to csv file
-print("Write capture event to the output csv <{}> file".format(output_filename))
-output_path = os. getcwd() + '\\'
-
-# For Windows
-with open(output_path + output_filename + '.csv','w', newline='') as out:
-# for linux : with open(output_path + output_file,'w') as out:
-    csv_output = csv.writer(out)
-    csv_output.writerow(['Event start time','Time in Nano second', 'Center Freq (Hz)', 'Avg Power (dBm)'])
-    csv_output.writerows(event_list)
-    #for row in data:
-    #    csv_out.writerow(row)    
-
-# Write Metadata file
-# For Windows
-with open(output_path + "Metadata-" + output_filename + '.csv','w', newline='') as out:
-# for linux : with open(output_path + output_file,'w') as out:
-    csv_output = csv.writer(out)
-    csv_output.writerow(['Sampling Rate (M/s)', fs/1e6])
-    csv_output.writerow(['Sweep option', args.option])
-    csv_output.writerow(['Min Center frequency (MHz)', center_freq/1e6])
-    csv_output.writerow(['Max Center frequency (MHz)', center_freq/1e6 + (channel_number-1)*filter_bandwidth/1e6])
-    csv_output.writerow(['Filter Bandwidth (MHz)', filter_bandwidth/1e6])
-    csv_output.writerow(['Total channels sweeping during capturing', channel_number])
-#    csv_output.writerow(['Center frequency (Hz)', center_freq])
-    csv_output.writerow(['Threshold (dBm)', args.threshold])
-    csv_output.writerow(['Reference level (dBm)', ref_level])
-    csv_output.writerow(['Total collection duration (min)', args.duration])
-    csv_output.writerow(['Buffer duration/min event size (us))', args.bufferduration])
-    csv_output.writerow(['Frequency dwell time (ms)', args.fcduration])
-    csv_output.writerow(['Comments', args.comment[0]])
+# Write event and Metadata to csv file. If interrupted, the collection duration is the time captured so far (min)
+write_output((time.perf_counter() - measure_start_time)/60 if interrupt_requested else args.duration)
+elapsed_time = time.perf_counter() - measure_start_time
+print("Throughput : {:.1f} buffers/s, {:.1f} events/s. Dead time per hop : {:.3f} ms".format(
+    dwell_count*num_captures_samefreq/elapsed_time, event_sink.count/elapsed_time, hop_dead_time*1e3/max(hop_count, 1)))
+if args.threads > 0 :
+    print("Pipeline : max queue depth {}/{}, ring overflows {}".format(max_queue_depth, ring_size, ring_overflow_count))
+if tune_revisit is not None and np.any(history.max_unobserved > tune_revisit) :
+    print("Warning : {} tunes went unobserved longer than their max revisit interval, by up to {:.1f} ms".format(
+        int(np.sum(history.max_unobserved > tune_revisit)), float(np.max(history.max_unobserved - tune_revisit))*1e3))
+
+# The events processed before the failure of a processing thread are written above, report the failure
+if pipeline_error is not None :
+    raise pipeline_error
        
 
 
 
-
-
 # #%%  Test iq acuiring power with different sample rate
 
 # # Open device
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+FFT channelizer of channel-capturing.py (--channelizer).
+
+The BB60C captures a wideband block (the max bandwidth of the decimation, e.g. 27 MHz at 40 Ms/s) and the
+channelizer splits it into <subchannel_number> adjacent sub-channels of <subchannel_bandwidth>, centered on the
+IQ center frequency. Each buffer is cut into frames of <nfft> samples, windowed (Hann) and transformed in one
+vectorized DFT over the whole dwell. The power of a sub-channel is the sum of the power of the FFT bins whose
+center falls in the sub-channel, averaged over the frames of the buffer. The bin power is normalized by the
+window energy, so the sum over all bins equals the avg power of the buffer (sum(I^2 + Q^2) / samples) and a
+sub-channel reads the same power as a capture with filter_bandwidth = <subchannel_bandwidth> would.
+"""
+import math
+import numpy as np
+
+
+class FftChannelizer:
+    """Split the IQ buffers into adjacent sub-channels and compute the avg power of each sub-channel"""
+
+    def __init__(self, fs, subchannel_bandwidth, subchannel_number, bins_per_subchannel=4):
+        self.fs = fs
+        self.subchannel_bandwidth = subchannel_bandwidth
+        self.subchannel_number = subchannel_number
+        # Smallest power of 2 FFT giving at least <bins_per_subchannel> bins per sub-channel
+        self.nfft = 2 ** int(math.ceil(math.log2(bins_per_subchannel * fs / subchannel_bandwidth)))
+        self.window = np.hanning(self.nfft).astype(np.float32)
+
+        # Offset (Hz) of the sub-channel centers from the IQ center frequency
+        self.offsets = (np.arange(subchannel_number) - (subchannel_number - 1)/2) * subchannel_bandwidth
+        # Map of the FFT bins to the sub-channels, including the window energy normalization. Bins outside all the
+        # sub-channels (edges of the capture bandwidth) are not computed
+        bin_freq = np.fft.fftfreq(self.nfft, 1/fs)
+        bin_map = np.zeros((self.nfft, subchannel_number), dtype=np.float32)
+        for k, offset in enumerate(self.offsets):
+            in_subchannel = (bin_freq >= offset - subchannel_bandwidth/2) & (bin_freq < offset + subchannel_bandwidth/2)
+            bin_map[in_subchannel, k] = 1.0 / (self.nfft * np.sum(self.window.astype(np.float64)**2))
+        used_bins = np.flatnonzero(bin_map.any(axis=1))
+        self.bin_map = bin_map[used_bins]
+        # Windowed DFT matrix of the used bins. The frames are short, so one matrix product over all the frames of the
+        # dwell is faster than np.fft.fft
+        n = np.arange(self.nfft)
+        self.dft = (self.window[:, None] * np.exp(-2j*np.pi*np.outer(n, used_bins)/self.nfft)).astype(np.complex64)
+
+    def power(self, iq_block, num_buffers):
+        """Avg power (mW) of each sub-channel of each buffer of <iq_block>, as an array (num_buffers, subchannel_number).
+        The buffer size must be a multiple of nfft"""
+        spectrum = iq_block.reshape(-1, self.nfft) @ self.dft
+        # Power of each bin summed over the frames of each buffer, computed on the (real, imag) float view
+        spectrum = spectrum.view(np.float32).reshape(num_buffers, -1, len(self.bin_map), 2)
+        frames_per_buffer = spectrum.shape[1]
+        bin_power = np.einsum('ijkl,ijkl->ik', spectrum, spectrum) / frames_per_buffer
+        return bin_power @ self.bin_map
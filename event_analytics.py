@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Occupancy analytics of the event files of channel-capturing.py, used by occupancy-analysis.py.
+
+An event file (<output_filename>.csv or .bin, events or coalesced bursts) is cut into chunks : ranges of records of
+the binary file, or byte ranges of whole lines of the csv file. Each chunk is analyzed on its own by
+analyze_chunk() into a partial aggregate, and the partial aggregates are summed by merge_partials(), so the chunks
+can be processed by a pool of processes and the memory stays bounded by the chunk size.
+
+The partial aggregate of a chunk is a dict :
+    "occupancy" : {(center freq (Hz), time bin) : [events, busy time (ns)]}, the time bin is the start time of the
+                  event // <bin_ns>. The busy time is the duration of the event (buffer or window duration) or of
+                  the burst, counted in the bin of its start
+    "bursts"    : {center freq (Hz) : histogram of the burst durations over DURATION_EDGES_US}. Without the
+                  coalescing, the consecutive events of a channel (less than <gap_ns> apart) are chained into
+                  bursts, inside each chunk
+    "power"     : {center freq (Hz) : histogram of the event power (dBm) over POWER_EDGES_DBM}
+"""
+import os
+import time
+import csv
+import io
+from datetime import datetime
+
+import numpy as np
+
+from event_sink import load_events, blocks_channel_freq
+
+# Bin edges of the burst duration histogram (us), 10 bins per decade from 1 us to 100 s
+DURATION_EDGES_US = 10 ** np.round(np.arange(0, 8.05, 0.1), 1)
+
+# Bin edges of the power histogram (dBm)
+POWER_EDGES_DBM = np.arange(-150.0, 30.5, 1.0)
+
+# Tolerance (ns) on the timestamps of consecutive events, rounded to the ns when the capture computes them
+TIME_TOLERANCE_NS = 1000
+
+
+def plan_chunks(path, event_format, chunk_size):
+    """Cut the event file <path> into chunks of about <chunk_size> events. Return the list of (start, stop) : record
+    indices of the binary file, or byte offsets of whole lines of the csv file (after the header line)"""
+    if event_format == 'bin':
+        _, events = load_events(path)
+        starts = list(range(0, len(events), chunk_size))
+        return [(start, min(start + chunk_size, len(events))) for start in starts]
+    # About 60 bytes per csv event row
+    chunk_bytes = chunk_size * 60
+    file_size = os.path.getsize(path)
+    chunks = []
+    with open(path, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        while start < file_size:
+            f.seek(min(start + chunk_bytes, file_size))
+            f.readline()
+            stop = min(f.tell(), file_size)
+            chunks.append((start, stop))
+            start = stop
+    return chunks
+
+
+def read_bin_chunk(path, start, stop):
+    """Events of the records [start, stop) of a binary event file : time (epoch ns), center freq (Hz), power (dBm)
+    and end time (epoch ns) of the bursts (None for the events)"""
+    header, events = load_events(path)
+    events = np.array(events[start:stop])
+    channel_freq = blocks_channel_freq(header.get("channel_blocks"), header["filter_bandwidth"])
+    if channel_freq is not None:
+        freq = channel_freq[events['channel']]
+    else:
+        freq = header["center_freq"] + events['channel'].astype(np.float64)*header["filter_bandwidth"]
+    end_ns = events['end_ns'] if 'end_ns' in events.dtype.names else None
+    return events['time_ns'], freq, events['power'].astype(np.float64), end_ns
+
+
+def read_csv_chunk(path, start, stop):
+    """Events of the lines in the byte range [start, stop) of a csv event file, same as read_bin_chunk()"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(stop - start).decode()
+    rows = [row for row in csv.reader(io.StringIO(text)) if row]
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), None
+    columns = list(zip(*rows))
+    # The date string is local time, parsed once per distinct second
+    date_text, inverse = np.unique(np.array(columns[0]), return_inverse=True)
+    date_sec = np.array([int(time.mktime(datetime.strptime(text, '%Y-%m-%d %H:%M:%S').timetuple())) for text in date_text],
+                        dtype=np.int64)
+    time_ns = date_sec[inverse]*1000000000 + np.array(columns[1], dtype=np.int64)
+    end_ns = np.array(columns[4], dtype=np.int64) if len(columns) > 4 else None
+    return time_ns, np.array(columns[2], dtype=np.float64), np.array(columns[3], dtype=np.float64), end_ns
+
+
+def analyze_chunk(task):
+    """Partial aggregate of one chunk. <task> : (path, event format, start, stop, time bin (ns), duration of an
+    event (ns), gap tolerance (ns) of the bursts)"""
+    path, event_format, start, stop, bin_ns, event_duration_ns, gap_ns = task
+    if event_format == 'bin':
+        time_ns, freq, power, end_ns = read_bin_chunk(path, start, stop)
+    else:
+        time_ns, freq, power, end_ns = read_csv_chunk(path, start, stop)
+    partial = {"occupancy" : {}, "bursts" : {}, "power" : {}}
+    if len(time_ns) == 0:
+        return partial
+    coalesced = end_ns is not None
+    if not coalesced:
+        end_ns = time_ns + event_duration_ns
+    channel_freq, channel = np.unique(freq, return_inverse=True)
+
+    # Events and busy time of each channel in each time bin
+    time_bin = time_ns // bin_ns
+    keys, key_inverse = np.unique(np.stack((channel, time_bin)), axis=1, return_inverse=True)
+    key_inverse = key_inverse.ravel()
+    events = np.bincount(key_inverse)
+    busy_ns = np.bincount(key_inverse, weights=end_ns - time_ns)
+    for (k, b), n, busy in zip(keys.T, events, busy_ns):
+        partial["occupancy"][(channel_freq[k], int(b))] = [int(n), float(busy)]
+
+    # Burst durations : the bursts of the file, or the chains of consecutive events of each channel
+    if coalesced:
+        burst_channel = channel
+        duration_us = (end_ns - time_ns) / 1e3
+    else:
+        order = np.lexsort((time_ns, channel))
+        burst_channel = channel[order]
+        burst_start = time_ns[order]
+        burst_end = end_ns[order]
+        new_burst = np.ones(len(order), dtype=bool)
+        new_burst[1:] = (burst_channel[1:] != burst_channel[:-1]) | (burst_start[1:] - burst_end[:-1] > gap_ns + TIME_TOLERANCE_NS)
+        first = np.flatnonzero(new_burst)
+        duration_us = (np.maximum.reduceat(burst_end, first) - burst_start[first]) / 1e3
+        burst_channel = burst_channel[first]
+    duration_bin = np.clip(np.searchsorted(DURATION_EDGES_US, duration_us, side='right') - 1, 0, len(DURATION_EDGES_US) - 2)
+    duration_histogram = np.bincount(burst_channel * (len(DURATION_EDGES_US) - 1) + duration_bin,
+                                     minlength=len(channel_freq) * (len(DURATION_EDGES_US) - 1))
+    power_bin = np.clip(np.searchsorted(POWER_EDGES_DBM, power, side='right') - 1, 0, len(POWER_EDGES_DBM) - 2)
+    power_histogram = np.bincount(channel * (len(POWER_EDGES_DBM) - 1) + power_bin,
+                                  minlength=len(channel_freq) * (len(POWER_EDGES_DBM) - 1))
+    for k, f in enumerate(channel_freq):
+        partial["bursts"][f] = duration_histogram.reshape(len(channel_freq), -1)[k]
+        partial["power"][f] = power_histogram.reshape(len(channel_freq), -1)[k]
+    return partial
+
+
+def merge_partials(total, partial):
+    """Add the partial aggregate <partial> to <total>. Return <total>"""
+    for key, (events, busy_ns) in partial["occupancy"].items():
+        counts = total["occupancy"].setdefault(key, [0, 0.0])
+        counts[0] = counts[0] + events
+        counts[1] = counts[1] + busy_ns
+    for name in ("bursts", "power"):
+        for freq, histogram in partial[name].items():
+            if freq in total[name]:
+                total[name][freq] = total[name][freq] + histogram
+            else:
+                total[name][freq] = histogram
+    return total
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming event writers for channel-capturing.py.
+
+The events are kept in a small pending batch and appended to the output file when the batch reaches
+<flush_size> events. Every <flush_time> seconds the pending events are also flushed and the file is fsync'ed
+(checkpoint), so at most <flush_time> seconds of events can be lost on a crash. Memory stays bounded by the
+batch size whatever the collection duration, and the output file only contains complete rows at any moment.
+
+Each event is (time_ns, channel, power) : start time of the buffer (epoch ns), channel index (the center
+frequency is center_freq + channel*filter_bandwidth, or channel_freq[channel] for the channel plans of several
+bands, see multi-capture.py) and the avg linear power (mW). The detection path only
+records these raw values in a preallocated pending batch. The dBm conversion and the time formatting are done
+in one vectorized pass over the batch when it is flushed.
+
+With the event coalescing (see burst_builder.py), the records are bursts of BURST_DTYPE instead : the events of
+EVENT_DTYPE plus the end time (epoch ns), the peak power and the number of buffers (or windows) of the burst.
+The power field is then the mean power of the burst.
+
+The records are written in the order they are added, which is not always the time order : with several
+processing threads (--threads > 1) the dwells are processed concurrently, and the bursts are written when they
+end. Sort the records by time_ns when the order matters (as merge_events() of multi-capture.py does).
+
+Output formats :
+    CsvEventSink    : <output_filename>.csv, one text row per event (see CSV_HEADER, BURST_CSV_HEADER)
+    BinaryEventSink : <output_filename>.bin, a header followed by the events as records of EVENT_DTYPE (int64 epoch
+                      ns, uint16 channel index, float32 power dBm) or BURST_DTYPE, appended in chunks.
+                      The header is a json document with the metadata of the capturing (the same rows as
+                      Metadata-<output_filename>.csv). Use load_events() to memory-map the records and
+                      events-to-csv.py to convert the file to the csv format.
+
+File header of the binary event file, the IQ recording and the power log (see write_file_header()) : the magic
+bytes of the file type, the offset of the data (uint64), the json header and a space padding up to the data. The
+room of the header is reserved when the file is opened, with a margin for the final metadata rewritten at the
+close. If the final metadata does not fit, it is written to the sidecar file <path>.json named in the header, and
+read_file_header() loads it back.
+"""
+import os
+import io
+import csv
+import json
+import struct
+import time
+import threading
+from datetime import datetime
+
+import numpy as np
+
+CSV_HEADER = ['Event start time','Time in Nano second', 'Center Freq (Hz)', 'Avg Power (dBm)']
+
+# Burst records : the first columns are the same as the events
+BURST_CSV_HEADER = CSV_HEADER + ['End time in Nano second (epoch)', 'Duration (us)', 'Peak Power (dBm)', 'Buffers']
+
+EVENT_DTYPE = np.dtype([('time_ns', '<i8'), ('channel', '<u2'), ('power', '<f4')])
+
+BURST_DTYPE = np.dtype([('time_ns', '<i8'), ('channel', '<u2'), ('power', '<f4'),
+                        ('end_ns', '<i8'), ('peak_power', '<f4'), ('count', '<u4')])
+
+# Fields kept as linear power (mW) in the pending records and converted to dBm when written
+POWER_FIELDS = ['power', 'peak_power']
+
+# Min size (bytes) of the file header
+HEADER_SIZE = 16384
+# The header room is HEADER_ROOM_FACTOR times the size of the header at the open, for the final metadata
+HEADER_ROOM_FACTOR = 4
+BINARY_MAGIC = b'SASEVENT'
+
+
+class EventSink:
+    """Keep the pending events and flush them in batches. Subclasses write the batches to the file"""
+
+    def __init__(self, path, center_freq, filter_bandwidth, flush_size=10000, flush_time=5.0, dtype=EVENT_DTYPE,
+                 channel_freq=None):
+        self.path = path
+        self.center_freq = center_freq
+        self.filter_bandwidth = filter_bandwidth
+        # Center frequency (Hz) of each channel index, for the channel plans that are not one regular span (see
+        # multi-capture.py). None if the channel <k> is center_freq + k*filter_bandwidth
+        self.channel_freq = np.asarray(channel_freq, dtype=np.float64) if channel_freq is not None else None
+        self.flush_size = flush_size
+        self.flush_time = flush_time
+        self.dtype = dtype
+        # Pending events as <dtype> records, with the linear power (mW) in the power fields
+        self.pending = np.empty(max(flush_size, 1), dtype=dtype)
+        self.pending_count = 0
+        # Number of events received (written + pending)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.last_checkpoint_time = time.monotonic()
+
+    def append(self, time_ns, channel, power):
+        """Add one event : start time (epoch ns), channel index and linear power (mW)"""
+        with self.lock:
+            self.pending[self.pending_count] = (time_ns, channel, power)
+            self.pending_count = self.pending_count + 1
+            self.count = self.count + 1
+            self.check_flush()
+
+    def add(self, time_ns, channel, power):
+        """Add the events given as arrays of start time (epoch ns) and linear power (mW). <channel> can be one
+        channel index for all the events or an array"""
+        with self.lock:
+            start = 0
+            while start < len(time_ns):
+                n = min(len(time_ns) - start, len(self.pending) - self.pending_count)
+                batch = self.pending[self.pending_count:self.pending_count+n]
+                batch['time_ns'] = time_ns[start:start+n]
+                batch['channel'] = channel if np.ndim(channel) == 0 else channel[start:start+n]
+                batch['power'] = power[start:start+n]
+                self.pending_count = self.pending_count + n
+                self.count = self.count + n
+                start = start + n
+                self.check_flush()
+
+    def add_records(self, records):
+        """Add the events given as an array of <dtype> records, with the linear power (mW) in the power fields"""
+        with self.lock:
+            start = 0
+            while start < len(records):
+                n = min(len(records) - start, len(self.pending) - self.pending_count)
+                self.pending[self.pending_count:self.pending_count+n] = records[start:start+n]
+                self.pending_count = self.pending_count + n
+                self.count = self.count + n
+                start = start + n
+                self.check_flush()
+
+    def poll(self):
+        """Flush on time even if no event was received since the last flush"""
+        with self.lock:
+            if time.monotonic() - self.last_checkpoint_time >= self.flush_time:
+                self.flush(True)
+
+    def check_flush(self):
+        if time.monotonic() - self.last_checkpoint_time >= self.flush_time:
+            self.flush(True)
+        elif self.pending_count >= len(self.pending):
+            self.flush(False)
+
+    def flush(self, checkpoint):
+        """Write the pending events. If <checkpoint>, fsync the file to the disk"""
+        if self.pending_count > 0:
+            self.write_events(self.pending[:self.pending_count])
+            self.pending_count = 0
+        if checkpoint:
+            self.checkpoint()
+
+    def checkpoint(self):
+        os.fsync(self.out.fileno())
+        self.last_checkpoint_time = time.monotonic()
+
+    def close(self, metadata=None):
+        """Flush the remaining events and close the file. <metadata> : list of [name, value] rows of the capturing"""
+        with self.lock:
+            if self.out.closed:
+                return
+            self.flush(False)
+            self.finish(metadata)
+            self.checkpoint()
+            self.out.close()
+
+    def finish(self, metadata):
+        pass
+
+
+class CsvEventSink(EventSink):
+    """Append the events to a csv file as text rows"""
+
+    def __init__(self, path, center_freq, filter_bandwidth, flush_size=10000, flush_time=5.0, dtype=EVENT_DTYPE,
+                 channel_freq=None):
+        EventSink.__init__(self, path, center_freq, filter_bandwidth, flush_size, flush_time, dtype, channel_freq)
+        self.out = open(path, 'w', newline='')
+        self.write_rows([BURST_CSV_HEADER if 'end_ns' in dtype.names else CSV_HEADER])
+        self.checkpoint()
+
+    def write_events(self, events):
+        self.write_dbm_records(to_dbm(events))
+
+    def write_dbm_records(self, records):
+        """Format the records (power fields in dBm) as csv rows. The date string is only formatted once per distinct second"""
+        time_ns = records['time_ns']
+        sec, inverse = np.unique(time_ns // 1000000000, return_inverse=True)
+        sec_text = np.array([datetime.fromtimestamp(s).strftime('%Y-%m-%d %H:%M:%S') for s in sec.tolist()])
+        if self.channel_freq is not None:
+            freq = self.channel_freq[records['channel']]
+        else:
+            freq = self.center_freq + records['channel'].astype(np.float64)*self.filter_bandwidth
+        columns = [sec_text[inverse].tolist(), (time_ns % 1000000000).tolist(),
+                   freq.astype(str).tolist(), records['power'].astype(str).tolist()]
+        if 'end_ns' in records.dtype.names:
+            columns = columns + [records['end_ns'].tolist(), ((records['end_ns'] - time_ns)/1e3).tolist(),
+                                 records['peak_power'].astype(str).tolist(), records['count'].tolist()]
+        self.write_rows(zip(*columns))
+
+    def write_rows(self, rows):
+        # Format the whole batch first and write it with one call, so only complete rows reach the file
+        text = io.StringIO()
+        csv.writer(text).writerows(rows)
+        self.out.write(text.getvalue())
+        self.out.flush()
+
+
+class BinaryEventSink(EventSink):
+    """Append the events to a binary file as EVENT_DTYPE records after a json header"""
+
+    def __init__(self, path, center_freq, filter_bandwidth, flush_size=10000, flush_time=5.0, metadata=None,
+                 dtype=EVENT_DTYPE, channel_freq=None):
+        EventSink.__init__(self, path, center_freq, filter_bandwidth, flush_size, flush_time, dtype, channel_freq)
+        self.out = open(path, 'wb')
+        self.data_offset = None
+        self.write_header(metadata)
+        self.checkpoint()
+
+    def write_header(self, metadata):
+        header = {"dtype" : self.dtype.descr,
+                  "center_freq" : self.center_freq,
+                  "filter_bandwidth" : self.filter_bandwidth,
+                  "channel_blocks" : channel_blocks(self.channel_freq, self.filter_bandwidth),
+                  "metadata" : metadata if metadata is not None else []}
+        self.data_offset = write_file_header(self.out, self.path, BINARY_MAGIC, header, self.data_offset)
+
+    def write_events(self, events):
+        self.write_dbm_records(to_dbm(events))
+
+    def write_dbm_records(self, records):
+        """Append the records (power fields in dBm)"""
+        self.out.write(records.tobytes())
+        self.out.flush()
+
+    def finish(self, metadata):
+        # Rewrite the header with the final metadata of the capturing
+        if metadata is not None:
+            self.write_header(metadata)
+
+
+def to_dbm(events):
+    """Copy of the records with the power fields converted from mW to dBm"""
+    records = events.copy()
+    for name in POWER_FIELDS:
+        if name in records.dtype.names:
+            records[name] = 10 * np.log10(events[name])
+    return records
+
+
+def channel_blocks(channel_freq, filter_bandwidth):
+    """Compact form of the channel frequency table kept in the binary header : [first channel, channels, center
+    frequency (Hz) of the first channel] of each block of regularly spaced channels. None without table"""
+    if channel_freq is None:
+        return None
+    block_first = np.flatnonzero(~np.isclose(np.diff(channel_freq, prepend=np.nan), filter_bandwidth))
+    block_size = np.diff(np.append(block_first, len(channel_freq)))
+    return [[int(first), int(size), float(channel_freq[first])] for first, size in zip(block_first, block_size)]
+
+
+def blocks_channel_freq(blocks, filter_bandwidth):
+    """Channel frequency table (Hz) of the blocks of channel_blocks(), None without blocks"""
+    if blocks is None:
+        return None
+    channel_freq = np.empty(sum(size for _, size, _ in blocks))
+    for first, size, freq in blocks:
+        channel_freq[first:first+size] = freq + np.arange(size)*filter_bandwidth
+    return channel_freq
+
+
+def json_value(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def metadata_file_path(path):
+    """Path of the sidecar metadata file of <path>, used when the final metadata does not fit in the header"""
+    return path + '.json'
+
+
+def write_file_header(out, path, magic, header, data_offset=None):
+    """Write the json <header> after <magic> at the start of the file <out> (path <path>) and return the data offset.
+    With <data_offset> None (file just opened), the header room is reserved for the final metadata. Otherwise the
+    header is rewritten in place and its "metadata" is moved to the sidecar file if it does not fit anymore"""
+    text = json.dumps(header, default=json_value).encode()
+    prefix_size = len(magic) + 8
+    if data_offset is None:
+        room = max(HEADER_SIZE, HEADER_ROOM_FACTOR * (prefix_size + len(text) + 1))
+        data_offset = -(-room // 4096) * 4096
+    elif prefix_size + len(text) + 1 > data_offset:
+        with open(metadata_file_path(path), 'w') as f:
+            json.dump(header["metadata"], f, default=json_value)
+        header = dict(header, metadata=[], metadata_file=os.path.basename(metadata_file_path(path)))
+        text = json.dumps(header, default=json_value).encode()
+        if prefix_size + len(text) + 1 > data_offset:
+            raise ValueError("Header too large for the header room of {}".format(path))
+    out.seek(0)
+    out.write(magic + struct.pack('<Q', data_offset) + text + b'\n' + b' ' * (data_offset - prefix_size - len(text) - 1))
+    out.seek(0, os.SEEK_END)
+    out.flush()
+    return data_offset
+
+
+def read_file_header(path, magic, description):
+    """Read the header of a file written with write_file_header(). Return (header, data offset). The metadata of the
+    sidecar file is loaded in the header. <description> : name of the file type for the error message"""
+    with open(path, 'rb') as f:
+        data = f.read(len(magic) + 8)
+        if not data.startswith(magic):
+            raise ValueError("{} is not {}".format(path, description))
+        data_offset = struct.unpack('<Q', data[len(magic):])[0]
+        header = json.loads(f.read(data_offset - f.tell()).decode())
+    if "metadata_file" in header:
+        with open(os.path.join(os.path.dirname(path), header["metadata_file"]), 'r') as f:
+            header["metadata"] = json.load(f)
+    return header, data_offset
+
+
+def read_header(path):
+    """Read the json header of a binary event file"""
+    return read_file_header(path, BINARY_MAGIC, "a binary event file")[0]
+
+
+def load_events(path):
+    """Memory-map the events (or bursts) of a binary event file. Return (header, records)"""
+    header, data_offset = read_file_header(path, BINARY_MAGIC, "a binary event file")
+    dtype = np.dtype([tuple(field) for field in header["dtype"]])
+    # Only the complete records are mapped, in case the capturing was interrupted during a write
+    event_count = (os.path.getsize(path) - data_offset) // dtype.itemsize
+    if event_count <= 0:
+        return header, np.empty(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=(event_count,))
+
+
+def export_csv(path, csv_path, metadata_path=None, chunk_size=1000000):
+    """Convert a binary event file to the csv event format, <chunk_size> events at a time. Optionally write the
+    metadata of the header to <metadata_path>"""
+    header, events = load_events(path)
+    sink = CsvEventSink(csv_path, header["center_freq"], header["filter_bandwidth"], dtype=events.dtype,
+                        channel_freq=blocks_channel_freq(header.get("channel_blocks"), header["filter_bandwidth"]))
+    for start in range(0, len(events), chunk_size):
+        sink.write_dbm_records(events[start:start+chunk_size])
+    sink.close()
+    if metadata_path is not None:
+        with open(metadata_path, 'w', newline='') as out:
+            csv.writer(out).writerows(header["metadata"])
+    return len(events)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Convert a binary event file (<output_filename>.bin, written by channel-capturing.py --format bin) to the csv
+event format, offline.
+
+Input : <output_filename>.bin
+Output :
+    <csv_filename>.csv : Event list, same columns as the csv output of channel-capturing.py
+    Metadata-<csv_filename>.csv : Metadata of the capturing, read from the header of the binary file
+
+Example : python events-to-csv.py example1.bin
+"""
+import argparse
+import os
+
+from event_sink import export_csv
+
+my_parser = argparse.ArgumentParser(prog="events-to-csv", description=__doc__,
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+my_parser.add_argument('input',
+                       metavar='<binary_event_file>',
+                       type=str,
+                       help='Binary event file to convert')
+my_parser.add_argument('-o', '--output',
+                       metavar='<csv_filename>',
+                       type=str,
+                       help='Output csv file name (without .csv). Default to the name of the binary event file')
+args = my_parser.parse_args()
+
+if args.output is None:
+    output_filename = os.path.splitext(args.input)[0]
+else:
+    output_filename = args.output
+output_directory, output_name = os.path.split(output_filename)
+
+event_count = export_csv(args.input, output_filename + '.csv',
+                         os.path.join(output_directory, 'Metadata-' + output_name + '.csv'))
+print("Convert {} events to <{}.csv>".format(event_count, output_filename))
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Hop strategies of channel-capturing.py (--option).
+
+The capture engine dwells on one channel (center frequency center_freq + channel*filter_bandwidth) at a time.
+After each dwell it asks the strategy for the next channel index given the per-channel history. A strategy
+returns None to keep capturing in the current channel without retuning the BB60C.
+
+To add a strategy, subclass HopStrategy, implement next_channel() and register the class in HOP_STRATEGIES.
+The engine loop does not need to be changed.
+"""
+import random
+import numpy as np
+
+
+class ChannelHistory:
+    """Per-channel history of the capturing, updated by the engine after each dwell"""
+
+    def __init__(self, channel_number, num_captures_samefreq):
+        self.channel_number = channel_number
+        self.num_captures_samefreq = num_captures_samefreq
+        # Current channel and the number of buffers over the threshold in its last dwell (None if not known yet)
+        self.current = 0
+        self.last_busy_count = None
+        # Dwells, buffers over the threshold and end time (s, time.perf_counter) of the last dwell of each channel
+        self.dwell_count = np.zeros(channel_number, dtype=np.int64)
+        self.busy_count = np.zeros(channel_number, dtype=np.int64)
+        self.last_visit = np.full(channel_number, np.nan)
+        # Max time (s) each channel went unobserved between two visits (consecutive dwells without retune)
+        self.max_unobserved = np.zeros(channel_number)
+        # Measured mean time (s) of a hop, from the end of a dwell to the start of the dwell in the next channel (the
+        # retune included), and of a dwell with the processing up to the next dwell. None until measured
+        self.retune_time = None
+        self.dwell_time = None
+        self.hop_count = 0
+        self.timed_dwell_count = 0
+        self.last_end = None
+
+    def record_retune(self, seconds):
+        # The retune time is the estimate of the hop time until a hop is measured
+        if self.hop_count == 0:
+            self.retune_time = seconds
+
+    def record_dwell(self, channel, end_time, start_time=None):
+        if start_time is not None:
+            if not np.isnan(self.last_visit[channel]):
+                self.max_unobserved[channel] = max(self.max_unobserved[channel], start_time - self.last_visit[channel])
+            if self.last_end is not None and channel != self.current:
+                self.hop_count = self.hop_count + 1
+                self.retune_time = self.retune_time + (start_time - self.last_end - self.retune_time)/self.hop_count
+            self.timed_dwell_count = self.timed_dwell_count + 1
+            dwell_time = end_time - (self.last_end if self.last_end is not None and channel == self.current else start_time)
+            self.dwell_time = dwell_time if self.dwell_time is None else self.dwell_time + (dwell_time - self.dwell_time)/self.timed_dwell_count
+            self.last_end = end_time
+        self.current = channel
+        self.dwell_count[channel] = self.dwell_count[channel] + 1
+        self.last_visit[channel] = end_time
+
+    def record_busy(self, channel, busy_count):
+        self.last_busy_count = busy_count
+        self.busy_count[channel] = self.busy_count[channel] + busy_count
+
+
+class HopStrategy:
+    """Base class of the hop strategies"""
+
+    # True if next_channel() needs the busy count of the last dwell. With the processing threads (--threads), the
+    # engine then waits for the dwell to be processed before choosing the next channel
+    needs_feedback = False
+
+    def __init__(self, channel_number, num_captures_samefreq, settings):
+        self.channel_number = channel_number
+        self.num_captures_samefreq = num_captures_samefreq
+        self.settings = settings
+
+    def next_channel(self, history):
+        """Return the next channel index, or None to stay in the current channel without retuning"""
+        raise NotImplementedError
+
+
+class FixedStrategy(HopStrategy):
+    """No hopping, capturing in the same frequency"""
+
+    def next_channel(self, history):
+        return None
+
+
+class SweepStrategy(HopStrategy):
+    """Sweep through channels through the whole span in order"""
+
+    def next_channel(self, history):
+        return (history.current+1) % self.channel_number
+
+
+class RandSweepStrategy(HopStrategy):
+    """Randomly hop through channels with equally distributed probability"""
+
+    def next_channel(self, history):
+        return random.randrange(self.channel_number)
+
+
+class HopIfNotBusyStrategy(HopStrategy):
+    """Randomly hop to another channel only if the channel is not busy (occupancy rate less than occupancy_threshold)"""
+
+    needs_feedback = True
+
+    def __init__(self, channel_number, num_captures_samefreq, settings):
+        HopStrategy.__init__(self, channel_number, num_captures_samefreq, settings)
+        self.occupancy_threshold = settings["occupancy_threshold"]
+        self.started = False
+
+    def is_busy(self, history):
+        # The first decision considers the channel busy
+        if not self.started:
+            self.started = True
+            return True
+        return (history.last_busy_count/self.num_captures_samefreq) >= self.occupancy_threshold
+
+    def next_channel(self, history):
+        if self.is_busy(history):
+            # Channel busy
+            return None
+        # Channel not busy, hop
+        return random.randrange(self.channel_number)
+
+
+class HopWithPStrategy(HopIfNotBusyStrategy):
+    """Stay in current frequency with the probability p_samefreq for busy channel, otherwise randomly hop to other channel"""
+
+    def __init__(self, channel_number, num_captures_samefreq, settings):
+        HopIfNotBusyStrategy.__init__(self, channel_number, num_captures_samefreq, settings)
+        self.p_samefreq = settings["p_samefreq"]
+
+    def next_channel(self, history):
+        if self.is_busy(history):
+            # Channel busy, stay in same freq with probability p_samefreq
+            if random.uniform(0, 1) <= self.p_samefreq:
+                return None
+        # Channel not busy (or leaving the busy channel), hop
+        return random.randrange(self.channel_number)
+
+
+class BanditStrategy(HopStrategy):
+    """Thompson sampling over the activity of the channels : the fraction of buffers over the threshold of each channel
+    has a Beta posterior, a sample is drawn from each posterior after each dwell and the channel with the highest sample
+    is captured next (staying in the current channel without retuning if it wins). The busy channels get most of the
+    dwells while the uncertain ones are still tried. The counts decay by <bandit_discount> per dwell so the posteriors
+    follow the changes of activity, and with the probability <bandit_exploration> the next channel is drawn uniformly,
+    so every channel keeps being visited"""
+
+    needs_feedback = True
+
+    def __init__(self, channel_number, num_captures_samefreq, settings):
+        HopStrategy.__init__(self, channel_number, num_captures_samefreq, settings)
+        self.exploration = settings["bandit_exploration"]
+        self.discount = settings["bandit_discount"]
+        # Discounted buffers over and under the threshold of each channel
+        self.busy = np.zeros(channel_number)
+        self.idle = np.zeros(channel_number)
+
+    def next_channel(self, history):
+        self.busy = self.busy * self.discount
+        self.idle = self.idle * self.discount
+        self.busy[history.current] = self.busy[history.current] + history.last_busy_count
+        self.idle[history.current] = self.idle[history.current] + self.num_captures_samefreq - history.last_busy_count
+        if random.uniform(0, 1) < self.exploration:
+            channel = random.randrange(self.channel_number)
+        else:
+            channel = int(np.argmax(np.random.beta(1 + self.busy, 1 + self.idle)))
+        if channel == history.current:
+            return None
+        return channel
+
+
+class DeadlineStrategy(HopStrategy):
+    """Earliest deadline first over the max revisit interval of each channel : a channel must be visited again at
+    most <revisit_interval> (s) after the end of its last visit. The deadlines are checked with the processor demand
+    criterion of EDF over the measured retune and dwell times, with a margin of <revisit_margin> of the interval
+    against their jitter. The strategy stays in the current channel as long as all the deadlines can still be met
+    after one more dwell here. Otherwise it hops to the channel whose visit leaves the most slack, which is the
+    earliest deadline when the deadlines are tight, so a channel with a short interval is not revisited earlier than
+    needed at the expense of the others. The channels not visited yet are due <revisit_interval> after the first
+    decision"""
+
+    def __init__(self, channel_number, num_captures_samefreq, settings):
+        HopStrategy.__init__(self, channel_number, num_captures_samefreq, settings)
+        self.revisit_interval = np.broadcast_to(np.asarray(settings["revisit_interval"], dtype=np.float64), (channel_number,))
+        self.margin = settings["revisit_margin"]*self.revisit_interval
+        self.start_time = None
+
+    def slack(self, end, deadline, candidates, dwell_time, retune_time):
+        """Min slack (s) of the deadlines <deadline> if the next dwell is in the channel c and ends at <end>, for each
+        channel c of <candidates>. For every deadline H up to the last one, the visits (retune and dwell) due by H,
+        the repeated visits of the channels with a short interval included, must start before H"""
+        period = self.revisit_interval - self.margin + dwell_time
+        # Deadlines and periods of the channels, then of the candidates after their visit
+        all_deadline = np.concatenate((deadline, end + self.revisit_interval[candidates] - self.margin[candidates]))
+        all_period = np.concatenate((period, period[candidates]))
+        count = np.floor((all_deadline.max() - all_deadline)/all_period).astype(np.int64) + 1
+        within = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count)
+        horizon = np.repeat(all_deadline, count) + np.repeat(all_period, count)*within
+        due = np.where(horizon[:, None] >= all_deadline, np.floor((horizon[:, None] - all_deadline)/all_period) + 1, 0)
+        total = due[:, :self.channel_number].sum(axis=1)[:, None] - due[:, candidates] + due[:, self.channel_number:]
+        return np.min(horizon[:, None] - (end + total*(retune_time + dwell_time) - dwell_time), axis=0)
+
+    def next_channel(self, history):
+        now = history.last_visit[history.current]
+        if self.start_time is None:
+            self.start_time = now
+        retune_time = history.retune_time if history.retune_time is not None else 0.0
+        dwell_time = history.dwell_time if history.dwell_time is not None else 0.0
+        deadline = np.where(np.isnan(history.last_visit), self.start_time, history.last_visit) + self.revisit_interval - self.margin
+        # The strategy only stays once a hop is measured, the retune time alone underestimates it
+        current = np.array([history.current])
+        if history.hop_count > 0 and self.slack(now + dwell_time, deadline, current, dwell_time, retune_time)[0] >= 0:
+            return None
+        others = np.delete(np.arange(self.channel_number), history.current)
+        others = others[np.argsort(deadline[others], kind='stable')]
+        return int(others[np.argmax(self.slack(now + retune_time + dwell_time, deadline, others, dwell_time, retune_time))])
+
+
+def deadline_utilization(revisit_interval, dwell_time, retune_time):
+    """Fraction of the time needed to meet the max revisit intervals <revisit_interval> (s, per channel) with visits
+    of one retune and one dwell : a channel is visited at least once per dwell + revisit interval. The deadlines can
+    not all be met over 1"""
+    return float(np.sum((dwell_time + retune_time) / (np.asarray(revisit_interval, dtype=np.float64) + dwell_time)))
+
+
+HOP_STRATEGIES = {
+    'fixed' : FixedStrategy,
+    'sweep' : SweepStrategy,
+    'rand-sweep' : RandSweepStrategy,
+    'hop-ifnot-busy' : HopIfNotBusyStrategy,
+    'hop-with-p' : HopWithPStrategy,
+    'bandit' : BanditStrategy,
+    'deadline' : DeadlineStrategy,
+}
+
+
+def make_strategy(name, channel_number, num_captures_samefreq, settings):
+    return HOP_STRATEGIES[name](channel_number, num_captures_samefreq, settings)
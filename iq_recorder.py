@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Raw IQ recording of channel-capturing.py (--record), replayed offline by bb_replay.py (--device replay).
+
+Every IQ read of the capture engine is appended as is to the recording, so the detection (threshold, buffer
+duration, window, coalescing, hop strategy) can be re-evaluated later on the same signals. The samples flushed
+after each retune are not recorded.
+
+Files :
+    <output_filename>.iq  : a json header (see write_file_header() in event_sink.py) followed by the raw samples of
+                            all the reads, in capture order : complex64, or int16 (I, Q) pairs with --iq16. The samples are written
+                            through a large write buffer, so the disk sees long sequential writes.
+                            The header has the IQ dtype, the decimation, the capture bandwidth and the metadata of
+                            the capturing (the same rows as Metadata-<output_filename>.csv).
+    <output_filename>.iqm : the markers, one MARKER_DTYPE record per read : sample offset of the read in the IQ
+                            data, number of samples, IQ center frequency (Hz), timestamp of the first sample
+                            (epoch ns), sample loss flag and the correction of the 16-bit IQ (1 with complex64).
+                            A change of center frequency between two markers is a retune.
+
+Use load_recording() to memory-map a recording.
+"""
+import os
+
+import numpy as np
+
+from event_sink import write_file_header, read_file_header
+
+RECORDING_MAGIC = b'SASIQREC'
+
+MARKER_DTYPE = np.dtype([('offset', '<i8'), ('count', '<i8'), ('center_freq', '<f8'), ('time_ns', '<i8'),
+                         ('sample_loss', 'u1'), ('correction', '<f4')])
+
+# Size (bytes) of the write buffer of the IQ file
+WRITE_BUFFER_SIZE = 16 << 20
+
+
+def markers_path(path):
+    """Path of the marker file of the IQ recording <path>"""
+    return os.path.splitext(path)[0] + '.iqm'
+
+
+class IqRecorder:
+    """Append the raw IQ reads and their markers to the recording <path>"""
+
+    def __init__(self, path, iq_dtype, decimation, bandwidth, metadata=None):
+        self.path = path
+        self.iq_dtype = np.dtype(iq_dtype)
+        self.decimation = decimation
+        self.bandwidth = bandwidth
+        self.out = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.markers = open(markers_path(path), 'wb')
+        self.data_offset = None
+        self.write_header(metadata)
+        # Number of samples recorded
+        self.sample_count = 0
+
+    def write_header(self, metadata):
+        header = {"dtype" : self.iq_dtype.str,
+                  "decimation" : self.decimation,
+                  "bandwidth" : self.bandwidth,
+                  "metadata" : metadata if metadata is not None else []}
+        self.data_offset = write_file_header(self.out, self.path, RECORDING_MAGIC, header, self.data_offset)
+
+    def record(self, iq, center_freq, time_ns, sample_loss, correction=1.0):
+        """Append the samples of one read : the IQ array <iq> (C contiguous) read at <center_freq> (Hz) and the
+        timestamp (epoch ns) of its first sample"""
+        self.out.write(iq.data)
+        marker = np.array([(self.sample_count, len(iq), center_freq, time_ns, sample_loss, correction)], dtype=MARKER_DTYPE)
+        self.markers.write(marker.tobytes())
+        self.sample_count = self.sample_count + len(iq)
+
+    def close(self, metadata=None):
+        """Flush and close the recording. <metadata> : list of [name, value] rows of the capturing"""
+        if self.out.closed:
+            return
+        if metadata is not None:
+            self.out.flush()
+            self.write_header(metadata)
+        self.out.close()
+        self.markers.close()
+
+
+def load_recording(path):
+    """Memory-map an IQ recording. Return (header, iq, markers). <iq> is complex64 of shape (samples,) or int16 of
+    shape (samples, 2)"""
+    header, data_offset = read_file_header(path, RECORDING_MAGIC, "an IQ recording")
+    iq_dtype = np.dtype(header["dtype"])
+    markers = np.fromfile(markers_path(path), dtype=MARKER_DTYPE)
+    # Only the reads completely written are replayed, in case the capturing was interrupted during a write
+    sample_shape = (2,) if iq_dtype == np.int16 else ()
+    sample_size = iq_dtype.itemsize * int(np.prod(sample_shape))
+    sample_count = (os.path.getsize(path) - data_offset) // sample_size
+    markers = markers[markers['offset'] + markers['count'] <= sample_count]
+    if sample_count <= 0:
+        return header, np.empty((0,) + sample_shape, dtype=iq_dtype), markers
+    iq = np.memmap(path, dtype=iq_dtype, mode='r', offset=data_offset, shape=(sample_count,) + sample_shape)
+    return header, iq, markers
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Capture channel activity with several BB60C at the same time, e.g. to cover 2.4 GHz and 5 GHz together.
+
+The channel plan (one or more bands of <filter_bandwidth> channels) is partitioned across the devices : each
+band gets at least one device, the remaining devices go to the bands with the most channels per device, and the
+channels of a band are split into contiguous blocks, one per device. One channel-capturing.py worker process runs
+per device (opened by its serial number, --serial), with binary event output. When all the workers are done, their
+event files are merged into one time-ordered output by a k-way merge on the timestamps.
+
+Output :
+    <output_filename>.csv (or .bin) : Events of all the devices in time order. The channel indices are the indices of
+                                      the whole channel plan
+    Metadata-<output_filename>.csv : Settings of the coordinator and the summary of each device
+    Devices-<output_filename>.csv : Center frequency of each channel and the device (serial number) observing it
+    <output_filename>-<serial>.bin, Metadata-<output_filename>-<serial>.csv, Stats-... : outputs of each worker
+
+Arguments not handled by the coordinator (duration, threshold, decimation, sweep option...) are passed to all
+the workers with --extra.
+
+Example : python multi-capture.py --serial 123 456 --band 2400 80 --band 5150 200 -o example1 --extra "-t 60 -d 8"
+"""
+import argparse
+import os
+import sys
+import csv
+import math
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+from event_sink import CsvEventSink, BinaryEventSink, load_events
+
+script_directory = os.path.dirname(os.path.abspath(__file__))
+
+# Events read from each worker file per step of the merge
+merge_chunk_size = 1000000
+
+
+def read_metadata(path):
+    with open(path, 'r', newline='') as f:
+        return {row[0] : row[1] for row in csv.reader(f) if len(row) >= 2}
+
+
+def partition_plan(bands, filter_bandwidth, serials):
+    """Split the channels of the <bands> ((center_freq, span) in MHz) across the devices <serials>. Return the
+    blocks of the plan : (serial, center frequency (MHz) of the first channel, channels)"""
+    band_channels = [math.ceil(span/filter_bandwidth) for _, span in bands]
+    devices_per_band = [1] * len(bands)
+    for _ in range(len(serials) - len(bands)):
+        band = max(range(len(bands)), key=lambda b : band_channels[b]/devices_per_band[b])
+        devices_per_band[band] = devices_per_band[band] + 1
+    blocks = []
+    serial_index = 0
+    for (freq, _), channels, devices in zip(bands, band_channels, devices_per_band):
+        for block in np.array_split(np.arange(channels), devices):
+            if len(block) > 0:
+                blocks.append((serials[serial_index], freq + block[0]*filter_bandwidth, len(block)))
+            else:
+                print("Warning : device {} has no channel to observe".format(serials[serial_index]))
+            serial_index = serial_index + 1
+    return blocks
+
+
+def merge_events(sources, sink):
+    """Write the events of the worker files <sources> ((path, first channel of the worker in the plan)) to <sink> in
+    time order. Return the number of events of each source"""
+    readers = []
+    for path, first_channel in sources:
+        _, events = load_events(path)
+        # The coalesced bursts and the events of the processing threads are not written in time order
+        time_ns = events['time_ns']
+        order = None if np.all(time_ns[1:] >= time_ns[:-1]) else np.argsort(time_ns, kind='stable')
+        readers.append({"events" : events, "order" : order, "position" : 0, "first_channel" : first_channel})
+
+    # k-way merge by blocks : the events of all the workers up to the smallest last timestamp of their current
+    # chunks are complete, and are written sorted. The worker with this smallest timestamp moves to its next chunk
+    while True:
+        active = [reader for reader in readers if reader["position"] < len(reader["events"])]
+        if not active:
+            break
+        chunks = []
+        for reader in active:
+            start = reader["position"]
+            if reader["order"] is None:
+                chunks.append(reader["events"][start:start+merge_chunk_size])
+            else:
+                chunks.append(reader["events"][reader["order"][start:start+merge_chunk_size]])
+        bound = min(chunk['time_ns'][-1] for chunk in chunks)
+        parts = []
+        for reader, chunk in zip(active, chunks):
+            n = np.searchsorted(chunk['time_ns'], bound, side='right')
+            part = np.array(chunk[:n])
+            part['channel'] = part['channel'] + reader["first_channel"]
+            parts.append(part)
+            reader["position"] = reader["position"] + n
+        merged = np.concatenate(parts)
+        sink.write_dbm_records(merged[np.argsort(merged['time_ns'], kind='stable')])
+    return [len(reader["events"]) for reader in readers]
+
+
+my_parser = argparse.ArgumentParser(prog="multi-capture", description=__doc__,
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+my_parser.add_argument('--serial',
+                       metavar='<serial_number>',
+                       type=int,
+                       nargs='+',
+                       required=True,
+                       help='Serial numbers of the BB60C used, one worker per device')
+my_parser.add_argument('--band',
+                       metavar=('<center_freq>', '<span>'),
+                       type=float,
+                       nargs=2,
+                       action='append',
+                       required=True,
+                       help='Band of the channel plan : center frequency (MHz) of its first channel and span (MHz). Can be repeated')
+my_parser.add_argument('-fb', '--filter_bandwidth',
+                       metavar='<filter_bandwidth>',
+                       type=float,
+                       default=3.75,
+                       help='Bandwidth (MHz) of the channels, passed to the workers. Default to 3.75 MHz')
+my_parser.add_argument('-o', '--output',
+                       metavar='<output_filename>',
+                       type=str,
+                       help='Set the output file name. Default name will be py-multi-out-<current time>')
+my_parser.add_argument('--format',
+                       metavar='<event_format>',
+                       type=str,
+                       choices=['csv', 'bin'],
+                       default='csv',
+                       help='Format of the merged event file. Default to csv')
+my_parser.add_argument('--extra',
+                       metavar='"<arguments>"',
+                       type=str,
+                       default='',
+                       help='Extra arguments passed to channel-capturing.py for every worker')
+args = my_parser.parse_args()
+
+if args.output is None:
+    output_filename = 'py-multi-out-' + datetime.now().strftime("%m-%d-%y-%Hh-%Mm-%Ss")
+else:
+    output_filename = args.output
+
+if len(args.serial) < len(args.band):
+    sys.exit("At least one device per band is needed")
+plan = partition_plan(args.band, args.filter_bandwidth, args.serial)
+
+# Start one worker per device. The span given to a worker is short of half a channel so that it rounds up to its
+# number of channels whatever the float rounding
+workers = []
+for serial, freq, channels in plan:
+    worker_output = '{}-{}'.format(output_filename, serial)
+    command = [sys.executable, os.path.join(script_directory, 'channel-capturing.py'),
+               '--serial', str(serial), '-f', str(freq), '-s', str((channels - 0.5)*args.filter_bandwidth),
+               '-fb', str(args.filter_bandwidth), '-o', worker_output, '--format', 'bin'] + args.extra.split()
+    print("Device {} : {} channels from {} MHz".format(serial, channels, freq))
+    workers.append((serial, freq, channels, worker_output, subprocess.Popen(command, stdout=subprocess.DEVNULL)))
+
+# Ctrl+C is also received by the workers, which close their device and write their output
+return_codes = []
+for worker in workers:
+    while True:
+        try:
+            return_codes.append(worker[4].wait())
+            break
+        except KeyboardInterrupt:
+            print("Waiting for the workers to write their output ...")
+
+# Channel plan : first channel of each worker in the whole plan and center frequency (Hz) of each channel
+first_channels = np.cumsum([0] + [channels for _, _, channels, _, _ in workers])[:-1]
+channel_freq = np.concatenate([(freq + np.arange(channels)*args.filter_bandwidth)*1e6 for _, freq, channels, _, _ in workers])
+sources = []
+for (serial, _, _, worker_output, _), first_channel, return_code in zip(workers, first_channels, return_codes):
+    if not os.path.exists(worker_output + '.bin'):
+        print("Warning : device {} worker failed (exit code {}), no output".format(serial, return_code))
+        continue
+    sources.append((worker_output + '.bin', first_channel))
+if not sources:
+    sys.exit("No worker output to merge")
+
+event_dtype = load_events(sources[0][0])[1].dtype
+if args.format == 'bin':
+    sink = BinaryEventSink(output_filename + '.bin', channel_freq[0], args.filter_bandwidth*1e6, dtype=event_dtype,
+                           channel_freq=channel_freq)
+else:
+    sink = CsvEventSink(output_filename + '.csv', channel_freq[0], args.filter_bandwidth*1e6, dtype=event_dtype,
+                        channel_freq=channel_freq)
+event_counts = merge_events(sources, sink)
+
+# Unified metadata : settings of the coordinator and the summary of each device, read from the metadata of its worker
+metadata = [['Devices', len(workers)],
+            ['Bands (center freq of the first channel MHz, span MHz)', args.band],
+            ['Filter Bandwidth (MHz)', args.filter_bandwidth],
+            ['Total channels', len(channel_freq)],
+            ['Worker arguments', args.extra],
+            ['Channel device table', 'Devices-' + output_filename + '.csv'],
+            ['Merged events', sum(event_counts)]]
+for (serial, freq, channels, worker_output, _), return_code in zip(workers, return_codes):
+    metadata.append(['Device {} channels (MHz)'.format(serial), '{} - {}'.format(freq, freq + (channels - 1)*args.filter_bandwidth)])
+    metadata.append(['Device {} exit code'.format(serial), return_code])
+    worker_metadata_path = 'Metadata-' + worker_output + '.csv'
+    if os.path.exists(worker_metadata_path):
+        worker_metadata = read_metadata(worker_metadata_path)
+        for name in ['Events', 'Throughput (buffers/s)', 'Duty cycle (%)']:
+            if name in worker_metadata:
+                metadata.append(['Device {} {}'.format(serial, name), worker_metadata[name]])
+sink.close(metadata)
+
+with open("Metadata-" + output_filename + '.csv', 'w', newline='') as out:
+    csv.writer(out).writerows(metadata)
+
+with open("Devices-" + output_filename + '.csv', 'w', newline='') as out:
+    csv_output = csv.writer(out)
+    csv_output.writerow(['Channel', 'Center Freq (MHz)', 'Device serial', 'Worker output'])
+    for (serial, _, channels, worker_output, _), first_channel in zip(workers, first_channels):
+        for k in range(channels):
+            csv_output.writerow([first_channel + k, channel_freq[first_channel + k]/1e6, serial, worker_output])
+
+print("Merge {} events of {} devices to the output {} <{}> file".format(sum(event_counts), len(sources), args.format, output_filename))
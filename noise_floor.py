@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive per-channel noise floor of channel-capturing.py (--adaptive).
+
+The noise floor of each channel is tracked online, dwell by dwell :
+    - the noise estimate of a dwell is the median power (dBm) of its buffers under the current threshold of the
+      channel (the buffers over the threshold are signal and are excluded)
+    - the noise floor is an exponentially weighted moving average (in dB) of these estimates with weight <alpha>
+    - the threshold of the channel is updated to (noise floor + <offset_db>)
+The first dwell of a channel initializes the noise floor with the lower quartile of all its buffers, which stays
+on the noise as long as the channel is less than 75 % occupied, whatever the initial threshold.
+
+The thresholds are kept in an array (mW) indexed by channel, shared with the detection and updated in place.
+"""
+import threading
+import numpy as np
+
+
+class NoiseFloorTracker:
+    """Track the noise floor of each channel and update the per-channel <threshold> array (mW) in place"""
+
+    def __init__(self, threshold, offset_db, alpha=0.1):
+        self.threshold = threshold
+        self.offset_db = offset_db
+        self.alpha = alpha
+        # Noise floor (dBm) of each channel, nan until the first dwell of the channel
+        self.floor = np.full(len(threshold), np.nan)
+        self.lock = threading.Lock()
+
+    def update(self, channels, power):
+        """Update with the avg power (mW) of the buffers of one dwell, as an array (buffers, channels) for the channel indices <channels>"""
+        power_db = 10 * np.log10(power)
+        with self.lock:
+            for k, channel in enumerate(channels):
+                if np.isnan(self.floor[channel]):
+                    self.floor[channel] = np.percentile(power_db[:, k], 25)
+                else:
+                    quiet = power_db[power[:, k] < self.threshold[channel], k]
+                    if len(quiet) == 0:
+                        continue
+                    self.floor[channel] = self.floor[channel] + self.alpha * (np.median(quiet) - self.floor[channel])
+                self.threshold[channel] = 10 ** ((self.floor[channel] + self.offset_db)/10)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Occupancy analytics of large event files of channel-capturing.py, offline.
+
+The event file (csv or binary, events or coalesced bursts) is read in chunks fanned out over a pool of processes.
+Each chunk gives partial aggregates that are summed, so the memory stays bounded by the chunk size and the run
+time scales with the number of cores (see event_analytics.py).
+
+Input : <output_filename>.csv or <output_filename>.bin. The buffer (or window) duration of the events is read from
+        Metadata-<output_filename>.csv if found, or given with --duration
+Output :
+    <analysis_filename>-occupancy.csv : events, busy time (s) and occupancy (% of the time bin) of each channel in
+                                        each time bin
+    <analysis_filename>-bursts.csv : histogram of the burst durations of each channel
+    <analysis_filename>-power.csv : histogram of the event power (dBm) of each channel
+
+The occupancy is the busy time over the length of the time bin : with the sweep options, a channel is only
+observed part of the time (see the duty cycle in the Metadata file).
+
+Example : python occupancy-analysis.py example1.bin --bin 300 -j 8
+"""
+import argparse
+import os
+import csv
+import functools
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from event_analytics import plan_chunks, analyze_chunk, merge_partials, DURATION_EDGES_US, POWER_EDGES_DBM
+
+
+def read_metadata(path):
+    with open(path, 'r', newline='') as f:
+        return {row[0] : row[1] for row in csv.reader(f) if len(row) >= 2}
+
+
+def event_duration_us(input_path):
+    """Duration (us) of the events from the Metadata file of the capturing : the window duration with --window, else
+    the buffer duration. None if not found (no Metadata file, or the Metadata of multi-capture.py)"""
+    directory, name = os.path.split(os.path.splitext(input_path)[0])
+    metadata_path = os.path.join(directory, 'Metadata-' + name + '.csv')
+    if not os.path.exists(metadata_path):
+        return None
+    metadata = read_metadata(metadata_path)
+    if 'Window size/min event size (samples)' in metadata:
+        return float(metadata['Window size/min event size (samples)']) / float(metadata['Sampling Rate (M/s)'])
+    if 'Buffer duration/min event size (us))' in metadata:
+        return float(metadata['Buffer duration/min event size (us))'])
+    return None
+
+
+if __name__ == '__main__':
+    my_parser = argparse.ArgumentParser(prog="occupancy-analysis", description=__doc__,
+                                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    my_parser.add_argument('input',
+                           metavar='<event_file>',
+                           type=str,
+                           help='Event file (.csv or .bin) to analyze')
+    my_parser.add_argument('--bin',
+                           metavar='<time_bin>',
+                           type=float,
+                           default=60.0,
+                           help='Length (s) of the occupancy time bins. Default to 60s')
+    my_parser.add_argument('--duration',
+                           metavar='<event_duration>',
+                           type=float,
+                           help='Duration (us) of an event (buffer or window duration). Default read from the Metadata file of the capturing, or 50us')
+    my_parser.add_argument('--gap',
+                           metavar='<gap_tolerance>',
+                           type=float,
+                           default=0.0,
+                           help='Without --coalesce in the capturing, the events of a channel less than <gap_tolerance> (us) apart are chained into one burst. Default to 0 us')
+    my_parser.add_argument('--chunksize',
+                           metavar='<events>',
+                           type=int,
+                           default=1000000,
+                           help='Events per chunk. Default to 1000000')
+    my_parser.add_argument('-j', '--jobs',
+                           metavar='<jobs>',
+                           type=int,
+                           default=os.cpu_count(),
+                           help='Number of processes. Default to the number of cores')
+    my_parser.add_argument('-o', '--output',
+                           metavar='<analysis_filename>',
+                           type=str,
+                           help='Output file name prefix. Default to the name of the event file')
+    args = my_parser.parse_args()
+
+    event_format = 'bin' if args.input.endswith('.bin') else 'csv'
+    output_filename = args.output if args.output is not None else os.path.splitext(args.input)[0]
+    duration_us = args.duration if args.duration is not None else event_duration_us(args.input)
+    if duration_us is None:
+        duration_us = 50.0
+        print("Event duration not found in the Metadata, the event duration is {} us".format(duration_us))
+    bin_ns = int(args.bin * 1e9)
+
+    chunks = plan_chunks(args.input, event_format, args.chunksize)
+    tasks = [(args.input, event_format, start, stop, bin_ns, int(duration_us * 1e3), int(args.gap * 1e3)) for start, stop in chunks]
+    print("Analyze <{}> in {} chunks with {} processes".format(args.input, len(tasks), args.jobs))
+    total = {"occupancy" : {}, "bursts" : {}, "power" : {}}
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        total = functools.reduce(merge_partials, executor.map(analyze_chunk, tasks), total)
+
+    with open(output_filename + '-occupancy.csv', 'w', newline='') as out:
+        csv_output = csv.writer(out)
+        csv_output.writerow(['Center Freq (MHz)', 'Bin start time', 'Events', 'Busy time (s)', 'Occupancy (%)'])
+        for (freq, time_bin), (events, busy_ns) in sorted(total["occupancy"].items()):
+            bin_start = datetime.fromtimestamp(time_bin * bin_ns / 1e9).strftime('%Y-%m-%d %H:%M:%S')
+            csv_output.writerow([freq/1e6, bin_start, events, busy_ns/1e9, 100 * busy_ns / bin_ns])
+
+    with open(output_filename + '-bursts.csv', 'w', newline='') as out:
+        csv_output = csv.writer(out)
+        csv_output.writerow(['Center Freq (MHz)'] + ['{:g}-{:g} us'.format(a, b) for a, b in zip(DURATION_EDGES_US[:-1], DURATION_EDGES_US[1:])])
+        for freq in sorted(total["bursts"]):
+            csv_output.writerow([freq/1e6] + total["bursts"][freq].tolist())
+
+    with open(output_filename + '-power.csv', 'w', newline='') as out:
+        csv_output = csv.writer(out)
+        csv_output.writerow(['Center Freq (MHz)'] + ['{:g} dBm'.format(a) for a in POWER_EDGES_DBM[:-1]])
+        for freq in sorted(total["power"]):
+            csv_output.writerow([freq/1e6] + total["power"][freq].tolist())
+
+    print("{:>20}{:>12}{:>12}{:>20}".format('Center Freq (MHz)', 'Events', 'Bursts', 'Busy time (s)'))
+    for freq in sorted(total["power"]):
+        busy_ns = sum(counts[1] for (f, _), counts in total["occupancy"].items() if f == freq)
+        print("{:>20}{:>12}{:>12}{:>20.6f}".format(freq/1e6, total["power"][freq].sum(), total["bursts"][freq].sum(), busy_ns/1e9))
+    print("Write the occupancy, bursts and power of <{}> to <{}-*.csv>".format(args.input, output_filename))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Re-apply other thresholds to the power log of a capturing (<output_filename>.pwr, written by channel-capturing.py
+--powerlog), offline.
+
+The power log is memory-mapped and all the thresholds are applied in one pass over it (see power_log.py).
+
+Input : <output_filename>.pwr
+Output :
+    table of the occupancy and coalesced bursts of all the channels for each threshold
+    <csv_filename>.csv : one row per threshold and channel : threshold (dBm), channel center frequency (MHz),
+                         buffers observed, buffers over the threshold (events without --coalesce), occupancy (%)
+                         and coalesced bursts (events with --coalesce, without hysteresis)
+
+Example : python power-log-threshold.py example1.pwr --range -80 -50 2 --gap 100
+"""
+import argparse
+import os
+import csv
+
+import numpy as np
+
+from power_log import rethreshold
+
+my_parser = argparse.ArgumentParser(prog="power-log-threshold", description=__doc__,
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+my_parser.add_argument('input',
+                       metavar='<power_log>',
+                       type=str,
+                       help='Power log to re-threshold')
+my_parser.add_argument('-th', '--threshold',
+                       metavar='<Threshold>',
+                       type=float,
+                       nargs='+',
+                       help='Thresholds (dBm) applied')
+my_parser.add_argument('--range',
+                       metavar=('<min>', '<max>', '<step>'),
+                       type=float,
+                       nargs=3,
+                       help='Thresholds (dBm) applied from <min> to <max> (included) by <step>')
+my_parser.add_argument('--gap',
+                       metavar='<gap_tolerance>',
+                       type=float,
+                       default=0.0,
+                       help='Gaps (us) under the threshold up to <gap_tolerance> are bridged inside a burst, like --gap of channel-capturing.py. Default to 0 us')
+my_parser.add_argument('-o', '--output',
+                       metavar='<csv_filename>',
+                       type=str,
+                       help='Output csv file name (without .csv). Default to <power_log>-thresholds')
+args = my_parser.parse_args()
+
+thresholds = []
+if args.threshold is not None:
+    thresholds = thresholds + args.threshold
+if args.range is not None:
+    thresholds = thresholds + np.arange(args.range[0], args.range[1] + args.range[2]/2, args.range[2]).round(6).tolist()
+if not thresholds:
+    my_parser.error('no threshold given (-th or --range)')
+
+if args.output is None:
+    output_filename = os.path.splitext(args.input)[0] + '-thresholds'
+else:
+    output_filename = args.output
+
+header, result = rethreshold(args.input, thresholds, int(args.gap*1e3))
+
+print('{:>16}{:>16}{:>16}{:>16}'.format('Threshold (dBm)', 'Occupancy (%)', 'Busy buffers', 'Bursts'))
+for t, threshold in enumerate(thresholds):
+    units = np.sum(result["units"][t])
+    busy = np.sum(result["busy"][t])
+    print('{:>16.2f}{:>16.3f}{:>16}{:>16}'.format(threshold, 100*busy/max(units, 1), busy, np.sum(result["bursts"][t])))
+
+with open(output_filename + '.csv', 'w', newline='') as out:
+    csv_output = csv.writer(out)
+    csv_output.writerow(['Threshold (dBm)', 'Center Freq (MHz)', 'Buffers', 'Busy buffers', 'Occupancy (%)', 'Bursts'])
+    for t, threshold in enumerate(thresholds):
+        for channel in range(header["channel_number"]):
+            units = result["units"][t, channel]
+            busy = result["busy"][t, channel]
+            csv_output.writerow([threshold, (header["center_freq"] + channel*header["filter_bandwidth"])/1e6,
+                                 units, busy, 100*busy/units if units > 0 else 0.0, result["bursts"][t, channel]])
+print("Write the thresholds of {} to <{}.csv>".format(args.input, output_filename))
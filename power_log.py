@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Power log of channel-capturing.py (--powerlog) : the avg power of every buffer (or window), over the threshold or not,
+so the thresholding can be re-applied offline with other threshold values (see power-log-threshold.py).
+
+Files :
+    <output_filename>.pwr  : a json header (see write_file_header() in event_sink.py) followed by one POWER_DTYPE
+                             record per buffer and channel (uint16 channel index, float32 linear power in mW), 6
+                             bytes per buffer.
+    <output_filename>.pwrm : one DWELL_DTYPE record per dwell : index of its first power record, timestamp of its
+                             first buffer (epoch ns), number of buffers (or windows) and number of channels.
+The power records of a dwell are in (buffer, channel) order. The timestamps are not stored per buffer : the start
+of the buffer b (window w) of a dwell is the dwell timestamp + the sample offset of the buffer (window), derived
+from the buffer size, decimation and window settings kept in the header (see unit_offsets_ns()).
+
+rethreshold() memory-maps a power log and computes, for many thresholds at once, the busy buffers, the occupancy
+and the coalesced bursts of each channel, a chunk of dwells at a time so the memory stays bounded.
+"""
+import os
+import threading
+
+import numpy as np
+
+from event_sink import write_file_header, read_file_header
+
+POWER_LOG_MAGIC = b'SASPOWER'
+
+POWER_DTYPE = np.dtype([('channel', '<u2'), ('power', '<f4')])
+
+DWELL_DTYPE = np.dtype([('offset', '<i8'), ('time_ns', '<i8'), ('units', '<u4'), ('channels', '<u2')])
+
+# Size (bytes) of the write buffer of the power log
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def dwells_path(path):
+    """Path of the dwell file of the power log <path>"""
+    return os.path.splitext(path)[0] + '.pwrm'
+
+
+class PowerLog:
+    """Append the avg power of every buffer (or window) of each dwell to the power log <path>. <settings> : dict of
+    center_freq, filter_bandwidth, channel_number, decimation, buffer_size, window_size and window_step (None without
+    --window)"""
+
+    def __init__(self, path, settings, metadata=None):
+        self.path = path
+        self.settings = settings
+        self.out = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.dwells = open(dwells_path(path), 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.data_offset = None
+        self.write_header(metadata)
+        # Number of power records written
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write_header(self, metadata):
+        header = dict(self.settings)
+        header["metadata"] = metadata if metadata is not None else []
+        self.data_offset = write_file_header(self.out, self.path, POWER_LOG_MAGIC, header, self.data_offset)
+
+    def add(self, time_ns, channels, power):
+        """Add the avg power (mW) of one dwell as an array (buffers, channels) for the channel indices <channels>, with
+        the timestamp (epoch ns) of its first buffer"""
+        records = np.empty(power.shape, dtype=POWER_DTYPE)
+        records['channel'] = channels
+        records['power'] = power
+        with self.lock:
+            dwell = np.array([(self.count, time_ns, power.shape[0], power.shape[1])], dtype=DWELL_DTYPE)
+            self.out.write(records.tobytes())
+            self.dwells.write(dwell.tobytes())
+            self.count = self.count + records.size
+
+    def close(self, metadata=None):
+        """Flush and close the power log. <metadata> : list of [name, value] rows of the capturing"""
+        with self.lock:
+            if self.out.closed:
+                return
+            if metadata is not None:
+                self.out.flush()
+                self.write_header(metadata)
+            self.out.close()
+            self.dwells.close()
+
+
+def load_power_log(path):
+    """Memory-map a power log. Return (header, records, dwells). Only the complete dwells are returned"""
+    header, data_offset = read_file_header(path, POWER_LOG_MAGIC, "a power log")
+    dwells = np.fromfile(dwells_path(path), dtype=DWELL_DTYPE)
+    record_count = (os.path.getsize(path) - data_offset) // POWER_DTYPE.itemsize
+    dwells = dwells[dwells['offset'] + dwells['units'].astype(np.int64)*dwells['channels'] <= record_count]
+    if record_count <= 0:
+        return header, np.empty(0, dtype=POWER_DTYPE), dwells
+    return header, np.memmap(path, dtype=POWER_DTYPE, mode='r', offset=data_offset, shape=(record_count,)), dwells
+
+
+def unit_offsets_ns(header, units):
+    """Offset (ns) of each of the <units> buffers (or windows) of a dwell from the dwell timestamp, and the duration
+    (ns) of a buffer (window)"""
+    decimation = header["decimation"]
+    buffer_size = header["buffer_size"]
+    if header["window_size"] is None:
+        sample_offset = np.arange(units, dtype=np.int64) * buffer_size
+        unit_size = buffer_size
+    else:
+        window_start = np.arange(0, buffer_size - header["window_size"] + 1, header["window_step"], dtype=np.int64)
+        unit = np.arange(units, dtype=np.int64)
+        sample_offset = (unit // len(window_start)) * buffer_size + window_start[unit % len(window_start)]
+        unit_size = header["window_size"]
+    return (sample_offset*1000000000*decimation)//40000000, (unit_size*1000000000*decimation)//40000000
+
+
+def rethreshold(path, thresholds_dbm, gap_ns=0, chunk_records=4000000):
+    """Re-apply the thresholds <thresholds_dbm> (dBm) to the power log <path>. Return (header, result) where result
+    is a dict of arrays (thresholds, channels) : "units" observed, "busy" units over the threshold and "bursts",
+    the busy units coalesced like --coalesce with no hysteresis : the busy units of a channel separated by at most
+    <gap_ns> are one burst, and a burst is closed when the channel stops being observed. The dwells are processed
+    in chunks of about <chunk_records> power records"""
+    header, records, dwells = load_power_log(path)
+    thresholds = 10 ** (np.asarray(thresholds_dbm, dtype=np.float64)/10)
+    channel_number = header["channel_number"]
+    units = np.zeros(channel_number, dtype=np.int64)
+    busy = np.zeros((len(thresholds), channel_number), dtype=np.int64)
+    bursts = np.zeros((len(thresholds), channel_number), dtype=np.int64)
+    # State carried from one chunk to the next, per channel : end of the last observed unit and observation segment
+    # count, and per threshold the end and segment of the last busy unit
+    observed_end = np.full(channel_number, np.iinfo(np.int64).min // 2)
+    segment_count = np.zeros(channel_number, dtype=np.int64)
+    busy_end = np.full((len(thresholds), channel_number), np.iinfo(np.int64).min // 2)
+    busy_segment = np.full((len(thresholds), channel_number), -1, dtype=np.int64)
+    # The units of a dwell are timed from the dwell timestamp, with the offsets of the longest dwell
+    offsets_ns, unit_ns = unit_offsets_ns(header, int(dwells['units'].max()) if len(dwells) > 0 else 0)
+
+    # Chunks of whole dwells, ordered by time (the processing threads may have written the dwells out of order)
+    dwells = dwells[np.argsort(dwells['time_ns'], kind='stable')]
+    dwell_records = dwells['units'].astype(np.int64) * dwells['channels']
+    chunk_first = np.flatnonzero(np.diff(np.cumsum(dwell_records) // max(chunk_records, 1), prepend=-1) != 0)
+    for first, last in zip(chunk_first, np.append(chunk_first[1:], len(dwells))):
+        chunk = dwells[first:last]
+        # Power records of the chunk, with the start time of their unit
+        counts = dwell_records[first:last]
+        within = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        index = np.repeat(chunk['offset'], counts) + within
+        unit = within // np.repeat(chunk['channels'].astype(np.int64), counts)
+        start_ns = np.repeat(chunk['time_ns'], counts) + offsets_ns[unit]
+        channel = records['channel'][index].astype(np.int64)
+        power = records['power'][index]
+
+        # Time order in each channel
+        order = np.lexsort((start_ns, channel))
+        start_ns = start_ns[order]
+        channel = channel[order]
+        power = power[order]
+        channel_first = np.flatnonzero(np.diff(channel, prepend=-1) != 0)
+        units = units + np.bincount(channel, minlength=channel_number)
+
+        # Observation segments : a unit not following the previous unit of its channel starts a new segment
+        previous_end = np.empty(len(start_ns), dtype=np.int64)
+        previous_end[1:] = start_ns[:-1] + unit_ns
+        previous_end[channel_first] = observed_end[channel[channel_first]]
+        discontinuity = (start_ns - previous_end > unit_ns).astype(np.int64)
+        discontinuity_cumsum = np.cumsum(discontinuity)
+        channel_size = np.diff(np.append(channel_first, len(channel)))
+        before_channel = discontinuity_cumsum[channel_first] - discontinuity[channel_first]
+        segment = discontinuity_cumsum - np.repeat(before_channel, channel_size) + segment_count[channel]
+        channel_last = np.append(channel_first[1:], len(channel)) - 1
+        observed_end[channel[channel_last]] = start_ns[channel_last] + unit_ns
+        segment_count[channel[channel_last]] = segment[channel_last]
+
+        for t, threshold in enumerate(thresholds):
+            above = np.flatnonzero(power >= threshold)
+            if len(above) == 0:
+                continue
+            above_channel = channel[above]
+            busy[t] = busy[t] + np.bincount(above_channel, minlength=channel_number)
+            # A busy unit starts a burst if the previous busy unit of its channel is in another observation segment or more than <gap_ns> before
+            above_first = np.flatnonzero(np.diff(above_channel, prepend=-1) != 0)
+            previous_end = np.empty(len(above), dtype=np.int64)
+            previous_end[1:] = start_ns[above[:-1]] + unit_ns
+            previous_end[above_first] = busy_end[t, above_channel[above_first]]
+            previous_segment = np.empty(len(above), dtype=np.int64)
+            previous_segment[1:] = segment[above[:-1]]
+            previous_segment[above_first] = busy_segment[t, above_channel[above_first]]
+            new_burst = (segment[above] != previous_segment) | (start_ns[above] - previous_end > gap_ns)
+            bursts[t] = bursts[t] + np.bincount(above_channel[new_burst], minlength=channel_number)
+            above_last = np.append(above_first[1:], len(above)) - 1
+            busy_end[t, above_channel[above_last]] = start_ns[above[above_last]] + unit_ns
+            busy_segment[t, above_channel[above_last]] = segment[above[above_last]]
+
+    return header, {"units" : np.broadcast_to(units, busy.shape), "busy" : busy, "bursts" : bursts}
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Sweep the detection parameters of channel-capturing.py over one raw IQ recording (--record), offline.
+
+Every combination of the swept values (threshold, buffer duration, dwell time, sweep option) is a replay of the
+recording with --device replay, run as its own channel-capturing.py process. <jobs> replays run at the same time,
+so the sweep uses all the cores. The outputs of each replay (events, Metadata, Stats) are written to
+<output_folder>/sweep-<k>.
+
+Output : table of the results, also written to <output_folder>/sweep-summary.csv (swept values, buffers
+processed, events and throughput of each replay).
+
+The capture settings of the recording (-f, -s, -fb, -d, --channelizer) must be given with --extra.
+
+Example : python replay-sweep.py example1.iq --extra "-f 2410 -s 100" -th -70 -65 -60 -b 50 100
+"""
+import argparse
+import os
+import sys
+import csv
+import shutil
+import itertools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+script_directory = os.path.dirname(os.path.abspath(__file__))
+
+# Swept parameters : name, option of channel-capturing.py
+SWEEP_PARAMETERS = [
+    ('threshold', '-th'),
+    ('bufferduration', '-b'),
+    ('fcduration', '-ft'),
+    ('option', '--option'),
+]
+
+# Metadata rows reported for each replay
+SWEEP_METRICS = ['Buffers processed', 'Events', 'Throughput (buffers/s)']
+
+# The replay ends at the end of the recording, the collection duration (min) is only an upper bound
+replay_duration = 1.0e6
+
+
+def read_metadata(path):
+    with open(path, 'r', newline='') as f:
+        return {row[0] : row[1] for row in csv.reader(f) if len(row) >= 2}
+
+
+def run_replay(name, recording, replay_args, output_folder):
+    work_dir = os.path.join(output_folder, name)
+    os.makedirs(work_dir, exist_ok=True)
+    shutil.copy(os.path.join(script_directory, 'default_conf.json'), work_dir)
+    command = [sys.executable, os.path.join(script_directory, 'channel-capturing.py'),
+               '--device', 'replay', '--replay', recording, '-t', str(replay_duration), '-o', name] + replay_args
+    subprocess.run(command, cwd=work_dir, check=True, stdout=subprocess.DEVNULL)
+    metadata = read_metadata(os.path.join(work_dir, 'Metadata-' + name + '.csv'))
+    return [metadata[metric] for metric in SWEEP_METRICS]
+
+
+my_parser = argparse.ArgumentParser(prog="replay-sweep", description=__doc__,
+                                    formatter_class=argparse.RawDescriptionHelpFormatter)
+my_parser.add_argument('recording', metavar='<iq_recording>', type=str, help='IQ recording (<output_filename>.iq) to replay')
+my_parser.add_argument('-th', '--threshold', metavar='<Threshold>', type=float, nargs='+',
+                       help='Thresholds (dBm) swept')
+my_parser.add_argument('-b', '--bufferduration', metavar='<Buffer_duration>', type=int, nargs='+',
+                       help='Buffer durations (us) swept')
+my_parser.add_argument('-ft', '--fcduration', metavar='<Fc_dwelltime>', type=int, nargs='+',
+                       help='Dwell times (ms) swept')
+my_parser.add_argument('--option', metavar='<Sweep_option>', type=str, nargs='+',
+                       help='Sweep options swept')
+my_parser.add_argument('--extra', metavar='"<arguments>"', type=str, default='',
+                       help='Extra arguments passed to channel-capturing.py for every replay, at least the capture settings of the recording')
+my_parser.add_argument('-j', '--jobs', metavar='<jobs>', type=int, default=os.cpu_count(),
+                       help='Number of replays run at the same time. Default to the number of cores')
+my_parser.add_argument('-o', '--output', metavar='<output_folder>', type=str,
+                       help='Folder of the replay outputs. Default to <iq_recording>-sweep')
+args = my_parser.parse_args()
+
+recording = os.path.abspath(args.recording)
+output_folder = args.output if args.output is not None else os.path.splitext(recording)[0] + '-sweep'
+os.makedirs(output_folder, exist_ok=True)
+
+# All the combinations of the swept values. The parameters not swept keep the value of --extra or the configuration file
+swept = [(name, option, getattr(args, name)) for name, option in SWEEP_PARAMETERS if getattr(args, name) is not None]
+combinations = list(itertools.product(*[values for _, _, values in swept]))
+replays = []
+for k, values in enumerate(combinations):
+    replay_args = args.extra.split()
+    for (name, option, _), value in zip(swept, values):
+        replay_args = replay_args + [option, str(value)]
+    replays.append(('sweep-{}'.format(k), replay_args))
+
+print('Replay <{}> with {} parameter combinations, {} at a time'.format(args.recording, len(replays), args.jobs))
+with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+    results = list(executor.map(lambda replay : run_replay(replay[0], recording, replay[1], output_folder), replays))
+
+header = ['replay'] + [name for name, _, _ in swept] + SWEEP_METRICS
+rows = [[name] + list(values) + result for (name, _), values, result in zip(replays, combinations, results)]
+print(''.join('{:>24}'.format(column) for column in header))
+for row in rows:
+    print(''.join('{:>24}'.format(value) for value in row))
+
+with open(os.path.join(output_folder, 'sweep-summary.csv'), 'w', newline='') as out:
+    csv_output = csv.writer(out)
+    csv_output.writerow(header)
+    csv_output.writerows(rows)